@@ -1,23 +1,334 @@
 from pathlib import Path
 import logging
-from datetime import datetime
-from mysql.connector import connect, FieldType
+from datetime import datetime, timedelta
+from mysql.connector import connect, FieldFlag, FieldType
+from mysql.connector.pooling import MySQLConnectionPool
 import mysql.connector.errors as mysql_errors
 import configparser
 from string import Template
-import hashlib
 import json
 import nibabel as nib
-from time import sleep
-import zipfile
-
+import pandas as pd
+from time import sleep, monotonic
+from contextlib import contextmanager
+import functools
+import threading
+import uuid
+
+from AMBRA_Backups import utils
 from AMBRA_Utils import Series
 
+# mysql client error numbers raised when the connection to the server is lost.
+CONNECTION_LOST_ERRNOS = (2006, 2013, 2055)
+
+# Column types, as reported in cursor.description, that are converted to
+# typed columns by Database.query_to_dataframe. Others are kept as objects.
+INTEGER_FIELD_TYPES = {
+    FieldType.TINY,
+    FieldType.SHORT,
+    FieldType.LONG,
+    FieldType.INT24,
+    FieldType.LONGLONG,
+    FieldType.YEAR,
+}
+FLOAT_FIELD_TYPES = {FieldType.FLOAT, FieldType.DOUBLE}
+DATETIME_FIELD_TYPES = {FieldType.DATETIME, FieldType.TIMESTAMP}
+STRING_FIELD_TYPES = {
+    FieldType.VARCHAR,
+    FieldType.VAR_STRING,
+    FieldType.STRING,
+    FieldType.ENUM,
+    FieldType.SET,
+}
+DECIMAL_FIELD_TYPES = {FieldType.DECIMAL, FieldType.NEWDECIMAL}
+BLOB_FIELD_TYPES = {
+    FieldType.TINY_BLOB,
+    FieldType.MEDIUM_BLOB,
+    FieldType.LONG_BLOB,
+    FieldType.BLOB,
+    FieldType.GEOMETRY,
+}
+# Character set number of binary strings, e.g. BLOB and VARBINARY columns.
+BINARY_CHARSET = 63
+# Largest precision and scale of a MySQL DECIMAL column.
+MAX_DECIMAL_PRECISION = 65
+MAX_DECIMAL_SCALE = 30
+
+
+# ------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def tag_key(group_hex, element_hex):
+    """
+    Returns the (group, element) integers of a DICOM tag given in hex, e.g.
+    tag_key("0020", "0011") == (0x0020, 0x0011).
+    """
+    return (int(str(group_hex), 16), int(str(element_hex), 16))
+
+
+# ------------------------------------------------------------------------------
+def index_tags(tags, keys=None):
+    """
+    Returns a dictionary mapping the (group, element) of every tag in a tag
+    payload, as returned by AMBRA_Utils.Series.get_tags(0), to its value. Tags
+    that appear more than once map to the list of their values.
+
+    Building the index once makes each following lookup O(1) instead of a scan
+    of the whole payload. If keys is given, only those tags are indexed.
+    """
+    index = {}
+    repeated = set()
+    for tag in tags["tags"]:
+        key = (tag["group"], tag["element"])
+        if keys is not None and key not in keys:
+            continue
+        if key not in index:
+            index[key] = tag["value"]
+        elif key in repeated:
+            index[key].append(tag["value"])
+        else:
+            index[key] = [index[key], tag["value"]]
+            repeated.add(key)
+    return index
+
+
+# Source of every img_series column filled from a series, in the column
+# order used for inserts: either the (group, element) of a DICOM tag read from
+# the series tags, or the name of an attribute of the AMBRA_Utils.Series.
+# Adding a column to img_series only requires adding it here.
+IMG_SERIES_FIELDS = (
+    ("scanner_model", tag_key("0008", "1090")),
+    ("scanner_manufac", tag_key("0008", "0070")),
+    ("magnetic_field_strength", tag_key("0018", "0087")),
+    ("device_serial_number", tag_key("0018", "1000")),
+    ("series_number", tag_key("0020", "0011")),
+    ("series_description", "formatted_description"),
+    ("protocol_name", tag_key("0018", "1030")),
+    ("TR", tag_key("0018", "0080")),
+    ("TE", tag_key("0018", "0081")),
+    ("recon_matrix_rows", tag_key("0028", "0010")),
+    ("recon_matrix_cols", tag_key("0028", "0011")),
+    ("slice_thickness", tag_key("0018", "0050")),
+    ("number_of_slices", tag_key("0054", "0081")),
+    ("number_of_temporal_positions", tag_key("0020", "0105")),
+    ("acquisition_number", tag_key("0020", "0012")),
+    ("number_of_dicoms", "count"),
+    ("series_uid", "series_uid"),
+    ("software_version", tag_key("0018", "1020")),
+    ("pixel_spacing", tag_key("0028", "0030")),
+    ("pixel_bandwidth", tag_key("0018", "0095")),
+    ("acq_matrix", tag_key("0018", "1310")),
+    ("perc_phase_fov", tag_key("0018", "0094")),
+    ("inversion_time", tag_key("0018", "0082")),
+    ("flip_angle", tag_key("0018", "1314")),
+    ("scanner_station_name", tag_key("0008", "1010")),
+    ("mr_acq_type", tag_key("0018", "0023")),
+    ("sequence_name", tag_key("0018", "0024")),
+)
+IMG_SERIES_COLUMNS = tuple(column for column, _ in IMG_SERIES_FIELDS)
+# (group, element) of the DICOM tags stored in the img_series table by column.
+SERIES_TAGS = {
+    column: source for column, source in IMG_SERIES_FIELDS if isinstance(source, tuple)
+}
+SERIES_TAG_KEYS = frozenset(SERIES_TAGS.values())
+
+
+# ------------------------------------------------------------------------------
+def series_record(series, series_tags):
+    """
+    Returns the values of the IMG_SERIES_COLUMNS for the series, given its tag
+    payload as returned by series.get_tags(0).
+    """
+    tag_index = {} if series_tags is None else index_tags(series_tags, SERIES_TAG_KEYS)
+    return tuple(
+        tag_index.get(source) if isinstance(source, tuple) else getattr(series, source)
+        for _, source in IMG_SERIES_FIELDS
+    )
+
+
+# ------------------------------------------------------------------------------
+def parse_ambra_datetime(value):
+    """
+    Returns a datetime from a date string returned by Ambra, e.g.
+    '2022-02-28 10:15:00.123456-07', or None if it cannot be parsed. The time
+    zone offset is dropped.
+    """
+    if not value:
+        return None
+    if value[-3:] == "-07":
+        value = value[0:-3]
+    if "+" in value:
+        value = value.split("+")[0]
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        try:
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+
+
+# ------------------------------------------------------------------------------
+def study_updated_datetime(study):
+    """
+    Returns the value stored in the updated column of the studies table for the
+    study: its 'updated' field, or its 'created' field if Ambra did not set it.
+
+    Both fields are parsed with parse_ambra_datetime, which drops '+HH' time
+    zone offsets. Before, only 'created' was handled this way, and an 'updated'
+    value with such an offset could not be parsed and was stored as NULL.
+    Studies stored like that are not current for study_is_current, so they are
+    updated once with the parsed time.
+    """
+    if not study.updated:
+        return parse_ambra_datetime(study.created)
+    return parse_ambra_datetime(study.updated)
+
+
+# ------------------------------------------------------------------------------
+def typed_column(values, field_type):
+    """
+    Returns the values of a query result column as a pandas array or Series
+    whose dtype matches the MySQL field_type. Integers use the nullable Int64
+    dtype so that NULL values do not turn the column into floats.
+    """
+    if field_type in INTEGER_FIELD_TYPES:
+        return pd.array(values, dtype="Int64")
+    if field_type in FLOAT_FIELD_TYPES:
+        return pd.array(values, dtype="Float64").astype("float64")
+    if field_type in DATETIME_FIELD_TYPES:
+        return pd.to_datetime(pd.Series(values, dtype=object))
+    return pd.Series(values, dtype=object)
+
+
+# ------------------------------------------------------------------------------
+def arrow_type(description):
+    """
+    Returns the pyarrow type of a query result column given its entry in
+    cursor.description, or None if it cannot be known from the field type.
+
+    DECIMAL columns use their precision and scale when the connector reports
+    them, and otherwise a decimal type wide enough for any MySQL DECIMAL, so
+    that every batch of a query has the same type. BLOB and string columns are
+    binary if their character set is binary, as mysql.connector returns bytes
+    for them.
+    """
+    import pyarrow as pa
+
+    field_type = description[1]
+    flags = description[7] if len(description) > 7 else 0
+    binary = len(description) > 8 and description[8] == BINARY_CHARSET
+
+    if field_type == FieldType.LONGLONG and flags & FieldFlag.UNSIGNED:
+        return pa.uint64()
+    if field_type in INTEGER_FIELD_TYPES:
+        return pa.int64()
+    if field_type == FieldType.BIT:
+        return pa.uint64()
+    if field_type in FLOAT_FIELD_TYPES:
+        return pa.float64()
+    if field_type in DECIMAL_FIELD_TYPES:
+        precision, scale = description[4], description[5]
+        if precision is None or scale is None:
+            precision, scale = MAX_DECIMAL_PRECISION, MAX_DECIMAL_SCALE
+        if precision > 38:
+            return pa.decimal256(precision, scale)
+        return pa.decimal128(precision, scale)
+    if field_type in DATETIME_FIELD_TYPES:
+        return pa.timestamp("us")
+    if field_type in (FieldType.DATE, FieldType.NEWDATE):
+        return pa.date32()
+    if field_type == FieldType.TIME:
+        # mysql.connector returns TIME values as timedeltas.
+        return pa.duration("us")
+    if field_type == FieldType.JSON:
+        return pa.string()
+    if field_type == FieldType.SET:
+        # mysql.connector returns SET values as python sets.
+        return None
+    if field_type in STRING_FIELD_TYPES or field_type in BLOB_FIELD_TYPES:
+        return pa.binary() if binary else pa.string()
+    if field_type == FieldType.NULL:
+        return pa.null()
+    return None
+
+
+# ------------------------------------------------------------------------------
+def arrow_column(values, description):
+    """
+    Returns the values of a query result column as a pyarrow array of the type
+    given by arrow_type for its cursor.description entry. Values of other
+    columns are converted with the type pyarrow infers.
+    """
+    import pyarrow as pa
+
+    return pa.array(values, type=arrow_type(description))
+
+
+# ------------------------------------------------------------------------------
+def with_connection(method=None, idempotent=False):
+    """
+    Decorator for Database methods that use self.connection, used either as
+    @with_connection or @with_connection(idempotent=True).
+
+    The call runs inside Database.session(), so in pooled mode a connection is
+    checked out of the pool for the duration of the call and returned after.
+    If the connection to the server was lost, it is reconnected. Idempotent
+    methods, i.e. reads, are then retried. Other methods are not, since the
+    server may have committed their changes before the connection was lost,
+    and the error is raised. Only the outermost decorated call reconnects, so a
+    nested call never silently continues on a new connection after earlier
+    statements were lost.
+    """
+    if method is None:
+        return functools.partial(with_connection, idempotent=idempotent)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.session() as connection:
+            if self._local.depth > 1:
+                return method(self, *args, **kwargs)
+            for attempt in range(self.n_retries + 1):
+                try:
+                    return method(self, *args, **kwargs)
+                except (
+                    mysql_errors.OperationalError,
+                    mysql_errors.InterfaceError,
+                ) as e:
+                    if (
+                        e.errno not in CONNECTION_LOST_ERRNOS
+                        and connection.is_connected()
+                    ):
+                        raise
+                    if idempotent and attempt == self.n_retries:
+                        raise
+                    logging.warning(
+                        f"Lost connection to the database, reconnecting: {e}"
+                    )
+                    connection.reconnect(attempts=self.n_retries, delay=5)
+                    if not idempotent:
+                        raise
+
+    return wrapper
+
 
 ################################################################################
 class Database:
+    # Incremented by create_schema for each database name so that instances
+    # reload their cached schema.
+    _schema_generations = {}
+
     # --------------------------------------------------------------------------
-    def __init__(self, database, config_path=None):
+    def __init__(
+        self,
+        database,
+        config_path=None,
+        hash_cache=None,
+        pool_size=None,
+        pool_timeout=60,
+        n_retries=3,
+        ambra_cache=None,
+    ):
         """
         Initialize the Database class.
 
@@ -28,25 +339,235 @@ class Database:
         config_path: str, Path
             Path to the config file, if 'None' it will look for the file in
             ~/.study_database
+        hash_cache: utils.HashCache, str, Path, bool, None
+            Cache of file hashes used by hash_file. A str or Path is the path to
+            the cache file and True uses the default cache file. If None, files
+            are always hashed.
+        pool_size: int, None
+            If None, a single connection is shared by all methods and the object
+            must not be used from more than one thread at a time. Otherwise a
+            pool of up to pool_size (at most 32) connections is created and each
+            thread checks out its own connection, see session().
+        pool_timeout: int, float
+            Seconds to wait for a free connection when the pool is exhausted.
+        n_retries: int
+            Number of times a call is retried after the connection was lost.
+        ambra_cache: ambra_cache.AmbraCache, None
+            If not None, series lists, series tags and study tags retrieved from
+            Ambra are taken from and stored in this cache.
         """
         self.db_name = database
         self.config_path = config_path
-        self.connection = self.connect(self.db_name, config_path=config_path)
+        self.n_retries = n_retries
+        self.pool_timeout = pool_timeout
+        self._local = threading.local()
+        self._pool = None
+        self._connection = None
+        if pool_size:
+            self._pool = self.create_pool(
+                self.db_name, pool_size, config_path=config_path
+            )
+        else:
+            self._connection = self.connect(self.db_name, config_path=config_path)
+
+        if hash_cache is True:
+            hash_cache = utils.HashCache()
+        elif isinstance(hash_cache, (str, Path)):
+            hash_cache = utils.HashCache(hash_cache)
+        self.hash_cache = hash_cache or None
+        self.ambra_cache = ambra_cache
+        self._schema = None
+        self._schema_generation = None
+        self._schema_lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    @property
+    def connection(self):
+        """
+        The connection used by the current thread.
+
+        In pooled mode, a thread that accesses the connection outside of
+        session() checks one out of the pool and keeps it until
+        release_connection() is called.
+        """
+        if self._pool is None:
+            return self._connection
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._checkout()
+            self._local.connection = connection
+        return connection
+
+    # --------------------------------------------------------------------------
+    @connection.setter
+    def connection(self, connection):
+        if self._pool is None:
+            self._connection = connection
+        else:
+            self._local.connection = connection
+
+    # --------------------------------------------------------------------------
+    def _checkout(self):
+        deadline = monotonic() + self.pool_timeout
+        while True:
+            try:
+                return self._pool.get_connection()
+            except mysql_errors.PoolError:
+                if monotonic() > deadline:
+                    raise
+                sleep(0.05)
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def session(self):
+        """
+        Context manager that yields the connection used by the current thread.
+
+        In pooled mode, if the thread does not hold a connection yet, one is
+        checked out of the pool for the duration of the block and returned to
+        the pool afterwards. Nested sessions share the same connection.
+        """
+        depth = getattr(self._local, "depth", 0)
+        checked_out = self._pool is not None and (
+            getattr(self._local, "connection", None) is None
+        )
+        connection = self.connection
+        self._local.depth = depth + 1
+        try:
+            yield connection
+        finally:
+            self._local.depth = depth
+            if checked_out:
+                self.release_connection()
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def transaction(self, flush_every=None):
+        """
+        Context manager for a unit of work. Commits made by the Database methods
+        inside the block are deferred and done once when the block exits. If an
+        exception is raised, uncommitted changes are rolled back.
+
+        Nested transactions join the outermost one.
+
+        Inputs:
+        --------
+        flush_every: int, None
+            If set, a commit is made after every flush_every write statements
+            so that long running blocks do not hold a single huge transaction.
+            Changes already flushed are not rolled back on error.
+        """
+        if getattr(self._local, "transaction", None) is not None:
+            yield self
+            return
+
+        with self.session() as connection:
+            self._local.transaction = {"flush_every": flush_every, "pending": 0}
+            try:
+                yield self
+            except BaseException:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
+            finally:
+                self._local.transaction = None
+
+    # --------------------------------------------------------------------------
+    def in_transaction(self):
+        """
+        Returns True if the current thread is inside transaction().
+        """
+        return getattr(self._local, "transaction", None) is not None
+
+    # --------------------------------------------------------------------------
+    def _commit(self, n_statements=1):
+        """
+        Commits the connection unless inside transaction(), in which case the
+        statements are only counted towards the next flush.
+        """
+        transaction = getattr(self._local, "transaction", None)
+        if transaction is None:
+            self.connection.commit()
+            return
+        transaction["pending"] += n_statements
+        flush_every = transaction["flush_every"]
+        if flush_every and transaction["pending"] >= flush_every:
+            self.connection.commit()
+            transaction["pending"] = 0
+
+    # --------------------------------------------------------------------------
+    def release_connection(self):
+        """
+        In pooled mode, returns the connection held by the current thread to
+        the pool. Does nothing otherwise.
+        """
+        if self._pool is None:
+            return
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection.close()
 
     # --------------------------------------------------------------------------
     def close(self):
-        self.connection.commit()
-        self.connection.close()
+        """
+        Commits and closes the connection of the current thread. In pooled mode
+        the idle connections of the pool are closed as well, so it must only be
+        called once other threads are done with the object.
+        """
+        if self._pool is None:
+            self._connection.commit()
+            self._connection.close()
+            return
+
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.commit()
+            self.release_connection()
+        while True:
+            try:
+                connection = self._pool.get_connection()
+            except mysql_errors.PoolError:
+                break
+            # disconnect() closes the underlying connection, while close()
+            # would return it to the pool.
+            connection.disconnect()
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        return self
 
     # --------------------------------------------------------------------------
     def __exit__(self, exc_type, exc_value, traceback):
-        self.connection.close()
+        self.close()
 
     # --------------------------------------------------------------------------
     def reconnect(self):
+        if self._pool is not None:
+            self.connection.reconnect(attempts=self.n_retries, delay=5)
+            return
         self.connection.close()
         self.connection = self.connect(self.db_name, config_path=self.config_path)
 
+    # --------------------------------------------------------------------------
+    def _study_series(self, study):
+        if self.ambra_cache is not None:
+            return self.ambra_cache.series(study)
+        return list(study.get_series())
+
+    # --------------------------------------------------------------------------
+    def _series_tags(self, series):
+        if self.ambra_cache is not None:
+            return self.ambra_cache.series_tags(series)
+        return series.get_tags(0)
+
+    # --------------------------------------------------------------------------
+    def _study_tags(self, study):
+        if self.ambra_cache is not None:
+            return self.ambra_cache.study_tags(study)
+        return study.get_study_tags()
+
     # --------------------------------------------------------------------------
     @classmethod
     def get_config(cls, config_path=None):
@@ -74,8 +595,11 @@ class Database:
 
     # --------------------------------------------------------------------------
     @classmethod
-    def connect(cls, db_name=None, config_path=None, n_retries=5):
-        """ """
+    def connect(cls, db_name=None, config_path=None, n_retries=5, **kwargs):
+        """
+        Returns a new connection. Extra keyword arguments are passed to
+        mysql.connector.connect, e.g. allow_local_infile_in_path.
+        """
         config = cls.get_config(config_path=config_path)
         db_config = config["ambra_backup"]
 
@@ -91,6 +615,7 @@ class Database:
                     # pool_size = 500
                     buffered=True,
                     # consume_results=True
+                    **kwargs,
                 )
 
                 return connection
@@ -101,6 +626,26 @@ class Database:
                 logging.error(e)
                 raise e
 
+    # --------------------------------------------------------------------------
+    @classmethod
+    def create_pool(cls, db_name, pool_size, config_path=None):
+        """
+        Returns a mysql.connector pool of pool_size connections to db_name.
+        """
+        config = cls.get_config(config_path=config_path)
+        db_config = config["ambra_backup"]
+
+        return MySQLConnectionPool(
+            pool_name=f"{db_name}_{uuid.uuid4().hex[0:8]}",
+            pool_size=pool_size,
+            host=db_config["host"],
+            port=db_config["port"],
+            user=db_config["user_name"],
+            password=db_config["password"],
+            database=db_name,
+            buffered=True,
+        )
+
     # --------------------------------------------------------------------------
     @classmethod
     def get_databases(cls, config_path=None):
@@ -151,38 +696,157 @@ class Database:
                 cursor.execute(query.strip())
             connection.commit()
 
+        cls._schema_generations[db_name] = cls._schema_generations.get(db_name, 0) + 1
+
+    # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
+    def _load_schema(self):
+        """
+        Queries the tables, columns and unique keys of the database.
+        """
+        schema = {}
+        columns = self.run_select_query(
+            """SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE,
+                      COLUMN_KEY, COLUMN_DEFAULT, EXTRA
+               FROM information_schema.COLUMNS
+               WHERE TABLE_SCHEMA = DATABASE()
+               ORDER BY TABLE_NAME, ORDINAL_POSITION"""
+        )
+        for table_name, *column in columns:
+            table = schema.setdefault(table_name, {"columns": [], "unique_keys": {}})
+            table["columns"].append(tuple(column))
+
+        unique_keys = self.run_select_query(
+            """SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME
+               FROM information_schema.STATISTICS
+               WHERE TABLE_SCHEMA = DATABASE() AND NON_UNIQUE = 0
+               ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX"""
+        )
+        for table_name, index_name, column_name in unique_keys:
+            if table_name in schema:
+                keys = schema[table_name]["unique_keys"]
+                keys.setdefault(index_name, []).append(column_name)
+
+        return schema
+
+    # --------------------------------------------------------------------------
+    def get_schema(self, refresh=False):
+        """
+        Returns a dictionary mapping each table name to a dictionary with:
+            columns: list of (name, type, null, key, default, extra) tuples, as
+                returned by DESCRIBE.
+            unique_keys: dictionary mapping the name of each unique index,
+                including PRIMARY, to its list of columns.
+
+        The schema is queried once and cached until refresh_schema() is called,
+        refresh is True or create_schema() is run for this database.
+        """
+        generation = self._schema_generations.get(self.db_name, 0)
+        with self._schema_lock:
+            if refresh or self._schema is None or self._schema_generation != generation:
+                self._schema = self._load_schema()
+                self._schema_generation = generation
+            return self._schema
+
+    # --------------------------------------------------------------------------
+    def refresh_schema(self):
+        """
+        Drops the cached schema, use after altering tables outside of this
+        object.
+        """
+        with self._schema_lock:
+            self._schema = None
+
+    # --------------------------------------------------------------------------
+    def _get_table(self, table_name):
+        """
+        Returns the cached schema of the table or None if it does not exist. The
+        schema is refreshed once if the table is missing, in case it has been
+        created since it was cached.
+        """
+        table = self.get_schema().get(table_name)
+        if table is None:
+            table = self.get_schema(refresh=True).get(table_name)
+        return table
+
     # --------------------------------------------------------------------------
     def list_tables(self, buffered=True):
-        with self.connection.cursor(buffered=buffered) as cursor:
-            cursor.execute("SHOW TABLES;")
-            results = cursor.fetchall()
-        return list(results)
+        """
+        Returns the tables of the database as a list of (name,) tuples, as
+        SHOW TABLES. buffered is ignored, the list comes from get_schema().
+        """
+        return [(table_name,) for table_name in sorted(self.get_schema())]
 
     # --------------------------------------------------------------------------
     def describe_table(self, table_name, buffered=True):
-        with self.connection.cursor(buffered=buffered) as cursor:
-            cursor.execute(f"DESCRIBE {table_name};")
-            results = cursor.fetchall()
-        return list(results)
+        """
+        Returns the columns of the table as DESCRIBE. buffered is ignored, the
+        columns come from get_schema().
+        """
+        table = self._get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} not in database")
+        return list(table["columns"])
+
+    # --------------------------------------------------------------------------
+    def table_columns(self, table_name):
+        """
+        Returns the list of column names of the table or None if it does not
+        exist.
+        """
+        table = self._get_table(table_name)
+        if table is None:
+            return None
+        return [column[0] for column in table["columns"]]
 
     # --------------------------------------------------------------------------
+    def column_types(self, table_name):
+        """
+        Returns a dictionary mapping the columns of the table to their SQL type.
+        """
+        return {column[0]: column[1] for column in self.describe_table(table_name)}
+
+    # --------------------------------------------------------------------------
+    def unique_keys(self, table_name):
+        """
+        Returns a dictionary mapping the unique indexes of the table to their
+        list of columns.
+        """
+        table = self._get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} not in database")
+        return {name: list(columns) for name, columns in table["unique_keys"].items()}
+
+    # --------------------------------------------------------------------------
+    def check_columns(self, table_name, columns):
+        """
+        Raises a ValueError if the table does not exist or does not have all of
+        the columns. The schema is refreshed once before failing.
+        """
+        table_columns = self.table_columns(table_name)
+        if table_columns is not None and not set(columns) <= set(table_columns):
+            self.refresh_schema()
+            table_columns = self.table_columns(table_name)
+        if table_columns is None:
+            raise ValueError(f"Table {table_name} not in database")
+        missing = set(columns) - set(table_columns)
+        if missing:
+            raise ValueError(
+                f"Columns {sorted(missing)} not in table {table_name}: {table_columns}"
+            )
+
+    # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def run_select_query(
         self, query, record=None, column_names=False, buffered=True, field_types=False
     ):
         """
         Runs an SQL SELECT query and return the results.
 
-        Do not set buffered to True if you expect a large result to be returned.
+        All of the rows are loaded in memory, use iter_select_query if you
+        expect a large result to be returned.
 
         """
-        # with self.connection.cursor(buffered=buffered) as cursor:
-        #     cursor.execute(query)
-        #     while True:
-        #         results = cursor.fetchmany(10)
-        #         if not results:
-        #             break
-        #         for result in results:
-        #             yield result
         with self.connection.cursor(buffered=buffered) as cursor:
             if record:
                 cursor.execute(query, record)
@@ -191,7 +855,7 @@ class Database:
             results = cursor.fetchall()
             columns = cursor.description
 
-        self.connection.commit()
+        self._commit(0)
 
         these_field_types = {this[0]: FieldType.get_info(this[1]) for this in columns}
 
@@ -209,6 +873,201 @@ class Database:
         return list(results)
 
     # --------------------------------------------------------------------------
+    def iter_select_query(
+        self,
+        query,
+        record=None,
+        batch_size=1000,
+        column_names=False,
+        as_dataframes=False,
+    ):
+        """
+        Runs an SQL SELECT query and yields the results as they are read from
+        the server, so that memory use is bounded by batch_size rows.
+
+        The query runs on its own unbuffered connection, so other queries can
+        be run on this Database while iterating. That connection does not see
+        changes that have not been committed yet. It is closed when the
+        iteration finishes or the generator is closed.
+
+        Inputs:
+        --------
+        query: str
+            SELECT query.
+        record: tuple, list, None
+            Parameters of the query.
+        batch_size: int
+            Number of rows fetched from the server at a time.
+        column_names: bool
+            If True, yields a dict per row keyed by column name, as
+            run_select_query. Otherwise yields a tuple per row.
+        as_dataframes: bool
+            If True, yields a pandas DataFrame of up to batch_size rows at a
+            time instead of single rows.
+        """
+        connection = self.connect(self.db_name, config_path=self.config_path)
+        try:
+            cursor = connection.cursor(buffered=False)
+            if record:
+                cursor.execute(query, record)
+            else:
+                cursor.execute(query)
+            columns = [column[0] for column in cursor.description]
+
+            while True:
+                results = cursor.fetchmany(batch_size)
+                if not results:
+                    break
+                if as_dataframes:
+                    yield pd.DataFrame.from_records(results, columns=columns)
+                elif column_names:
+                    for result in results:
+                        yield dict(zip(columns, result))
+                else:
+                    yield from results
+        finally:
+            # Closing the connection discards any rows that were not read.
+            connection.close()
+
+    # --------------------------------------------------------------------------
+    def _iter_column_batches(self, cursor, batch_size):
+        """
+        Yields the rows of an executed query as lists of column values, one
+        list per column, for up to batch_size rows at a time.
+        """
+        while True:
+            results = cursor.fetchmany(batch_size)
+            if not results:
+                break
+            yield [list(column) for column in zip(*results)]
+
+    # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
+    def query_to_dataframe(self, query, record=None, batch_size=10000, arrow=False):
+        """
+        Runs an SQL SELECT query and returns the result as a pandas DataFrame,
+        or a pyarrow Table if arrow is True.
+
+        Rows are read in batches of batch_size straight into columns, without
+        building a dict per row, and each column gets a dtype from its MySQL
+        field type: nullable Int64 for integers, float64, datetime64 for
+        DATETIME and TIMESTAMP, and object otherwise. Unlike
+        pd.DataFrame(run_select_query(..., column_names=True)), an empty result
+        still has its columns.
+
+        Inputs:
+        --------
+        query: str
+            SELECT query.
+        record: tuple, list, None
+            Parameters of the query.
+        batch_size: int
+            Number of rows fetched from the server at a time.
+        arrow: bool
+            If True, returns a pyarrow Table. Requires pyarrow to be installed.
+        """
+        with self.connection.cursor(buffered=False) as cursor:
+            if record:
+                cursor.execute(query, record)
+            else:
+                cursor.execute(query)
+            description = cursor.description
+            names = [column[0] for column in description]
+            field_types = [column[1] for column in description]
+
+            columns = [[] for _ in names]
+            for batch in self._iter_column_batches(cursor, batch_size):
+                for column, values in zip(columns, batch):
+                    column.extend(values)
+
+        self._commit(0)
+
+        if arrow:
+            import pyarrow as pa
+
+            return pa.Table.from_arrays(
+                [
+                    arrow_column(values, column)
+                    for values, column in zip(columns, description)
+                ],
+                names=names,
+            )
+
+        dataframe = pd.DataFrame(
+            {
+                index: typed_column(values, field_type)
+                for index, (values, field_type) in enumerate(zip(columns, field_types))
+            },
+            index=pd.RangeIndex(len(columns[0]) if columns else 0),
+        )
+        dataframe.columns = names
+        return dataframe
+
+    # --------------------------------------------------------------------------
+    def query_to_parquet(self, query, parquet_path, record=None, batch_size=10000):
+        """
+        Runs an SQL SELECT query and writes the result to a Parquet file, one
+        row group per batch of batch_size rows, so memory use stays bounded
+        for large exports. Requires pyarrow to be installed.
+
+        The schema is built from cursor.description, see arrow_type, so it does
+        not depend on the values of the first batch: e.g. a batch of NULLs or
+        of DECIMALs with few digits. Only columns whose type cannot be known
+        from the field type take the type of the first batch.
+
+        The query runs on its own connection, see iter_select_query.
+
+        Returns the number of rows written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        connection = self.connect(self.db_name, config_path=self.config_path)
+        n_rows = 0
+        writer = None
+        try:
+            cursor = connection.cursor(buffered=False)
+            if record:
+                cursor.execute(query, record)
+            else:
+                cursor.execute(query)
+            names = [column[0] for column in cursor.description]
+            types = [arrow_type(column) for column in cursor.description]
+
+            for batch in self._iter_column_batches(cursor, batch_size):
+                table = pa.Table.from_arrays(
+                    [
+                        pa.array(values, type=column_type)
+                        for values, column_type in zip(batch, types)
+                    ],
+                    names=names,
+                )
+                if writer is None:
+                    # Columns whose type could not be known from the field type
+                    # take the type of the first batch.
+                    types = list(table.schema.types)
+                    writer = pq.ParquetWriter(str(parquet_path), table.schema)
+                writer.write_table(table)
+                n_rows += table.num_rows
+
+            if writer is None:
+                schema = pa.schema(
+                    [
+                        pa.field(
+                            name, pa.null() if column_type is None else column_type
+                        )
+                        for name, column_type in zip(names, types)
+                    ]
+                )
+                writer = pq.ParquetWriter(str(parquet_path), schema)
+        finally:
+            if writer is not None:
+                writer.close()
+            connection.close()
+        return n_rows
+
+    # --------------------------------------------------------------------------
+    @with_connection
     def run_insert_query(self, query, record):
         """
         Runs an SQL INSERT/UPDATE query.
@@ -217,7 +1076,7 @@ class Database:
             cursor.execute(query, record)
             row_id = cursor.lastrowid
 
-        self.connection.commit()
+        self._commit()
         return row_id
 
     # --------------------------------------------------------------------------
@@ -228,6 +1087,7 @@ class Database:
 
         Returns the id of the inserted row.
         """
+        self.check_columns(table, dict.keys())
         query = (
             f"INSERT INTO {table} ( "
             + ", ".join(dict.keys())
@@ -246,6 +1106,7 @@ class Database:
         Update the dictionary into the specified table with keys being the column
         names for the 'id_column' row with value 'id_value'.
         """
+        self.check_columns(table, list(dict.keys()) + [id_column])
         set_string = ", ".join([str(this) + "=%s" for this in dict.keys()])
         query = f"UPDATE {table} SET {set_string} WHERE {id_column}='{id_value}';"
 
@@ -253,6 +1114,7 @@ class Database:
         return row_id
 
     # --------------------------------------------------------------------------
+    @with_connection
     def insert_update_datetime(
         self, namespace_name, namespace_type, namespace_id, namespace_uuid, date_time
     ):
@@ -285,9 +1147,10 @@ class Database:
         with self.connection.cursor(buffered=True) as cursor:
             cursor.execute(insert_update_query, datetime_record)
 
-        self.connection.commit()
+        self._commit()
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def get_last_backup(self, namespace_name, namespace_type):
         """
         Returns a datetime object of the last_update column of the backup_info table.
@@ -306,6 +1169,7 @@ class Database:
         return result[0]
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def get_study_by_uid(self, uid, storage_ns=None):
         """
         Returns the id from the studies table for the study that matches the
@@ -334,6 +1198,7 @@ class Database:
         return result[0]
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def get_study_by_uuid(self, uuid, storage_ns=None):
         """
         Returns the id from the studies table for the study that matches the
@@ -362,6 +1227,38 @@ class Database:
         return result[0]
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
+    def study_is_current(self, study):
+        """
+        Returns True if the study is in the studies table with the same updated
+        time as on Ambra and all of its series are in the img_series table, in
+        which case inserting it again would not change anything.
+
+        Inputs:
+        ----------
+        study: Object of the AMBRA_Utils.Study class
+        """
+        study_updated = study_updated_datetime(study)
+        if study_updated is None:
+            return False
+
+        select_query = """SELECT studies.updated, studies.series_count, COUNT(img_series.id)
+            FROM studies LEFT JOIN img_series ON img_series.id_study = studies.id
+            WHERE studies.uuid = %s GROUP BY studies.id"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(select_query, (study.uuid,))
+            results = cursor.fetchall()
+
+        if len(results) != 1:
+            return False
+        updated, series_count, n_series = results[0]
+        if updated is None or series_count is None or n_series < series_count:
+            return False
+        # The updated column does not store fractions of a second.
+        return abs(updated - study_updated) < timedelta(seconds=1)
+
+    # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def get_series_by_uid(self, uid):
         """
         Returns the id from the img_series table for the series that matches the
@@ -377,6 +1274,7 @@ class Database:
         return result[0]
 
     # --------------------------------------------------------------------------
+    @with_connection
     def insert_patient(self, patient_id, patient_name):
         """
         Insert the patient into the database if it does not already exist.
@@ -395,9 +1293,10 @@ class Database:
         with self.connection.cursor() as cursor:
             cursor.executemany(insert_patient_query, patient_record)
 
-        self.connection.commit()
+        self._commit()
 
     # --------------------------------------------------------------------------
+    @with_connection
     def insert_study(
         self,
         study,
@@ -405,6 +1304,7 @@ class Database:
         custom_functions=None,
         redownload=True,
         ignore_existing=False,
+        series=None,
     ):
         """
         Because study_uid is set as a unique primary key and IGNORE is used in the query,
@@ -424,42 +1324,17 @@ class Database:
         redownload: bool
             If true, then a study update will null the is_downloaded and download_date fields.
             If false, then those fields will be left as is.
-        """
+        series: list, None
+            Series of the study if they have already been retrieved, used for
+            the series count. If None, they are retrieved from Ambra.
 
-        if study.created[-3:] == "-07":
-            created_string = study.created[0:-3]
-        else:
-            created_string = study.created
+        Returns the id of the study in the studies table.
+        """
+        if series is None:
+            series = self._study_series(study)
 
-        if "+" in created_string:
-            created_string = created_string.split("+")[0]
-
-        try:
-            study_created = datetime.strptime(created_string, "%Y-%m-%d %H:%M:%S.%f")
-        except ValueError:
-            try:
-                study_created = datetime.strptime(created_string, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                study_created = None
-
-        if not study.updated:
-            study_updated = study_created
-        else:
-            if study.updated[-3:] == "-07":
-                updated_string = study.updated[0:-3]
-            else:
-                updated_string = study.updated
-            try:
-                study_updated = datetime.strptime(
-                    updated_string, "%Y-%m-%d %H:%M:%S.%f"
-                )
-            except ValueError:
-                try:
-                    study_updated = datetime.strptime(
-                        updated_string, "%Y-%m-%d %H:%M:%S"
-                    )
-                except ValueError:
-                    study_updated = None
+        study_created = parse_ambra_datetime(study.created)
+        study_updated = study_updated_datetime(study)
 
         # print(f'Study date: {study.study_date}')
         if study.study_date:
@@ -570,7 +1445,7 @@ class Database:
             study_record = (
                 study.patient_name,
                 study.attachment_count,
-                len(list(study.get_series())),
+                len(series),
                 study.study_uid,
                 study.uuid,
                 study.formatted_description,
@@ -586,7 +1461,7 @@ class Database:
 
             with self.connection.cursor() as cursor:
                 cursor.execute(insert_study_query, study_record)
-                self.connection.commit()
+                self._commit()
         else:
 
             def set_download(download):
@@ -616,7 +1491,7 @@ class Database:
             study_record = (
                 (
                     study.attachment_count,
-                    len(list(study.get_series())),
+                    len(series),
                     study.uuid,
                     study.formatted_description,
                     study_updated,
@@ -634,7 +1509,7 @@ class Database:
             with self.connection.cursor() as cursor:
                 cursor.execute(update_study_query, study_record)
 
-            self.connection.commit()
+            self._commit()
 
         # self.add_to_sequence_map(study.formatted_description)
 
@@ -644,142 +1519,231 @@ class Database:
         )
 
         if id_study is not None:
-            for tag in study.get_study_tags()["tags"]:
-                group, element = tag["tag"].strip("(").strip(")").split(",")
-                value = tag["value"]
-                max_tag_value_length = 512
-                if len(value) > max_tag_value_length:
-                    value = value[0:512]
-                tag_query = """INSERT INTO study_tags (id_study, tag_group, tag_element, tag_value) 
-                            VALUES (%s, %s, %s, %s)
-                            ON DUPLICATE KEY UPDATE
-                            tag_value = %s"""
-                tag_record = (id_study, group, element, value, value)
-
-                with self.connection.cursor() as cursor:
-                    cursor.execute(tag_query, tag_record)
+            self.insert_study_tags(id_study, self._study_tags(study))
 
-            self.connection.commit()
+        return id_study
+
+    # --------------------------------------------------------------------------
+    @with_connection
+    def insert_study_tags(self, id_study, study_tags, chunk_size=500):
+        """
+        Inserts or updates the study tags of the study with id id_study in the
+        study_tags table.
+
+        Only tags that are new or whose value has changed are written. They are
+        sent as multi-row INSERT ... ON DUPLICATE KEY UPDATE statements of at
+        most chunk_size rows, all committed in a single transaction.
+
+        Inputs:
+        -----------
+        id_study: int
+            id of the study in the studies table.
+        study_tags: dict
+            Study tags as returned by AMBRA_Utils.Study.get_study_tags().
+        chunk_size: int
+            Maximum number of rows per INSERT statement.
+        """
+        max_tag_value_length = 512
+        tags = {}
+        for tag in study_tags["tags"]:
+            group, element = tag["tag"].strip("(").strip(")").split(",")
+            tags[(group, element)] = tag["value"][0:max_tag_value_length]
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                """SELECT tag_group, tag_element, tag_value FROM study_tags
+                WHERE id_study = %s""",
+                (id_study,),
+            )
+            existing_tags = {
+                (group, element): value for group, element, value in cursor
+            }
+
+        tag_records = [
+            (id_study, group, element, value)
+            for (group, element), value in tags.items()
+            if (group, element) not in existing_tags
+            or existing_tags[(group, element)] != value
+        ]
+        if len(tag_records) == 0:
+            return
+
+        with self.connection.cursor() as cursor:
+            for start in range(0, len(tag_records), chunk_size):
+                chunk = tag_records[start : start + chunk_size]
+                tag_query = (
+                    """INSERT INTO study_tags (id_study, tag_group, tag_element, tag_value)
+                    VALUES """
+                    + ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+                    + """ ON DUPLICATE KEY UPDATE tag_value = VALUES(tag_value)"""
+                )
+                cursor.execute(tag_query, [item for record in chunk for item in record])
+
+        self._commit()
 
     # --------------------------------------------------------------------------
     def get_tag_value(self, tags, group_hex, element_hex):
+        """
+        Returns the value of a tag from a tag payload or from an index of one
+        built with index_tags. Index the payload first when looking up more
+        than one tag.
+        """
         if tags is None:
             return None
-        values = [
-            this["value"]
-            for this in tags["tags"]
-            if this["group"] == int(str(group_hex), 16)
-            and this["element"] == int(str(element_hex), 16)
-        ]
-        if len(values) == 0:
-            return None
-        elif len(values) == 1:
-            return values[0]
-        else:
-            return values
+        if "tags" in tags:
+            tags = index_tags(tags)
+        return tags.get(tag_key(group_hex, element_hex))
 
     # --------------------------------------------------------------------------
-    def insert_series(self, series):
+    def series_values(self, series, series_tags):
         """
-        Add series to the database.
+        Returns the values of the img_series columns in IMG_SERIES_COLUMNS,
+        without id_study, for the series. Use insert_series_bulk to add many
+        series at once.
 
         Inputs:
         -----------
         series: Object of the AMBRA_Utils.Series class
-            Object of the series class to be added to the database.
+        series_tags: dict
+            Tags of the series as returned by series.get_tags(0).
         """
-        insert_series_query = """
-        INSERT IGNORE INTO img_series
-        (id_study, scanner_model, scanner_manufac,
-        magnetic_field_strength, device_serial_number, series_number, series_description,
-        protocol_name, TR, TE, recon_matrix_rows,
-        recon_matrix_cols, slice_thickness, number_of_slices,
-        number_of_temporal_positions, acquisition_number, number_of_dicoms,
-        series_uid, software_version, pixel_spacing,
-        pixel_bandwidth, acq_matrix, perc_phase_fov,
-        inversion_time, flip_angle, scanner_station_name, mr_acq_type, sequence_name)
-        VALUES ((SELECT id from studies WHERE studies.study_uid=%s), %s, %s,
-        %s, %s, %s,
-        %s, %s, %s, %s,
-        %s, %s, %s, %s,
-        %s, %s, %s,
-        %s, %s, %s,
-        %s, %s, %s,
-        %s, %s, %s,
-        %s, %s)
+        return series_record(series, series_tags)
+
+    # --------------------------------------------------------------------------
+    @with_connection
+    def insert_series(self, series, series_tags=None):
         """
+        Add series to the database.
+
+        Inputs:
+        -----------
+        series: Object of the AMBRA_Utils.Series class
+            Object of the series class to be added to the database.
+        series_tags: dict, None
+            Tags of the series if they have already been retrieved. If None,
+            they are retrieved from Ambra.
+        """
+        insert_series_query = (
+            f"INSERT IGNORE INTO img_series (id_study, {', '.join(IMG_SERIES_COLUMNS)}) "
+            "VALUES ((SELECT id from studies WHERE studies.study_uid=%s), "
+            + ", ".join(["%s"] * len(IMG_SERIES_COLUMNS))
+            + ")"
+        )
 
         # try:
-        series_tags = series.get_tags(0)
+        if series_tags is None:
+            series_tags = self._series_tags(series)
         # except Exception:
         #    series_tags = None
 
-        scanner_model = self.get_tag_value(series_tags, "0008", "1090")
-        scanner_manufac = self.get_tag_value(series_tags, "0008", "0070")
-        magnetic_field_strength = self.get_tag_value(series_tags, "0018", "0087")
-        device_serial_number = self.get_tag_value(series_tags, "0018", "1000")
-        series_number = self.get_tag_value(series_tags, "0020", "0011")
-        series_description = series.formatted_description
-        protocol_name = self.get_tag_value(series_tags, "0018", "1030")
-        tr = self.get_tag_value(series_tags, "0018", "0080")
-        te = self.get_tag_value(series_tags, "0018", "0081")
-        recon_matrix_rows = self.get_tag_value(series_tags, "0028", "0010")
-        recon_matrix_cols = self.get_tag_value(series_tags, "0028", "0011")
-        slice_thickness = self.get_tag_value(series_tags, "0018", "0050")
-        number_of_slices = self.get_tag_value(series_tags, "0054", "0081")
-        number_of_temporal_positions = self.get_tag_value(series_tags, "0020", "0105")
-        acquisition_number = self.get_tag_value(series_tags, "0020", "0012")
-        number_of_dicoms = series.count
-        series_uid = series.series_uid
-        scanner_station_name = self.get_tag_value(series_tags, "0008", "1010")
-        inversion_time = self.get_tag_value(series_tags, "0018", "0082")
-        flip_angle = self.get_tag_value(series_tags, "0018", "1314")
-        perc_phase_fov = self.get_tag_value(series_tags, "0018", "0094")
-        acq_matrix = self.get_tag_value(series_tags, "0018", "1310")
-        pixel_bandwidth = self.get_tag_value(series_tags, "0018", "0095")
-        pixel_spacing = self.get_tag_value(series_tags, "0028", "0030")
-        software_version = self.get_tag_value(series_tags, "0018", "1020")
-        mr_acq_type = self.get_tag_value(series_tags, "0018", "0023")
-        seq_name = self.get_tag_value(series_tags, "0018", "0024")
-
-        series_record = (
-            series.study.study_uid,
-            scanner_model,
-            scanner_manufac,
-            magnetic_field_strength,
-            device_serial_number,
-            series_number,
-            series_description,
-            protocol_name,
-            tr,
-            te,
-            recon_matrix_rows,
-            recon_matrix_cols,
-            slice_thickness,
-            number_of_slices,
-            number_of_temporal_positions,
-            acquisition_number,
-            number_of_dicoms,
-            series_uid,
-            software_version,
-            pixel_spacing,
-            pixel_bandwidth,
-            acq_matrix,
-            perc_phase_fov,
-            inversion_time,
-            flip_angle,
-            scanner_station_name,
-            mr_acq_type,
-            seq_name,
+        series_record = (series.study.study_uid,) + self.series_values(
+            series, series_tags
         )
 
         with self.connection.cursor() as cursor:
             cursor.execute(insert_series_query, series_record)
 
-        self.connection.commit()
+        self._commit()
 
         self.add_to_series_map(series.formatted_description)
 
+    # --------------------------------------------------------------------------
+    @with_connection
+    def insert_series_bulk(
+        self,
+        series_list,
+        id_study=None,
+        series_exceptions=(),
+        get_series_tags=None,
+        stop_on_exception=False,
+    ):
+        """
+        Adds all of the series of a study to the database.
+
+        Unlike calling insert_series for each series, id_study is resolved once,
+        all img_series rows are written with a single multi-row INSERT IGNORE,
+        the series descriptions are added to series_map with another and both
+        are committed together.
+
+        Inputs:
+        -----------
+        series_list: iterable of AMBRA_Utils.Series objects
+            Series that all belong to the same study.
+        id_study: int, None
+            id of the study in the studies table. If None, it is looked up from
+            the study_uid of the first series.
+        series_exceptions: tuple of Exception classes
+            Errors raised while retrieving the tags of a series that should not
+            stop the other series from being added.
+        get_series_tags: function, None
+            Called with a series to retrieve its tags, e.g.
+            prefetch.StudyPrefetcher.series_tags. Defaults to retrieving them
+            from Ambra.
+        stop_on_exception: bool
+            If True, stops at the first series raising one of series_exceptions
+            and returns it without writing any of the series.
+
+        Returns a list of (series, exception) tuples for the series that were
+        skipped because of one of series_exceptions.
+        """
+        fetched_series = []
+        tags_list = []
+        failed = []
+        for series in series_list:
+            try:
+                if get_series_tags is None:
+                    series_tags = self._series_tags(series)
+                else:
+                    series_tags = get_series_tags(series)
+            except series_exceptions as e:
+                failed.append((series, e))
+                if stop_on_exception:
+                    return failed
+                continue
+
+            if id_study is None:
+                id_study = self.get_study_by_uid(series.study.study_uid)
+                if id_study is None:
+                    raise Exception(
+                        f"Study {series.study.study_uid} is not in the database."
+                    )
+
+            fetched_series.append(series)
+            tags_list.append(series_tags)
+
+        if not fetched_series:
+            return failed
+
+        records = [
+            (id_study, *series_record(series, series_tags))
+            for series, series_tags in zip(fetched_series, tags_list)
+        ]
+        description_index = IMG_SERIES_COLUMNS.index("series_description") + 1
+        descriptions = list(
+            dict.fromkeys(record[description_index] for record in records)
+        )
+
+        columns = ", ".join(("id_study",) + IMG_SERIES_COLUMNS)
+        row_placeholder = "(" + ", ".join(["%s"] * (len(IMG_SERIES_COLUMNS) + 1)) + ")"
+        insert_series_query = (
+            f"INSERT IGNORE INTO img_series ({columns}) VALUES "
+            + ", ".join([row_placeholder] * len(records))
+        )
+        series_map_query = (
+            "INSERT IGNORE INTO series_map (series_description) VALUES "
+            + ", ".join(["(LOWER(%s))"] * len(descriptions))
+        )
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                insert_series_query,
+                [value for record in records for value in record],
+            )
+            cursor.execute(series_map_query, descriptions)
+
+        self._commit(2)
+        return failed
+
     # --------------------------------------------------------------------------
     def is_zip_corrupt(self, zip_file_path):
         """
@@ -790,24 +1754,10 @@ class Database:
         zip_file_path: str
             Path to the zip file relative to the backup directory.
         """
-
-        zip_file_path = Path(zip_file_path)
-        if not zip_file_path.exists():
-            raise Exception("The zip file does not exist.")
-        try:
-            with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
-                # Test reading a file from the zip
-                zip_ref.read("README.txt")
-                # If no exception is raised, the zip is likely not corrupt
-                return False
-        except zipfile.BadZipfile:
-            # If a BadZipFile exception is raised, the zip is corrupt
-            return True
-        except KeyError:
-            # Raised when the zip does not contain a README.txt file
-            return True
+        return utils.is_zip_corrupt(zip_file_path)
 
     # --------------------------------------------------------------------------
+    @with_connection
     def set_study_is_downloaded(
         self,
         study_uid,
@@ -862,9 +1812,10 @@ class Database:
                 )
             cursor.execute(download_query, records)
 
-        self.connection.commit()
+        self._commit()
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def study_download_date(self, study_uid):
         """
         Returns the download date if the study with the given study_uid has been marked as downloaded in the database.
@@ -890,23 +1841,17 @@ class Database:
         """
         Returns a list of study_uids from studies that have not been downloaded.
         """
-        with self.connection.cursor(buffered=True) as cursor:
-            download_query = """SELECT studies.uuid, studies.study_uid, studies.phi_namespace, backup_info.namespace_name, studies.id
-                                FROM studies INNER JOIN backup_info ON studies.phi_namespace = backup_info.namespace_id
-                                WHERE (studies.is_downloaded IS NULL OR studies.is_downloaded=FALSE)
-                                AND (studies.deleted != 1 OR studies.deleted is NULL);"""
-            # download_query = """SELECT studies.id
-            #                    FROM studies
-            #                    WHERE studies.is_downloaded IS NULL OR studies.is_downloaded=FALSE;"""
-            cursor.execute(download_query)
-            while True:
-                results = cursor.fetchmany(10)
-                if not results:
-                    break
-                for result in results:
-                    yield result
+        download_query = """SELECT studies.uuid, studies.study_uid, studies.phi_namespace, backup_info.namespace_name, studies.id
+                            FROM studies INNER JOIN backup_info ON studies.phi_namespace = backup_info.namespace_id
+                            WHERE (studies.is_downloaded IS NULL OR studies.is_downloaded=FALSE)
+                            AND (studies.deleted != 1 OR studies.deleted is NULL);"""
+        # download_query = """SELECT studies.id
+        #                    FROM studies
+        #                    WHERE studies.is_downloaded IS NULL OR studies.is_downloaded=FALSE;"""
+        yield from self.iter_select_query(download_query)
 
     # --------------------------------------------------------------------------
+    @with_connection(idempotent=True)
     def get_study_info_by_id_study(self, id_study):
         """
         Returns selected info for the study whose id in the studies table mathces id_study.
@@ -922,6 +1867,7 @@ class Database:
             return result
 
     # --------------------------------------------------------------------------
+    @with_connection
     def add_raw_nifti(self, nifti_path, series_uid):
         """
         Inserts the nifti_path into the column raw_nifti for the img_series table_name
@@ -939,7 +1885,7 @@ class Database:
         with self.connection.cursor() as cursor:
             cursor.executemany(insert_query, [(str(nifti_path), series_uid)])
 
-        self.connection.commit()
+        self._commit()
 
     # --------------------------------------------------------------------------
     def add_niftis(self, nifti_dir):
@@ -973,6 +1919,7 @@ class Database:
                 logging.warning(f"Could not add {nifti_file} to database.")
 
     # --------------------------------------------------------------------------
+    @with_connection
     def add_nifti_paths(self, backup_path, nifti_directory, series):
         """
         Searches for nifti files matching the series description and series number
@@ -988,8 +1935,9 @@ class Database:
 
         """
         nifti_dir = Path(nifti_directory)
-        series_tags = series.get_tags(0)
-        series_number = self.get_tag_value(series_tags, "0020", "0011")
+        series_tags = self._series_tags(series)
+        tag_index = {} if series_tags is None else index_tags(series_tags)
+        series_number = tag_index.get(SERIES_TAGS["series_number"])
         search_pattern = f"{series.formatted_description}_*_{series_number}.nii*"
 
         niftis = list(nifti_dir.glob(search_pattern))
@@ -1181,20 +2129,15 @@ class Database:
         # Need to hash image and insert into processing table
 
     # ------------------------------------------------------------------------------
-    def hash_file(self, file_path):
-        """
-        Returns the md5 hash of the file at file_path.
+    def hash_file(self, file_path, algorithm="md5"):
         """
-        file_path = Path(file_path)
-        if not file_path.is_file():
-            raise Exception("Only files can be hashed.")
+        Returns the hash of the file at file_path, md5 by default.
 
-        hasher = hashlib.md5()
-        with open(file_path, "rb") as fopen:
-            buf = fopen.read()
-            hasher.update(buf)
-
-        return hasher.hexdigest()
+        The file is streamed through utils.hash_file so large niftis are never
+        read into memory at once. If the Database was created with a hash_cache,
+        unchanged files are not read at all.
+        """
+        return utils.hash_file(file_path, algorithm=algorithm, cache=self.hash_cache)
 
     # ------------------------------------------------------------------------------
     def add_nifti(self, nifti_path, json_path=None, id_img_series=None, id_study=None):
@@ -1300,36 +2243,47 @@ class Database:
         return result[0][0]
 
     # ------------------------------------------------------------------------------
-    def add_nifti_dir(self, nifti_dir):
+    def add_nifti_dir(self, nifti_dir, batch_size=1):
         """
         Loops over all *.nii.gz files in the directory and calls add_nifti.
+
+        Inputs:
+        --------
+        nifti_dir: Path
+            Directory of nifti files.
+        batch_size: int, None
+            Number of write statements per commit. If None, the whole directory
+            is added in a single transaction.
         """
         id_study = self.get_study_id(nifti_dir)
-        for nifti_file in nifti_dir.glob("*.nii.gz"):
-            json_file = nifti_dir.joinpath(nifti_file.name.replace(".nii.gz", ".json"))
-            if not json_file.exists():
-                json_file = None
-                id_img_series = None
-            else:
-                try:
-                    id_img_series = self.get_img_series_id(nifti_file, json_file)
-                except Exception:
+        with self.transaction(flush_every=batch_size):
+            for nifti_file in nifti_dir.glob("*.nii.gz"):
+                json_file = nifti_dir.joinpath(
+                    nifti_file.name.replace(".nii.gz", ".json")
+                )
+                if not json_file.exists():
+                    json_file = None
                     id_img_series = None
+                else:
+                    try:
+                        id_img_series = self.get_img_series_id(nifti_file, json_file)
+                    except Exception:
+                        id_img_series = None
 
-            try:
-                self.add_nifti(
-                    nifti_file,
-                    json_file,
-                    id_img_series=id_img_series,
-                    id_study=id_study,
-                )
-            except mysql_errors.IntegrityError as e:
-                # Most likely thrown if row already exists.
-                print(f"Could not add nifti: {nifti_file}", e)
-                continue
-            except Exception:
-                print(f"Could not add nifti: {nifti_file}")
-                continue
+                try:
+                    self.add_nifti(
+                        nifti_file,
+                        json_file,
+                        id_img_series=id_img_series,
+                        id_study=id_study,
+                    )
+                except mysql_errors.IntegrityError as e:
+                    # Most likely thrown if row already exists.
+                    print(f"Could not add nifti: {nifti_file}", e)
+                    continue
+                except Exception:
+                    print(f"Could not add nifti: {nifti_file}")
+                    continue
 
     # ------------------------------------------------------------------------------
     def add_niftis_in_study_dir(self, study_dir):
@@ -1,5 +1,8 @@
 from AMBRA_Backups import backup as backup
 from AMBRA_Backups import utils as utils
+from AMBRA_Backups import journal as journal
+from AMBRA_Backups import prefetch as prefetch
+from AMBRA_Backups import ambra_cache as ambra_cache
 from AMBRA_Backups import crfs as crfs
 from AMBRA_Backups import redcap_funcs as redcap_funcs
 
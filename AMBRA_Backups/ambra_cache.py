@@ -0,0 +1,134 @@
+"""
+Cache of Ambra API results used to avoid requesting the same object twice.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+################################################################################
+class AmbraCache:
+    """
+    Thread-safe cache of the series lists, series tags and study tags returned
+    by AMBRA_Utils, keyed by study uuid and series uid. Study entries also
+    include the study 'updated' field, so a study updated on Ambra is fetched
+    again.
+
+    Entries expire ttl seconds after they were fetched and the least recently
+    used entries are evicted once more than max_size are stored. Concurrent
+    requests for the same missing entry only fetch it once.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, ttl=3600, max_size=1000, clock=monotonic):
+        """
+        Inputs:
+        --------
+        ttl: int, float, None
+            Number of seconds an entry is kept. If None, entries do not expire.
+        max_size: int
+            Maximum number of entries kept.
+        clock: function
+            Returns the current time in seconds, used for expiry.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def _lookup(self, key):
+        """
+        Returns (True, value) if key is cached and has not expired, otherwise
+        (False, None). Must be called with self._lock held.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        value, expires = entry
+        if expires is not None and self.clock() > expires:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    # --------------------------------------------------------------------------
+    def get(self, key, fetch):
+        """
+        Returns the cached value for key, calling fetch() to retrieve it if it
+        is missing or expired. Errors raised by fetch are not cached.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                found, value = self._lookup(key)
+                if found:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+
+            try:
+                value = fetch()
+                with self._lock:
+                    expires = None if self.ttl is None else self.clock() + self.ttl
+                    self._entries[key] = (value, expires)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+        return value
+
+    # --------------------------------------------------------------------------
+    def series(self, study):
+        """
+        Returns the list of series of the study, as study.get_series().
+        """
+        return self.get(
+            ("series", study.uuid, study.updated), lambda: list(study.get_series())
+        )
+
+    # --------------------------------------------------------------------------
+    def series_tags(self, series):
+        """
+        Returns the tags of the series, as series.get_tags(0).
+        """
+        return self.get(("series_tags", series.series_uid), lambda: series.get_tags(0))
+
+    # --------------------------------------------------------------------------
+    def study_tags(self, study):
+        """
+        Returns the tags of the study, as study.get_study_tags().
+        """
+        return self.get(("study_tags", study.uuid, study.updated), study.get_study_tags)
+
+    # --------------------------------------------------------------------------
+    def invalidate(self, study):
+        """
+        Removes the entries of the study and of its cached series.
+        """
+        with self._lock:
+            found, series = self._lookup(("series", study.uuid, study.updated))
+            self._entries.pop(("series", study.uuid, study.updated), None)
+            self._entries.pop(("study_tags", study.uuid, study.updated), None)
+            for this_series in series if found else []:
+                self._entries.pop(("series_tags", this_series.series_uid), None)
+
+    # --------------------------------------------------------------------------
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -1,13 +1,19 @@
 import os
 from pathlib import Path
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import chain
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import mysql.connector.errors as mysql_errors
 from ambra_sdk.exceptions.storage import NotFound, ImageNotFound, Unknown, StudyNotFound
 
 from AMBRA_Backups import utils
+from AMBRA_Backups.journal import BackupJournal
+from AMBRA_Backups.prefetch import StudyPrefetcher
+from AMBRA_Backups.ambra_cache import AmbraCache
 from AMBRA_Utils import Api, utilities
 
 
@@ -24,11 +30,23 @@ def get_zip_stem(study):
 
 # ------------------------------------------------------------------------------
 def backup_study(
-    study, backup_path, convert=False, use_uid=False, force=False, annotations=True
+    study,
+    backup_path,
+    convert=False,
+    use_uid=False,
+    force=False,
+    annotations=True,
+    journal=None,
+    converter=None,
+    scratch_dir=None,
+    scratch_budget=None,
 ):
     """
     Backup the given study to the backup_path.
 
+    The zip file is downloaded to a temporary file next to it and renamed once
+    the download has finished, so an existing zip file is always complete.
+
     Inputs:
     -------
     study:
@@ -47,7 +65,33 @@ def backup_study(
 
     annotations: bool
         If True, will save annotations to annotations.json file in the study backup directorys.
+
+    journal: BackupJournal, None
+        If not None, the state of the study is recorded in the journal and
+        studies the journal reports as complete are skipped.
+
+    converter: utils.ConversionPool, None
+        If not None and convert is True, the nifti conversion is queued on the
+        pool instead of being run before this function returns.
+
+    scratch_dir: str, Path, None
+        If not None, studies are extracted into a temporary directory in
+        scratch_dir (e.g. /dev/shm) for conversion instead of next to the zip
+        file. See utils.extract_and_convert.
+
+    scratch_budget: int, None
+        Maximum uncompressed size in bytes of a study extracted into scratch_dir.
     """
+    if journal is not None and not force and journal.is_complete(study, convert):
+        logging.info(
+            f"\tSkipping backup of {study.patient_name} {study.formatted_description}, already complete in the backup journal."
+        )
+        record = journal.get_record(study)
+        return tuple(
+            Path(record[key]) if key in record else None
+            for key in ("zip_file", "nifti_dir", "annotation_file")
+        )
+
     if use_uid:
         uid_string = study.study_uid.replace(".", "_")
         study_dir = backup_path.joinpath(
@@ -66,15 +110,37 @@ def backup_study(
         f"\tPatient Name: {study.patient_name}\n\tPatient ID: {study.patientid}\n\tStudy date: {study.study_date}\n\tCreated: {study.created}\n\tUpdated: {study.updated}"
     )
 
-    if (not zip_file.exists()) or force:
+    download = (not zip_file.exists()) or force
+    verified = False
+    if not download and journal is not None:
+        # Zip files written before downloads were made atomic may be partial.
+        verified = not utils.is_zip_corrupt(zip_file)
+        if not verified:
+            logging.warning(f"\t{zip_file} is corrupt and will be downloaded again.")
+            download = True
+
+    if download:
         logging.info(f"\tBacking up {study.patient_name} to {zip_file}.")
+        if journal is not None:
+            journal.set_state(study, "downloading", zip_file=zip_file)
+        part_file = zip_file.with_suffix(".part.zip")
         try:
-            study.download(zip_file, ignore_exists=True)
+            study.download(part_file, ignore_exists=True)
         except NotFound:
+            part_file.unlink(missing_ok=True)
             logging.error(
                 f"\tData not found on Ambra for {study.patient_name} {study.formatted_description}."
             )
             return None, None, None
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        os.replace(part_file, zip_file)
+        if journal is not None:
+            journal.set_state(study, "downloaded", zip_file=zip_file)
+            verified = not utils.is_zip_corrupt(zip_file)
+            if not verified:
+                logging.error(f"\tThe downloaded zip file {zip_file} is corrupt.")
     else:
         logging.info(
             f"\tSkipping backup of {study.patient_name} {study.formatted_description}, zip file already exists."
@@ -85,22 +151,434 @@ def backup_study(
         annotation_file = study_dir.joinpath("annotations.json")
         study.export_annotations(annotation_file)
 
+    if verified:
+        journal.set_state(
+            study, "verified", zip_file=zip_file, annotation_file=annotation_file
+        )
+
     nifti_dir = None
     if convert:
         nifti_dir = study_dir.joinpath(f"{zip_stem}_nii")
-        if (not nifti_dir.exists()) or force:
+        converted = nifti_dir.exists() and not force
+        if not converted and converter is not None:
+
+            def on_converted(result):
+                if verified and result["success"]:
+                    journal.set_state(study, "converted", nifti_dir=nifti_dir)
+
+            converter.submit(zip_file, nifti_dir, key=study.uuid, callback=on_converted)
+        elif not converted:
             try:
-                utils.extract_and_convert(zip_file, nifti_dir, cleanup=True)
+                utils.extract_and_convert(
+                    zip_file,
+                    nifti_dir,
+                    cleanup=True,
+                    scratch_dir=scratch_dir,
+                    scratch_budget=scratch_budget,
+                )
+                converted = True
             except Exception as e:
                 logging.error(e)
+        if verified and converted:
+            journal.set_state(study, "converted", nifti_dir=nifti_dir)
 
     # TODO: Change to return a dictionary with these paths
     return zip_file, nifti_dir, annotation_file
 
 
+# ------------------------------------------------------------------------------
+def backup_study_isolated(study, backup_path, **kwargs):
+    """
+    Calls backup_study and logs any exception raised so that an error in one
+    study does not stop the remaining studies from being backed up.
+
+    Returns the output of backup_study or None if an exception was raised.
+    """
+    try:
+        return backup_study(study, backup_path, **kwargs)
+    except Exception as e:
+        print(e)
+        logging.error(
+            f"\tError backing up {study.patient_name} {study.formatted_description}: {e}"
+        )
+        return None
+
+
+# ------------------------------------------------------------------------------
+def list_studies(namespace, min_date=None):
+    """
+    Returns an iterator over the studies of the namespace. If min_date is a
+    datetime object, only studies updated after min_date are returned.
+    """
+    if isinstance(min_date, datetime):
+        return namespace.get_studies_after(min_date, updated=True)
+    return namespace.get_studies()
+
+
+################################################################################
+class BackupScheduler:
+    """
+    Backs up the studies of several namespaces concurrently.
+
+    Each namespace is listed in its own thread into a bounded queue. Studies are
+    then dispatched round-robin across the namespaces to a shared pool of
+    download workers, so a namespace with many studies cannot starve the
+    others. The number of downloads in flight is capped globally by n_workers
+    and per namespace by namespace_workers.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(
+        self,
+        backup_path,
+        n_workers=4,
+        namespace_workers=None,
+        queue_size=None,
+        convert=False,
+        use_uid=False,
+        progress_interval=50,
+        journal=None,
+        convert_workers=None,
+        scratch_dir=None,
+        scratch_budget=None,
+    ):
+        """
+        Inputs:
+        -------
+        backup_path: String, Path; Path to where the data will be stored. Must exist.
+
+        n_workers: int
+            Maximum number of studies downloaded at the same time across all namespaces.
+
+        namespace_workers: int, None
+            Maximum number of studies downloaded at the same time for a single
+            namespace. Defaults to n_workers.
+
+        queue_size: int, None
+            Maximum number of listed studies waiting to be downloaded for each
+            namespace. Defaults to twice namespace_workers.
+
+        convert: If True, will convert the dicoms to nifti and put them in a directory
+            called *_nii
+
+        use_uid: bool
+            If True, will include the study uid in the data directory name.
+
+        progress_interval: int
+            A progress summary is logged for a namespace every time this many of
+            its studies have finished.
+
+        journal: BackupJournal, None
+            If not None, studies and namespaces the journal reports as complete
+            are skipped and the state of every study is recorded in it.
+
+        convert_workers: int, None
+            If set and convert is True, nifti conversions are run in a separate
+            pool of this many processes while downloads continue.
+
+        scratch_dir, scratch_budget:
+            Scratch location and size budget used for nifti conversion. See
+            utils.extract_and_convert.
+        """
+        self.backup_path = Path(backup_path)
+        self.n_workers = n_workers
+        self.namespace_workers = namespace_workers or n_workers
+        self.queue_size = queue_size or 2 * self.namespace_workers
+        self.convert = convert
+        self.use_uid = use_uid
+        self.progress_interval = progress_interval
+        self.journal = journal
+        self.convert_workers = convert_workers
+        self.scratch_dir = scratch_dir
+        self.scratch_budget = scratch_budget
+        self._converter = None
+
+        self._namespaces = []
+        self._condition = threading.Condition()
+        self._in_flight = 0
+
+    # --------------------------------------------------------------------------
+    def add_namespace(self, namespace, min_date=None):
+        """
+        Adds a namespace to be backed up when run() is called. If min_date is
+        set then only studies updated after that date will be downloaded.
+        """
+        assert isinstance(namespace, Api.Namespace)
+        self._namespaces.append(
+            {
+                "namespace": namespace,
+                "min_date": min_date,
+                "queue": queue.Queue(maxsize=self.queue_size),
+                "listing_done": False,
+                "listing_error": False,
+                "complete": False,
+                "in_flight": 0,
+                "converting": 0,
+                "summary": {
+                    "listed": 0,
+                    "skipped": 0,
+                    "downloaded": 0,
+                    "not_found": 0,
+                    "failed": 0,
+                    "converted": 0,
+                    "conversion_failed": 0,
+                },
+            }
+        )
+
+    # --------------------------------------------------------------------------
+    def progress(self):
+        """
+        Returns a dictionary with a copy of the summary of each namespace, keyed
+        by the string representation of the namespace.
+        """
+        with self._condition:
+            return {
+                str(state["namespace"]): dict(state["summary"])
+                for state in self._namespaces
+            }
+
+    # --------------------------------------------------------------------------
+    def _list_namespace(self, state):
+        namespace = state["namespace"]
+        journal = self.journal
+        if journal is not None and journal.is_namespace_complete(namespace):
+            logging.info(f"Skipping {namespace}, already complete in this run.")
+            with self._condition:
+                state["listing_done"] = True
+                state["complete"] = True
+                self._condition.notify_all()
+            return
+
+        try:
+            for study in list_studies(namespace, min_date=state["min_date"]):
+                if journal is not None:
+                    if journal.is_complete(study, self.convert):
+                        with self._condition:
+                            state["summary"]["skipped"] += 1
+                        continue
+                    journal.set_state(study, "queued")
+                state["queue"].put(study)
+                with self._condition:
+                    state["summary"]["listed"] += 1
+                    self._condition.notify_all()
+        except Exception as e:
+            print(e)
+            logging.error(f"Error listing studies for {namespace}: {e}")
+            with self._condition:
+                state["listing_error"] = True
+        finally:
+            with self._condition:
+                state["listing_done"] = True
+                self._mark_complete(state)
+                self._condition.notify_all()
+
+    # --------------------------------------------------------------------------
+    def _mark_complete(self, state):
+        # Must be called while holding self._condition. Namespaces with failed
+        # studies or conversions are not marked complete so that a resumed run
+        # retries them, and namespaces are only complete once the last of their
+        # conversions has finished.
+        summary = state["summary"]
+        if state["complete"] or state["listing_error"]:
+            return
+        if summary["failed"] or summary["conversion_failed"]:
+            return
+        if (
+            state["listing_done"]
+            and state["queue"].empty()
+            and state["in_flight"] == 0
+            and state["converting"] == 0
+        ):
+            state["complete"] = True
+            if self.journal is not None:
+                self.journal.set_namespace_complete(state["namespace"])
+
+    # --------------------------------------------------------------------------
+    def _conversion_submitted(self, state):
+        with self._condition:
+            state["converting"] += 1
+
+    # --------------------------------------------------------------------------
+    def _conversion_finished(self, state, success):
+        with self._condition:
+            state["converting"] -= 1
+            if success:
+                state["summary"]["converted"] += 1
+            else:
+                state["summary"]["conversion_failed"] += 1
+            self._mark_complete(state)
+            self._condition.notify_all()
+
+    # --------------------------------------------------------------------------
+    def _backup(self, state, study):
+        outcome = "failed"
+        converter = None
+        if self._converter is not None:
+            converter = _NamespaceConverter(self, state)
+        try:
+            zip_file, _, _ = backup_study(
+                study,
+                self.backup_path,
+                convert=self.convert,
+                use_uid=self.use_uid,
+                journal=self.journal,
+                converter=converter,
+                scratch_dir=self.scratch_dir,
+                scratch_budget=self.scratch_budget,
+            )
+            outcome = "downloaded" if zip_file is not None else "not_found"
+        except Exception as e:
+            print(e)
+            logging.error(
+                f"\tError backing up {study.patient_name} {study.formatted_description}: {e}"
+            )
+        finally:
+            with self._condition:
+                summary = state["summary"]
+                summary[outcome] += 1
+                state["in_flight"] -= 1
+                self._in_flight -= 1
+                finished = (
+                    summary["downloaded"] + summary["not_found"] + summary["failed"]
+                )
+                if self.progress_interval and finished % self.progress_interval == 0:
+                    self._log_summary(state)
+                self._mark_complete(state)
+                self._condition.notify_all()
+
+    # --------------------------------------------------------------------------
+    def _log_summary(self, state):
+        summary = state["summary"]
+        logging.info(
+            f"Progress for {state['namespace']}: {summary['listed']} listed, "
+            f"{summary['skipped']} skipped, "
+            f"{summary['downloaded']} downloaded, {summary['not_found']} not found, "
+            f"{summary['failed']} failed, {summary['converted']} converted, "
+            f"{summary['conversion_failed']} failed conversion."
+        )
+
+    # --------------------------------------------------------------------------
+    def _is_finished(self):
+        return all(
+            state["listing_done"] and state["queue"].empty() and state["in_flight"] == 0
+            for state in self._namespaces
+        )
+
+    # --------------------------------------------------------------------------
+    def run(self):
+        """
+        Backs up all added namespaces and returns the per namespace summary
+        returned by progress().
+        """
+        listers = [
+            threading.Thread(
+                target=self._list_namespace,
+                args=(state,),
+                name=f"list-{state['namespace']}",
+                daemon=True,
+            )
+            for state in self._namespaces
+        ]
+        for lister in listers:
+            lister.start()
+
+        if self.convert and self.convert_workers:
+            self._converter = utils.ConversionPool(
+                n_workers=self.convert_workers,
+                scratch_dir=self.scratch_dir,
+                scratch_budget=self.scratch_budget,
+            )
+
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            with self._condition:
+                while not self._is_finished():
+                    dispatched = False
+                    # Take at most one study from each namespace per pass,
+                    # starting where the previous pass stopped.
+                    for offset in range(len(self._namespaces)):
+                        if self._in_flight >= self.n_workers:
+                            break
+                        index = (next_index + offset) % len(self._namespaces)
+                        state = self._namespaces[index]
+                        if state["in_flight"] >= self.namespace_workers:
+                            continue
+                        try:
+                            study = state["queue"].get_nowait()
+                        except queue.Empty:
+                            continue
+                        state["in_flight"] += 1
+                        self._in_flight += 1
+                        executor.submit(self._backup, state, study)
+                        next_index = index + 1
+                        dispatched = True
+                    if not dispatched:
+                        self._condition.wait(timeout=1)
+
+        for lister in listers:
+            lister.join()
+
+        if self._converter is not None:
+            # Conversion callbacks update the summaries and complete namespaces.
+            self._converter.close()
+            self._converter = None
+
+        for state in self._namespaces:
+            self._log_summary(state)
+
+        return self.progress()
+
+
+################################################################################
+class _NamespaceConverter:
+    """
+    Submits the conversions of one BackupScheduler namespace to the shared
+    ConversionPool and reports them to the scheduler, so that the namespace is
+    only journaled complete once all of its conversions have succeeded.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, scheduler, state):
+        self.scheduler = scheduler
+        self.state = state
+
+    # --------------------------------------------------------------------------
+    def submit(self, zip_file, output_directory, key=None, callback=None):
+        """
+        Same as ConversionPool.submit.
+        """
+        self.scheduler._conversion_submitted(self.state)
+
+        def done(result):
+            try:
+                if callback is not None:
+                    callback(result)
+            finally:
+                self.scheduler._conversion_finished(self.state, result["success"])
+
+        try:
+            return self.scheduler._converter.submit(
+                zip_file, output_directory, key=key, callback=done
+            )
+        except Exception:
+            self.scheduler._conversion_finished(self.state, False)
+            raise
+
+
 # ------------------------------------------------------------------------------
 def backup_namespace(
-    namespace, backup_path, min_date=None, convert=False, use_uid=False
+    namespace,
+    backup_path,
+    min_date=None,
+    convert=False,
+    use_uid=False,
+    n_workers=1,
+    queue_size=None,
+    journal=None,
+    convert_workers=None,
+    scratch_dir=None,
+    scratch_budget=None,
 ):
     """
     Backup all subject data belonging to the input namespace. If min_date is set
@@ -120,6 +598,30 @@ def backup_namespace(
 
     database: Database object
         Object of the AMBRA_Backups.database.Database class.
+
+    n_workers: int
+        Number of studies to download concurrently. If 1, studies are downloaded
+        one at a time in the calling thread.
+
+    queue_size: int, None
+        Maximum number of listed studies waiting to be downloaded when
+        n_workers > 1. Defaults to twice the number of workers.
+
+    journal: BackupJournal, None
+        If not None, studies already complete in the journal are skipped and
+        the state of every study is recorded in it.
+
+    convert_workers: int, None
+        If set and convert is True, nifti conversions are run in a separate pool
+        of this many processes while the next studies are downloaded.
+
+    scratch_dir: str, Path, None
+        If not None, studies are extracted into a temporary directory in
+        scratch_dir (e.g. /dev/shm) for conversion instead of next to the zip
+        file. See utils.extract_and_convert.
+
+    scratch_budget: int, None
+        Maximum uncompressed size in bytes of a study extracted into scratch_dir.
     """
     assert isinstance(namespace, Api.Namespace)
     backup_log = backup_path.joinpath("backups.log")
@@ -130,17 +632,43 @@ def backup_namespace(
     )
 
     logging.info(f"Backing up studies for {namespace}.")
-    if isinstance(min_date, datetime):
-        studies_to_backup = namespace.get_studies_after(min_date, updated=True)
-    else:
-        studies_to_backup = namespace.get_studies()
+    if n_workers <= 1 and not (convert and convert_workers):
+        if journal is not None and journal.is_namespace_complete(namespace):
+            logging.info(f"Skipping {namespace}, already complete in this run.")
+            return
+        failed = False
+        for study in list_studies(namespace, min_date=min_date):
+            if journal is not None:
+                if journal.is_complete(study, convert):
+                    continue
+                journal.set_state(study, "queued")
+            result = backup_study_isolated(
+                study,
+                backup_path,
+                convert=convert,
+                use_uid=use_uid,
+                journal=journal,
+                scratch_dir=scratch_dir,
+                scratch_budget=scratch_budget,
+            )
+            failed = failed or result is None
+        if journal is not None and not failed:
+            journal.set_namespace_complete(namespace)
+        return
 
-    for study in studies_to_backup:
-        try:
-            backup_study(study, backup_path, convert=convert, use_uid=use_uid)
-        except Exception as e:
-            print(e)
-            logging.error(e)
+    scheduler = BackupScheduler(
+        backup_path,
+        n_workers=n_workers,
+        queue_size=queue_size,
+        convert=convert,
+        use_uid=use_uid,
+        journal=journal,
+        convert_workers=convert_workers,
+        scratch_dir=scratch_dir,
+        scratch_budget=scratch_budget,
+    )
+    scheduler.add_namespace(namespace, min_date=min_date)
+    scheduler.run()
 
 
 # ------------------------------------------------------------------------------
@@ -152,6 +680,12 @@ def backup_account(
     locations=False,
     convert=False,
     use_uid=False,
+    n_workers=1,
+    namespace_workers=None,
+    journal=False,
+    convert_workers=None,
+    scratch_dir=None,
+    scratch_budget=None,
 ):
     """
     Inputs:
@@ -172,6 +706,36 @@ def backup_account(
 
     database: Database object
         Object of the AMBRA_Backups.database.Database class.
+
+    n_workers: int
+        Maximum number of studies downloaded at the same time across all
+        namespaces. If 1, namespaces are backed up one after another.
+
+    namespace_workers: int, None
+        Maximum number of studies downloaded at the same time for a single
+        namespace when n_workers > 1. Defaults to n_workers.
+
+    convert_workers: int, None
+        If set and convert is True, nifti conversions are run in a separate pool
+        of this many processes while downloads continue.
+
+    scratch_dir: str, Path, None
+        If not None, studies are extracted into a temporary directory in
+        scratch_dir (e.g. /dev/shm) for conversion instead of next to the zip
+        file. See utils.extract_and_convert.
+
+    scratch_budget: int, None
+        Maximum uncompressed size in bytes of a study extracted into scratch_dir.
+
+    journal: bool
+        If True, the state of every study is recorded in backups_journal.jsonl
+        next to backups.log. If a previous run did not finish, it is resumed:
+        namespaces and studies it completed are skipped. Note that studies the
+        journal reports as complete are skipped entirely, including the
+        annotation export done for studies that are already downloaded.
+
+    Returns a dictionary with a summary for each namespace when n_workers > 1
+    or convert_workers is used.
     """
     backup_path = Path(backup_path)
     assert backup_path.exists()
@@ -187,12 +751,49 @@ def backup_account(
     ambra = utilities.get_api()
     account = ambra.get_account_by_name(account_name)
 
+    backup_journal = None
+    if journal:
+        backup_journal = BackupJournal(backup_path.joinpath("backups_journal.jsonl"))
+        backup_journal.start_run()
+
+    if n_workers > 1 or (convert and convert_workers):
+        scheduler = BackupScheduler(
+            backup_path,
+            n_workers=n_workers,
+            namespace_workers=namespace_workers,
+            convert=convert,
+            use_uid=use_uid,
+            journal=backup_journal,
+            convert_workers=convert_workers,
+            scratch_dir=scratch_dir,
+            scratch_budget=scratch_budget,
+        )
+        if groups:
+            for group in account.get_groups():
+                scheduler.add_namespace(group, min_date=min_date)
+        if locations:
+            for location in account.get_locations():
+                scheduler.add_namespace(location, min_date=min_date)
+        summaries = scheduler.run()
+        for namespace_name, summary in summaries.items():
+            print(f"{namespace_name}: {summary}")
+        if backup_journal is not None:
+            backup_journal.finish_run()
+        return summaries
+
     if groups:
         logging.info(f"Backing up all groups for account {account_name}.")
         for group in account.get_groups():
             print(20 * "=" + f"\n{group}\n" + 20 * "=")
             backup_namespace(
-                group, backup_path, min_date=min_date, convert=convert, use_uid=use_uid
+                group,
+                backup_path,
+                min_date=min_date,
+                convert=convert,
+                use_uid=use_uid,
+                journal=backup_journal,
+                scratch_dir=scratch_dir,
+                scratch_budget=scratch_budget,
             )
     if locations:
         logging.info(f"Backing up all locations for account {account_name}.")
@@ -204,7 +805,46 @@ def backup_account(
                 min_date=min_date,
                 convert=convert,
                 use_uid=use_uid,
+                journal=backup_journal,
+                scratch_dir=scratch_dir,
+                scratch_budget=scratch_budget,
             )
+    if backup_journal is not None:
+        backup_journal.finish_run()
+
+
+# ------------------------------------------------------------------------------
+def unique_studies(studies):
+    """
+    Yields the studies, skipping any study whose uuid has already been seen.
+    """
+    seen = set()
+    for study in studies:
+        if study.uuid in seen:
+            continue
+        seen.add(study.uuid)
+        yield study
+
+
+# ------------------------------------------------------------------------------
+def skip_study(study, ignore_uploading=True, ignore_must_approve=False):
+    """
+    Returns True if the study should not be added to the database because it is
+    still uploading or waiting for approval.
+    """
+    if ignore_uploading:
+        if study.patient_name == "Study uploading":
+            print(
+                f"\t{study.study_uid} Study Uploading: Skipping addition of this study to the database."
+            )
+            return True
+    if ignore_must_approve:
+        if study.must_approve == 1:
+            print(
+                f"\t{study.study_uid} Needs approval: Skipping addition of this study to the database."
+            )
+            return True
+    return False
 
 
 # ------------------------------------------------------------------------------
@@ -217,6 +857,12 @@ def update_database(
     ignore_uploading=True,
     ignore_study_exception=False,
     ignore_must_approve=False,
+    batch_size=1,
+    n_prefetch_workers=4,
+    max_requests_per_second=None,
+    ambra_cache=None,
+    overlap=timedelta(hours=1),
+    skip_unchanged=True,
 ):
     """
     Inputs:
@@ -237,7 +883,8 @@ def update_database(
         database.insert_study() method.
 
     ignore_series_exception: bool
-        If True, a ImageNotFound error will be ignored. Otherwise an exception will be raised.
+        If True, a ImageNotFound error will be ignored. Otherwise an exception will be raised
+        before any series of the study is added.
 
     ignore_study_exception: bool
         If True, errors related to study retrieval from Ambra will be ignored. Otherwise an exception will be raised.
@@ -247,6 +894,33 @@ def update_database(
 
     ignore_must_approve: bool
         If True, studies with must_approve=1 (i.e. in the activities queue) will not be backed up.
+
+    batch_size: int, None
+        Number of write statements per commit. If None, the namespace is
+        updated in a single transaction that is only committed, together with
+        the new backup date, once all of the studies have been inserted.
+
+    n_prefetch_workers: int
+        Number of threads fetching the series and series tags of the next
+        studies from Ambra while the current study is inserted. If 0, they are
+        fetched when needed.
+
+    max_requests_per_second: float, None
+        If not None, limits the rate of the prefetch requests made to Ambra.
+
+    ambra_cache: ambra_cache.AmbraCache, None
+        Cache of Ambra objects shared by the prefetching and the database
+        methods for this update. Defaults to database.ambra_cache, or to a new
+        cache that only lives for this update if that is None.
+
+    overlap: timedelta
+        Studies updated up to overlap before the last backup are requested
+        again, so that studies are not missed because of clock skew between
+        Ambra and this machine.
+
+    skip_unchanged: bool
+        If True, studies whose updated time matches the one in the database
+        and whose series are all in the database are skipped.
     """
     last_backup = database.get_last_backup(namespace.name, namespace.namespace_type)
     current_backup = datetime.now()
@@ -255,81 +929,96 @@ def update_database(
     else:
         # This is a fix for an Ambra bug that is setting the study 'updated' field to null
         # on newly inserted studies, should only need the method with 'updated=True'  - TCM 02/28/2022
+        # The two queries overlap, so the studies are deduplicated below.
+        since = last_backup - overlap
         studies = chain(
-            namespace.get_studies_after(last_backup, updated=True),
-            namespace.get_studies_after(last_backup, updated=False),
+            namespace.get_studies_after(since, updated=True),
+            namespace.get_studies_after(since, updated=False),
         )
-    for study in studies:
-        print(study)
-        print(study.study_uid)
-        if ignore_uploading:
-            if study.patient_name == "Study uploading":
-                print(
-                    "\tStudy Uploading: Skipping addition of this study to the database."
-                )
+
+    n_unchanged = 0
+
+    def studies_to_update(studies):
+        nonlocal n_unchanged
+        for study in unique_studies(studies):
+            if skip_study(study, ignore_uploading, ignore_must_approve):
                 continue
-        if ignore_must_approve:
-            if study.must_approve == 1:
-                print(
-                    "\tNeeds approval: Skipping addition of this study to the database."
-                )
+            if skip_unchanged and database.study_is_current(study):
+                n_unchanged += 1
                 continue
-        try:
-            database.insert_study(
-                study, custom_fields=custom_fields, custom_functions=custom_functions
-            )
-            series = study.get_series()
-            for this_series in series:
+            yield study
+
+    studies = studies_to_update(studies)
+    if ambra_cache is None:
+        ambra_cache = database.ambra_cache or AmbraCache()
+    database_cache = database.ambra_cache
+    database.ambra_cache = ambra_cache
+    try:
+        prefetcher = StudyPrefetcher(
+            n_workers=n_prefetch_workers,
+            rate=max_requests_per_second,
+            cache=ambra_cache,
+        )
+        with prefetcher, database.transaction(flush_every=batch_size):
+            for study in prefetcher.iter_prefetched(studies):
+                print(study)
+                print(study.study_uid)
                 try:
-                    database.insert_series(this_series)
-                except ImageNotFound:
-                    if ignore_series_exception:
-                        print(f"Could not find the series {this_series.series_uid}.")
-                    else:
-                        raise Exception(
-                            f"Could not find the series {this_series.series_uid}."
+                    series = prefetcher.series(study)
+                    id_study = database.insert_study(
+                        study,
+                        custom_fields=custom_fields,
+                        custom_functions=custom_functions,
+                        series=series,
+                    )
+                    failed_series = database.insert_series_bulk(
+                        series,
+                        id_study=id_study,
+                        series_exceptions=(ImageNotFound, StudyNotFound, Unknown),
+                        get_series_tags=prefetcher.series_tags,
+                        stop_on_exception=not ignore_series_exception,
+                    )
+                    for this_series, _ in failed_series:
+                        if ignore_series_exception:
+                            print(
+                                f"Could not find the series {this_series.series_uid}."
+                            )
+                        else:
+                            raise Exception(
+                                f"Could not find the series {this_series.series_uid}."
+                            )
+                except mysql_errors.ProgrammingError as e:
+                    raise Exception(e)
+                except NotFound:
+                    if ignore_study_exception:
+                        print(
+                            f"Error: Could not find the study {study.patient_name}: {study.uuid}."
                         )
-                except StudyNotFound:
-                    if ignore_series_exception:
-                        print(f"Could not find the series {this_series.series_uid}.")
                     else:
-                        raise Exception(
-                            f"Could not find the series {this_series.series_uid}."
+                        raise (
+                            f"Error: Could not find the study {study.patient_name}: {study.uuid}."
+                        )
+                except Exception as e:
+                    if ignore_study_exception:
+                        print(
+                            f"Error inserting study into database: \n\tUID: {study.study_uid}\n\tError: {e}"
                         )
-                except Unknown:
-                    if ignore_series_exception:
-                        print(f"Could not find the series {this_series.series_uid}.")
                     else:
-                        raise Exception(
-                            f"Could not find the series {this_series.series_uid}."
+                        raise (
+                            Exception(
+                                f"Error inserting study into database: \n\tUID: {study.study_uid}\n\tError: {e}"
+                            )
                         )
-        except mysql_errors.ProgrammingError as e:
-            raise Exception(e)
-        except NotFound:
-            if ignore_study_exception:
-                print(
-                    f"Error: Could not find the study {study.patient_name}: {study.uuid}."
-                )
-            else:
-                raise (
-                    f"Error: Could not find the study {study.patient_name}: {study.uuid}."
-                )
-        except Exception as e:
-            if ignore_study_exception:
-                print(
-                    f"Error inserting study into database: \n\tUID: {study.study_uid}\n\tError: {e}"
-                )
-            else:
-                raise (
-                    Exception(
-                        f"Error inserting study into database: \n\tUID: {study.study_uid}\n\tError: {e}"
-                    )
-                )
 
-    database.insert_update_datetime(
-        namespace.name,
-        namespace.namespace_type,
-        namespace.namespace_id,
-        namespace.uuid,
-        current_backup,
-    )
+            database.insert_update_datetime(
+                namespace.name,
+                namespace.namespace_type,
+                namespace.namespace_id,
+                namespace.uuid,
+                current_backup,
+            )
+    finally:
+        database.ambra_cache = database_cache
+
+    if n_unchanged:
+        print(f"Skipped {n_unchanged} studies that have not changed.")
@@ -5,8 +5,12 @@ Extracts information from CRFs and adds to database.
 from datetime import datetime
 
 from string import Template
+import logging
 import re
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from bs4 import BeautifulSoup, Tag, UnicodeDammit
 
 import AMBRA_Backups
 import AMBRA_Utils
@@ -155,6 +159,13 @@ class UnaccountedSpan(Exception):
 
 ################################################################################
 
+# Parser for which the html is parsed with lxml directly and the values are
+# extracted with XPath instead of BeautifulSoup, several times faster.
+FAST_PARSER = "lxml"
+
+# Parser used unless another one is requested.
+DEFAULT_PARSER = "html.parser"
+
 
 def get_database(database_name):
     """
@@ -187,15 +198,182 @@ def get_location(ambra_account_name, location_name):
 
 
 # ------------------------------------------------------------------------------
-def attachment_audit(attachment):
+def get_html(attachment):
     """
-    Extracts audit information from the html attachment.
+    Returns the html content of the attachment, raising GetContentError on error.
+    """
+    try:
+        return attachment.get_content()
+    except Exception as exc:
+        raise GetContentError(attachment) from exc
+
+
+# ------------------------------------------------------------------------------
+def parse_html(html, parser=None):
+    """
+    Parses the html.
+
+    Returns a BeautifulSoup object or, if parser is FAST_PARSER, an lxml
+    element. The functions of this module taking a 'soup' accept either. If lxml
+    is not installed or fails to parse the html, BeautifulSoup with html.parser
+    is used instead.
+
+    Inputs:
+    --------
+    html: str, bytes
+    parser: str, None
+        FAST_PARSER or a parser name passed on to BeautifulSoup. Defaults to
+        DEFAULT_PARSER.
     """
+    parser = parser or DEFAULT_PARSER
+    if parser != FAST_PARSER:
+        return BeautifulSoup(html, parser)
+
     try:
-        html = attachment.get_content()
-    except Exception:
-        print("Error getting content for ", attachment)
-    soup = BeautifulSoup(html, "html.parser")
+        import lxml.etree
+        import lxml.html
+    except ImportError:
+        logging.warning("lxml is not installed, parsing CRFs with html.parser.")
+        return BeautifulSoup(html, "html.parser")
+
+    if isinstance(html, bytes):
+        # Without a meta charset, lxml would decode bytes as Latin-1. Decode
+        # them as BeautifulSoup does, so both parsers read the same text.
+        html = UnicodeDammit(html, is_html=True).unicode_markup
+
+    try:
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # lxml refuses str input with an xml encoding declaration.
+            return lxml.html.document_fromstring(
+                html.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8")
+            )
+    except (lxml.etree.ParserError, ValueError) as exc:
+        logging.warning(f"lxml could not parse the CRF, using html.parser: {exc}")
+        return BeautifulSoup(html, "html.parser")
+
+
+# ------------------------------------------------------------------------------
+def is_lxml(soup):
+    """
+    Returns True if soup was parsed with FAST_PARSER.
+    """
+    return not isinstance(soup, Tag)
+
+
+# ------------------------------------------------------------------------------
+def _class_xpath(html_class):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {html_class} ')"
+
+
+# ------------------------------------------------------------------------------
+def _lxml_attrs(element):
+    """
+    Returns a copy of the attributes of the element, with the class split into
+    a list as BeautifulSoup does.
+    """
+    attrs = dict(element.attrib)
+    if "class" in attrs:
+        attrs["class"] = attrs["class"].split()
+    return attrs
+
+
+# ------------------------------------------------------------------------------
+def _lxml_matches(element, attrs):
+    """
+    Returns True if the element matches attrs as BeautifulSoup's find would.
+    Values can be a str, a compiled regular expression, True or None.
+    """
+    for name, expected in (attrs or {}).items():
+        value = element.get(name)
+        if expected is None:
+            if value is not None:
+                return False
+            continue
+        if value is None:
+            return False
+        if expected is True:
+            continue
+        values = [value]
+        if name == "class":
+            values += value.split()
+        if hasattr(expected, "search"):
+            if not any(expected.search(this) for this in values):
+                return False
+        elif expected not in values:
+            return False
+    return True
+
+
+# ------------------------------------------------------------------------------
+def find_tag(soup, tag, attrs=None):
+    """
+    Returns the first tag with matching attributes, as soup.find(tag, attrs),
+    or None.
+    """
+    if not is_lxml(soup):
+        return soup.find(tag, attrs=attrs or {})
+    for element in soup.iter(tag):
+        if _lxml_matches(element, attrs):
+            return element
+    return None
+
+
+# ------------------------------------------------------------------------------
+def tag_text(tag):
+    """
+    Returns the text of the tag and of all of its children.
+    """
+    if isinstance(tag, Tag):
+        return tag.text
+    # str() so the result does not keep a reference to the whole tree.
+    return str(tag.text_content())
+
+
+# ------------------------------------------------------------------------------
+def tag_attrs(tag):
+    """
+    Returns a copy of the attributes of the tag, as tag.attrs.copy().
+    """
+    if isinstance(tag, Tag):
+        return tag.attrs.copy()
+    return _lxml_attrs(tag)
+
+
+# ------------------------------------------------------------------------------
+def id_spans(soup):
+    """
+    Returns all of the span elements with an id attribute.
+    """
+    if is_lxml(soup):
+        return soup.xpath("//span[@id]")
+    return soup.find_all("span", id=True)
+
+
+# ------------------------------------------------------------------------------
+def attachment_audit(attachment, soup=None, parser=None):
+    """
+    Extracts audit information from the html attachment.
+
+    Inputs:
+    --------
+    attachment: AMBRA_Utils attachment
+    soup: BeautifulSoup, lxml element, None
+        The parsed html of the attachment. If None, the content is downloaded
+        and parsed with parser.
+    parser: str, None
+        See parse_html.
+    """
+    if soup is None:
+        try:
+            html = attachment.get_content()
+        except Exception:
+            print("Error getting content for ", attachment)
+        soup = parse_html(html, parser=parser)
+
+    if is_lxml(soup):
+        return _lxml_attachment_audit(soup)
 
     audit = []
 
@@ -224,6 +402,102 @@ def attachment_audit(attachment):
     return audit
 
 
+# ------------------------------------------------------------------------------
+def _lxml_attachment_audit(tree):
+    """
+    attachment_audit for a tree parsed with FAST_PARSER.
+    """
+    audit = []
+
+    audit_spans = tree.xpath(f"//span[{_class_xpath('report-audit-action')}]")
+    if len(audit_spans) > 0:
+        for audit_span in audit_spans:
+            action = tag_text(audit_span)
+            user_span, date_span = [
+                audit_span.xpath(f"following-sibling::span[{_class_xpath(name)}]")[0]
+                for name in ("report-audit-user", "report-audit-time")
+            ]
+            user = tag_text(user_span)
+            action_date = tag_text(date_span)
+            audit.append({"Name": user, "Date": action_date, "Action": action})
+    else:
+        audit_spans = tree.xpath("//span[contains(@data-i18n-token, 'report-audit:')]")
+        for audit_span in audit_spans:
+            text = tag_text(audit_span.getparent())
+            action = text.split(" by ")[0]
+            user = text.split(" by ")[1].split(" at ")[0]
+            date = text.split(" by ")[1].split(" at ")[1]
+
+            audit.append({"Name": user, "Date": date, "Action": action})
+
+    return audit
+
+
+# ------------------------------------------------------------------------------
+def crf_title(attachment, soup):
+    """
+    Returns the title of the CRF, raising GetTitleError if it is not found.
+    """
+    # May not be correct for all CRFs
+    # title_span = soup.find('span', attrs={'data-i18n-token':re.compile('report:.*')})
+    title_span = find_tag(soup, "span", attrs={"data-i18n-token": True})
+    if title_span is None:
+        raise GetTitleError(attachment)
+
+    return tag_text(title_span)
+
+
+# ------------------------------------------------------------------------------
+def last_signer(audit):
+    """
+    Returns the name and datetime of the last signature in the audit, or
+    (None, None) if the CRF was not signed.
+    """
+    signers = [
+        this for this in audit if this["Action"] in ["Signed Addendum", "Signed"]
+    ]
+    if len(signers) == 0:
+        return None, None
+
+    max_date = max([this["Date"] for this in signers])
+    last_signed = [this for this in signers if this["Date"] == max_date][0]
+    signed_date = datetime.strptime(last_signed["Date"], "%m-%d-%Y %I:%M:%S %p")
+    return last_signed["Name"], signed_date
+
+
+# ------------------------------------------------------------------------------
+def parse_crf(attachment, additional_fields=None, parser=None):
+    """
+    Downloads and parses the html attachment once and extracts everything
+    add_html needs, so the parsed tree does not have to be kept.
+
+    Returns a dictionary with the keys:
+        title: the CRF title
+        audit: list of audit entries, see attachment_audit
+        signed_by, signed_date: the last signer, see last_signer
+        data: list of span values, see extract_crf_values
+
+    Inputs:
+    --------
+    parser: str, None
+        See parse_html.
+    """
+    assert attachment.filename.split(".")[-1] == "html"
+
+    soup = parse_html(get_html(attachment), parser=parser)
+    title = crf_title(attachment, soup)
+    audit = attachment_audit(attachment, soup=soup)
+    signed_by, signed_date = last_signer(audit)
+
+    return {
+        "title": title,
+        "audit": audit,
+        "signed_by": signed_by,
+        "signed_date": signed_date,
+        "data": extract_crf_values(soup, additional_fields=additional_fields),
+    }
+
+
 # ------------------------------------------------------------------------------
 def extract_and_verify_crf_values(this_schema, soup):
     """
@@ -232,11 +506,11 @@ def extract_and_verify_crf_values(this_schema, soup):
     question_id = this_schema["question_id"]
     html_span_id = this_schema["html_span_id"]
 
-    span = soup.find("span", attrs={"id": html_span_id})
+    span = find_tag(soup, "span", attrs={"id": html_span_id})
     if span is None:
         raise SpanNotFound(html_span_id)
         # print('Could not find span for schema:', this_schema)
-    field_value = span.text
+    field_value = tag_text(span)
 
     if this_schema["re_pattern"]:
         pattern = re.compile(this_schema["re_pattern"])
@@ -290,7 +564,8 @@ def extract_crf_values(soup, additional_fields=None):
 
     Inputs:
     --------
-    soup: An object of the BeautifulSoup class.
+    soup: An object of the BeautifulSoup class or an lxml element returned by
+        parse_html.
 
     additional_fields: list of dicts
         A dictionary of additional fields to pull from the html.
@@ -300,8 +575,8 @@ def extract_crf_values(soup, additional_fields=None):
         no data will be extracted.
     """
     all_data = []
-    for span in soup.find_all("span", attrs={"id": re.compile(".*")}):
-        attrs = span.attrs.copy()
+    for span in id_spans(soup):
+        attrs = tag_attrs(span)
         attrs["html_span_id"] = attrs.pop("id")
 
         html_class = attrs.get("class")
@@ -318,7 +593,7 @@ def extract_crf_values(soup, additional_fields=None):
             attrs["style"] = ";".join(html_style)
         attrs["html_style"] = attrs.pop("style")
 
-        field_value = span.text
+        field_value = tag_text(span)
 
         # The code below will grab only text at the top level of the tag and
         # will ignore text from child elements
@@ -330,9 +605,9 @@ def extract_crf_values(soup, additional_fields=None):
 
     if additional_fields is not None:
         for add_field in additional_fields:
-            this_tag = soup.find(add_field["tag"], attrs=add_field["attrs"])
+            this_tag = find_tag(soup, add_field["tag"], attrs=add_field["attrs"])
             if this_tag is not None:
-                attrs = this_tag.attrs.copy()
+                attrs = tag_attrs(this_tag)
 
                 if add_field["html_span_id"] is None:
                     attrs["html_span_id"] = attrs.pop("id")
@@ -353,7 +628,7 @@ def extract_crf_values(soup, additional_fields=None):
                     attrs["style"] = ";".join(html_style)
                 attrs["html_style"] = attrs.pop("style")
 
-                field_value = this_tag.text
+                field_value = tag_text(this_tag)
                 attrs["value"] = field_value
 
                 all_data.append(attrs)
@@ -381,6 +656,68 @@ def crf_in_database(database, id_study, crf_id):
     return True, crf["uploaded"], crf["data_added"]
 
 
+# ------------------------------------------------------------------------------
+def namespace_crf_status(database, namespace_id):
+    """
+    Loads the state of the CRFs of all studies in the namespace with a single
+    query, so that up to date attachments can be skipped without downloading
+    them.
+
+    Returns (study_ids, crf_status) where study_ids maps the study_uid of each
+    study of the namespace in the database to its id and crf_status maps
+    (id_study, crf_id) to (uploaded, data_added), as crf_in_database.
+
+    Inputs:
+    --------
+    database: Database
+    namespace_id: str
+        Ambra id of the namespace, stored in the phi_namespace column of the
+        studies table.
+    """
+    rows = database.run_select_query(
+        """SELECT studies.study_uid, studies.id, CRF.crf_id, CRF.uploaded, CRF.data_added
+        FROM studies LEFT JOIN CRF ON CRF.id_study = studies.id
+        WHERE studies.phi_namespace = %s""",
+        (namespace_id,),
+    )
+
+    study_ids = {}
+    crf_status = {}
+    for study_uid, id_study, crf_id, uploaded, data_added in rows:
+        study_ids[study_uid] = id_study
+        if crf_id is not None:
+            crf_status[(id_study, crf_id)] = (uploaded, data_added)
+
+    return study_ids, crf_status
+
+
+# ------------------------------------------------------------------------------
+def crf_is_current(crf_status, id_study, attachment):
+    """
+    Returns True if the attachment is in crf_status, see namespace_crf_status,
+    with its data added and has not been uploaded again since, in which case
+    add_html would not change anything.
+    """
+    status = crf_status.get((id_study, str(attachment.id)))
+    if status is None:
+        return False
+    uploaded, data_added = status
+    return attachment_is_current(attachment, uploaded, data_added)
+
+
+# ------------------------------------------------------------------------------
+def attachment_is_current(attachment, uploaded, data_added):
+    """
+    Returns True if the attachment, stored in the CRF table with the given
+    uploaded and data_added values, has its data added and has not been
+    uploaded again since.
+    """
+    if not data_added or uploaded is None:
+        return False
+    # mysql does not store microsecond resolution so have to set to 0 when comparing
+    return not attachment.uploaded.replace(microsecond=0) > uploaded
+
+
 # ------------------------------------------------------------------------------
 def set_data_added(database, id_study, crf_id, value=True):
     """
@@ -426,16 +763,50 @@ def get_id_crf(database, id_study, crf_id):
     return id_crf
 
 
+# ------------------------------------------------------------------------------
+def insert_crf_data(database, id_crf, all_data, chunk_size=500):
+    """
+    Inserts or updates the values extracted by extract_crf_values for the CRF
+    with id id_crf in the CRF_Data table, with multi-row
+    INSERT ... ON DUPLICATE KEY UPDATE statements of at most chunk_size rows.
+
+    Values longer than 1024 characters are truncated to their last 1024
+    characters.
+    """
+    records = []
+    for this_data in all_data:
+        this_data["id_crf"] = id_crf
+        if len(this_data["value"]) > 1024:
+            this_data["value"] = this_data["value"][-1024:]
+        records.append(
+            (
+                this_data["id_crf"],
+                this_data["value"],
+                this_data["html_class"],
+                this_data["html_style"],
+                this_data["html_span_id"],
+            )
+        )
+
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start : start + chunk_size]
+        database.run_insert_query(
+            """INSERT INTO CRF_Data (id_crf, value, html_class, html_style, html_span_id)
+            VALUES """
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+            + """ ON DUPLICATE KEY UPDATE value=VALUES(value), html_class=VALUES(html_class),
+            html_style=VALUES(html_style), decoded_value=NULL""",
+            [item for record in chunk for item in record],
+        )
+
+
 # ------------------------------------------------------------------------------
 def verify_all_spans_accounted(schema, soup):
     """
     Raises UnaccountedSpan exception if all of the spans in the html are not
     included in the schema.
     """
-    html_span_ids = [
-        item.attrs.get("id")
-        for item in soup.find_all("span", attrs={"id": re.compile(".*")})
-    ]
+    html_span_ids = [item.get("id") for item in id_spans(soup)]
     schema_span_ids = [this["html_span_id"] for this in schema]
     unaccounted_spans = list(set(schema_span_ids).difference(html_span_ids))
 
@@ -444,126 +815,108 @@ def verify_all_spans_accounted(schema, soup):
 
 
 # ------------------------------------------------------------------------------
-def add_html(database, attachment, id_study, crf_version=1.0, additional_fields=None):
+def add_html(
+    database,
+    attachment,
+    id_study,
+    crf_version=1.0,
+    additional_fields=None,
+    crf=None,
+    parser=None,
+):
     """
     For html attachment add to crf table and extract data into crf_data table.
+
+    Inputs:
+    --------
+    crf: dict, None
+        The attachment parsed by parse_crf, including its data. If None, the
+        attachment is only downloaded and parsed with parser if it is not
+        already up to date in the database.
+    parser: str, None
+        See parse_html.
     """
     assert attachment.filename.split(".")[-1] == "html"
 
     crf_id = attachment.id
 
     file_type = "html"
-    try:
-        html = attachment.get_content()
-    except Exception as exc:
-        raise GetContentError(attachment) from exc
-        # raise Exception('Error getting content for ', attachment)
+    status = None
+    if crf is None:
+        status = crf_in_database(database, id_study, crf_id)
+        crf_in_db, uploaded, data_added = status
+        if crf_in_db and attachment_is_current(attachment, uploaded, data_added):
+            return
+        crf = parse_crf(attachment, additional_fields=additional_fields, parser=parser)
+    if crf.get("data") is None:
+        raise ValueError(f"The parsed CRF {attachment.filename} has no data.")
+
+    crf_title = crf["title"]
+    signer = crf["signed_by"]
+    signed_date = crf["signed_date"]
+
+    # The CRF row, its data and data_added are written in a single transaction.
+    with database.transaction():
+        # 4) Add to CRF table and get id for this entry
+        if status is None:
+            status = crf_in_database(database, id_study, crf_id)
+        crf_in_db, uploaded, data_added = status
+        if not crf_in_db:
+            id_crf = database.insert_dict(
+                {
+                    "id_study": id_study,
+                    "crf_name": crf_title,
+                    "file_type": file_type,
+                    "file_name": attachment.filename,
+                    "signed_by": signer,
+                    "signed_date": signed_date,
+                    "uploaded": attachment.uploaded,
+                    "crf_id": crf_id,
+                    "version": attachment.version,
+                    "phi_namespace": attachment.phi_namespace,
+                    "data_added": False,
+                },
+                "CRF",
+            )
+        elif attachment.uploaded.replace(microsecond=0) > uploaded:
+            # mysql does not store microsecond resolution so have to set to 0 when comparing
+            # update CRF and data
+            data_added = False
+            id_crf = get_id_crf(database, id_study, crf_id)
+            database.update_dict(
+                {
+                    "crf_name": crf_title,
+                    "file_type": file_type,
+                    "file_name": attachment.filename,
+                    "signed_by": signer,
+                    "signed_date": signed_date,
+                    "uploaded": attachment.uploaded,
+                    "version": attachment.version,
+                    "phi_namespace": attachment.phi_namespace,
+                    "data_added": False,
+                },
+                "CRF",
+                "id",
+                id_crf,
+            )
 
-    soup = BeautifulSoup(html, "html.parser")
+        else:
+            id_crf = get_id_crf(database, id_study, crf_id)
 
-    # May not be correct for all CRFs
-    # title_span = soup.find('span', attrs={'data-i18n-token':re.compile('report:.*')})
-    title_span = soup.find("span", attrs={"data-i18n-token": re.compile(".*")})
-    if title_span is None:
-        raise GetTitleError(attachment)
+        if not data_added:
+            ## Schema-less
+            ## ------------
+            all_data = crf["data"]
 
-    crf_title = title_span.text
+            insert_crf_data(database, id_crf, all_data)
 
-    # 3) Get audit and extract the last signer
-    audit = attachment_audit(attachment)
-
-    # last signer
-    signers = [
-        this for this in audit if this["Action"] in ["Signed Addendum", "Signed"]
-    ]
-    max_date = None
-    last_signed = None
-    signer = None
-    signed_date = None
-    if len(signers) > 0:
-        max_date = max([this["Date"] for this in signers])
-        last_signed = [this for this in signers if this["Date"] == max_date][0]
-        signer = last_signed["Name"]
-        signed_date = datetime.strptime(last_signed["Date"], "%m-%d-%Y %I:%M:%S %p")
-
-    # 4) Add to CRF table and get id for this entry
-    crf_in_db, uploaded, data_added = crf_in_database(database, id_study, crf_id)
-    if not crf_in_db:
-        id_crf = database.insert_dict(
-            {
-                "id_study": id_study,
-                "crf_name": crf_title,
-                "file_type": file_type,
-                "file_name": attachment.filename,
-                "signed_by": signer,
-                "signed_date": signed_date,
-                "uploaded": attachment.uploaded,
-                "crf_id": crf_id,
-                "version": attachment.version,
-                "phi_namespace": attachment.phi_namespace,
-                "data_added": False,
-            },
-            "CRF",
-        )
-    elif attachment.uploaded.replace(microsecond=0) > uploaded:
-        # mysql does not store microsecond resolution so have to set to 0 when comparing
-        # update CRF and data
-        data_added = False
-        id_crf = get_id_crf(database, id_study, crf_id)
-        database.update_dict(
-            {
-                "crf_name": crf_title,
-                "file_type": file_type,
-                "file_name": attachment.filename,
-                "signed_by": signer,
-                "signed_date": signed_date,
-                "uploaded": attachment.uploaded,
-                "version": attachment.version,
-                "phi_namespace": attachment.phi_namespace,
-                "data_added": False,
-            },
-            "CRF",
-            "id",
-            id_crf,
-        )
-
-    else:
-        id_crf = get_id_crf(database, id_study, crf_id)
-
-    if not data_added:
-        ## Schema-less
-        ## ------------
-        all_data = extract_crf_values(soup, additional_fields=additional_fields)
-
-        for this_data in all_data:
-            this_data["id_crf"] = id_crf
-            if len(this_data["value"]) > 1024:
-                this_data["value"] = this_data["value"][-1024:]
-
-            # database.insert_dict(this_data, 'CRF_Data')
-            database.run_insert_query(
-                """
-            INSERT INTO CRF_Data (id_crf, value, html_class, html_style, html_span_id)
-            VALUES (%s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE value=%s, html_class=%s, html_style=%s, decoded_value=NULL;
-            """,
-                (
-                    this_data["id_crf"],
-                    this_data["value"],
-                    this_data["html_class"],
-                    this_data["html_style"],
-                    this_data["html_span_id"],
-                    this_data["value"],
-                    this_data["html_class"],
-                    this_data["html_style"],
-                ),
-            )
-
-    set_data_added(database, id_study, crf_id, value=True)
+        set_data_added(database, id_study, crf_id, value=True)
 
 
 # ------------------------------------------------------------------------------
-def add_html_crfs(database, study, additional_fields=None, ignore_errors=False):
+def add_html_crfs(
+    database, study, additional_fields=None, ignore_errors=False, parser=None
+):
     """
     Find html CRFs in the given study and add to the database.
     """
@@ -579,6 +932,7 @@ def add_html_crfs(database, study, additional_fields=None, ignore_errors=False):
                         attachment,
                         id_study,
                         additional_fields=additional_fields,
+                        parser=parser,
                     )
                 except GetContentError as gce:
                     print(
@@ -593,42 +947,249 @@ def add_html_crfs(database, study, additional_fields=None, ignore_errors=False):
 
 
 # ------------------------------------------------------------------------------
-def backup_studies(database, studies, additional_html_fields=None):
+def fetch_study_crfs(study, additional_fields=None, parser=None, is_current=None):
     """
-    Backup all studies in the given 'studies' list.
+    Downloads and parses the html attachments of the study. Does not use the
+    database, so it can run in a worker thread.
+
+    If is_current is not None, attachments for which is_current(attachment)
+    returns True are skipped before their content is downloaded.
+
+    Returns a list of (attachment, crf, exception) tuples, where crf is the
+    dictionary returned by parse_crf or None if parsing raised exception.
+    Raises GetAttachmentsError if the attachments could not be listed.
     """
-    for study in studies:
+    try:
+        attachments = study.get_attachments()
+    except Exception as exc:
+        raise GetAttachmentsError(study) from exc
+
+    results = []
+    for attachment in attachments or []:
+        if attachment.filename.split(".")[-1] != "html":
+            continue
+        if is_current is not None and is_current(attachment):
+            continue
         try:
-            add_html_crfs(database, study, additional_fields=additional_html_fields)
+            crf = parse_crf(
+                attachment, additional_fields=additional_fields, parser=parser
+            )
         except Exception as exc:
-            print(20 * "=")
-            print(study)
-            print(exc)
-            print(20 * "=")
+            results.append((attachment, None, exc))
+        else:
+            results.append((attachment, crf, None))
+    return results
+
+
+# ------------------------------------------------------------------------------
+def study_error(study, exception, attachment=None):
+    """
+    Returns an entry of the error report of backup_studies and logs it.
+    """
+    error = {
+        "study_uid": study.study_uid,
+        "attachment": None if attachment is None else attachment.filename,
+        "error": f"{type(exception).__name__}: {exception}",
+        "exception": exception,
+    }
+    logging.error(
+        f"CRF backup failed for study {error['study_uid']}"
+        + (f", attachment {error['attachment']}" if attachment is not None else "")
+        + f": {error['error']}"
+    )
+    return error
+
+
+# ------------------------------------------------------------------------------
+def write_study_crfs(database, study, fetched):
+    """
+    Adds the CRFs returned by fetch_study_crfs for the study to the database.
+
+    Returns the list of errors, see backup_studies.
+    """
+    errors = []
+    id_study = database.get_study_by_uid(study.study_uid)
+    for attachment, crf, exception in fetched:
+        if exception is None:
+            try:
+                add_html(database, attachment, id_study, crf=crf)
+            except Exception as exc:
+                exception = exc
+        if exception is not None:
+            errors.append(study_error(study, exception, attachment))
+    return errors
 
 
 # ------------------------------------------------------------------------------
-def backup_location_reads(database_name, ambra_account_name, location_name):
+def backup_studies(
+    database,
+    studies,
+    additional_html_fields=None,
+    parser=None,
+    n_workers=0,
+    max_pending=None,
+    crf_status=None,
+):
+    """
+    Backup all studies in the given 'studies' iterable.
+
+    Attachments are downloaded and parsed by fetch_study_crfs and written by
+    write_study_crfs. With n_workers > 0, a pool of threads downloads and
+    parses the studies while the calling thread writes them to the database in
+    order, so the database is only used from one thread. Studies are taken
+    from 'studies' as they are needed, with at most max_pending studies fetched
+    ahead of the one being written.
+
+    Inputs:
+    --------
+    database: Database
+    studies: iterable of AMBRA_Utils.Study objects
+    additional_html_fields: list of dicts, None
+        See extract_crf_values.
+    parser: str, None
+        See parse_html, use FAST_PARSER to extract with lxml.
+    n_workers: int
+        Number of threads downloading and parsing attachments. If 0, studies
+        are processed one at a time in the calling thread.
+    max_pending: int, None
+        Defaults to twice the number of workers.
+    crf_status: tuple, None
+        The result of namespace_crf_status for the namespace of the studies.
+        If not None, attachments already up to date in the database are
+        skipped without being downloaded.
+
+    Returns a list with an entry for each study or attachment that failed, a
+    dictionary with the keys 'study_uid', 'attachment' (the file name or None
+    if the whole study failed), 'error' and 'exception'.
+    """
+    errors = []
+    n_studies = 0
+
+    def fetch(study):
+        is_current = None
+        if crf_status is not None:
+            study_ids, status = crf_status
+            id_study = study_ids.get(study.study_uid)
+            if id_study is not None:
+                is_current = partial(crf_is_current, status, id_study)
+
+        return fetch_study_crfs(
+            study,
+            additional_fields=additional_html_fields,
+            parser=parser,
+            is_current=is_current,
+        )
+
+    def write(study, fetched):
+        try:
+            errors.extend(write_study_crfs(database, study, fetched))
+        except Exception as exc:
+            errors.append(study_error(study, exc))
+
+    if n_workers <= 0:
+        for study in studies:
+            n_studies += 1
+            try:
+                fetched = fetch(study)
+            except Exception as exc:
+                errors.append(study_error(study, exc))
+                continue
+            write(study, fetched)
+    else:
+        if max_pending is None:
+            max_pending = 2 * n_workers
+        pending = deque()
+        studies = iter(studies)
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            while True:
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        study = next(studies)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((study, executor.submit(fetch, study)))
+                if not pending:
+                    break
+                study, future = pending.popleft()
+                n_studies += 1
+                try:
+                    fetched = future.result()
+                except Exception as exc:
+                    errors.append(study_error(study, exc))
+                    continue
+                write(study, fetched)
+
+    logging.info(
+        f"Backed up CRFs of {n_studies} studies, "
+        f"{len(errors)} studies or attachments failed."
+    )
+    return errors
+
+
+# ------------------------------------------------------------------------------
+def backup_location_reads(
+    database_name,
+    ambra_account_name,
+    location_name,
+    parser=None,
+    n_workers=0,
+    skip_current=True,
+):
     """
     Backup html CRFs from the location namespace location_name.
+
+    If skip_current is True, CRFs already up to date in the database are
+    skipped without being downloaded, see namespace_crf_status.
+
+    Returns the error report of backup_studies.
     """
     database = get_database(database_name)
     location = get_location(ambra_account_name, location_name)
-    studies = list(location.get_studies())
-
-    backup_studies(database, studies)
+    crf_status = None
+    if skip_current:
+        crf_status = namespace_crf_status(database, location.namespace_id)
+
+    return backup_studies(
+        database,
+        location.get_studies(),
+        parser=parser,
+        n_workers=n_workers,
+        crf_status=crf_status,
+    )
 
 
 # ------------------------------------------------------------------------------
-def backup_group_reads(database_name, ambra_account_name, group_name):
+def backup_group_reads(
+    database_name,
+    ambra_account_name,
+    group_name,
+    parser=None,
+    n_workers=0,
+    skip_current=True,
+):
     """
     Backup html CRFs from the group namespace group_name.
+
+    If skip_current is True, CRFs already up to date in the database are
+    skipped without being downloaded, see namespace_crf_status.
+
+    Returns the error report of backup_studies.
     """
     database = get_database(database_name)
     group = get_group(ambra_account_name, group_name)
-    studies = list(group.get_studies())
-
-    backup_studies(database, studies)
+    crf_status = None
+    if skip_current:
+        crf_status = namespace_crf_status(database, group.namespace_id)
+
+    return backup_studies(
+        database,
+        group.get_studies(),
+        parser=parser,
+        n_workers=n_workers,
+        crf_status=crf_status,
+    )
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,208 @@
+"""
+Append-only journal used to make backup runs resumable.
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# States a study moves through during a backup, in order.
+STUDY_STATES = ("queued", "downloading", "downloaded", "verified", "converted")
+
+
+################################################################################
+class BackupJournal:
+    """
+    Records the state of every study of a backup run as one JSON object per
+    line in the journal file. The file is only ever appended to, so a run that
+    dies halfway leaves a journal that can be replayed to find where it stopped.
+
+    Study entries are keyed by the study uuid and store the study 'updated'
+    field, so a study that has changed on Ambra since it was journaled is not
+    considered complete.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, journal_path):
+        """
+        Inputs:
+        --------
+        journal_path: str, Path
+            Path to the journal file. It will be created if it does not exist.
+        """
+        self.journal_path = Path(journal_path)
+        self._lock = threading.Lock()
+        self._studies = {}
+        self._namespaces = set()
+        self.run_id = None
+        self._last_run = None
+        self._last_run_finished = True
+
+        if self.journal_path.exists():
+            self._replay()
+
+    # --------------------------------------------------------------------------
+    def _replay(self):
+        """
+        Applies the entries of the journal file. A last line without a newline
+        was only partially written by a crash and is truncated, so that the
+        next entry is not appended onto it.
+        """
+        complete_size = 0
+        with open(self.journal_path, "rb") as fopen:
+            for line in fopen:
+                if not line.endswith(b"\n"):
+                    break
+                complete_size += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    logging.warning(f"Ignoring corrupt line in {self.journal_path}.")
+                    continue
+                self._apply(entry)
+
+        if complete_size < self.journal_path.stat().st_size:
+            logging.warning(
+                f"Truncating partially written last line of {self.journal_path}."
+            )
+            with open(self.journal_path, "r+b") as fopen:
+                fopen.truncate(complete_size)
+                fopen.flush()
+                os.fsync(fopen.fileno())
+
+    # --------------------------------------------------------------------------
+    def _apply(self, entry):
+        if "uuid" in entry:
+            record = self._studies.setdefault(entry["uuid"], {})
+            record.update({k: v for k, v in entry.items() if v is not None})
+        elif "namespace" in entry:
+            if entry["run"] == self._last_run:
+                self._namespaces.add(entry["namespace"])
+        elif entry["state"] == "run_started":
+            if entry["run"] != self._last_run:
+                self._namespaces = set()
+            self._last_run = entry["run"]
+            self._last_run_finished = False
+        elif entry["state"] == "run_finished":
+            self._last_run_finished = True
+
+    # --------------------------------------------------------------------------
+    def _append(self, entry):
+        entry["time"] = datetime.now().isoformat()
+        with self._lock:
+            with open(self.journal_path, "a") as fopen:
+                fopen.write(json.dumps(entry) + "\n")
+                fopen.flush()
+                os.fsync(fopen.fileno())
+            self._apply(entry)
+
+    # --------------------------------------------------------------------------
+    def start_run(self):
+        """
+        Starts a new run, or resumes the last run if it did not finish.
+
+        Returns the id of the run.
+        """
+        if self._last_run is not None and not self._last_run_finished:
+            self.run_id = self._last_run
+            logging.info(f"Resuming backup run {self.run_id}.")
+        else:
+            self.run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+            logging.info(f"Starting backup run {self.run_id}.")
+        self._append({"run": self.run_id, "state": "run_started"})
+        return self.run_id
+
+    # --------------------------------------------------------------------------
+    def finish_run(self):
+        """
+        Marks the current run as finished so the next run starts from scratch,
+        then compacts the journal.
+        """
+        self._append({"run": self.run_id, "state": "run_finished"})
+        self.compact()
+
+    # --------------------------------------------------------------------------
+    def compact(self):
+        """
+        Rewrites the journal with a single line per study, holding its latest
+        record, so that the file and the time taken to replay it do not grow
+        with every run. Should only be called when no run is in progress.
+
+        The new journal is written to a temporary file that then replaces the
+        journal, so a crash leaves either the old or the new journal.
+        """
+        with self._lock:
+            entries = [dict(record) for record in self._studies.values()]
+            if self._last_run is not None:
+                entries.append({"run": self._last_run, "state": "run_started"})
+                if self._last_run_finished:
+                    entries.append({"run": self._last_run, "state": "run_finished"})
+
+            temp_path = self.journal_path.with_name(self.journal_path.name + ".tmp")
+            with open(temp_path, "w") as fopen:
+                for entry in entries:
+                    fopen.write(json.dumps(entry) + "\n")
+                fopen.flush()
+                os.fsync(fopen.fileno())
+            os.replace(temp_path, self.journal_path)
+
+    # --------------------------------------------------------------------------
+    def set_namespace_complete(self, namespace):
+        """
+        Marks all studies of the namespace as processed for the current run.
+        """
+        self._append(
+            {"run": self.run_id, "namespace": namespace.uuid, "state": "complete"}
+        )
+
+    # --------------------------------------------------------------------------
+    def is_namespace_complete(self, namespace):
+        """
+        Returns True if the namespace was completed in the current run.
+        """
+        with self._lock:
+            return namespace.uuid in self._namespaces
+
+    # --------------------------------------------------------------------------
+    def set_state(self, study, state, **paths):
+        """
+        Records the new state of the study along with any paths (zip_file,
+        nifti_dir, annotation_file) passed as keyword arguments.
+        """
+        assert state in STUDY_STATES
+        entry = {
+            "run": self.run_id,
+            "uuid": study.uuid,
+            "updated": study.updated,
+            "state": state,
+        }
+        entry.update({key: str(value) for key, value in paths.items() if value})
+        self._append(entry)
+
+    # --------------------------------------------------------------------------
+    def get_record(self, study):
+        """
+        Returns a copy of the journaled record for the study or None if the
+        study is not in the journal or has been updated since.
+        """
+        with self._lock:
+            record = self._studies.get(study.uuid)
+            if record is None or record.get("updated") != study.updated:
+                return None
+            return dict(record)
+
+    # --------------------------------------------------------------------------
+    def is_complete(self, study, convert=False):
+        """
+        Returns True if the study does not need to be processed again: its zip
+        file has been verified and, if convert is True, converted to nifti.
+        """
+        record = self.get_record(study)
+        if record is None:
+            return False
+        if convert:
+            return record["state"] == "converted"
+        return record["state"] in ("verified", "converted")
@@ -0,0 +1,241 @@
+"""
+Concurrent prefetching of Ambra study metadata.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from time import monotonic, sleep
+
+
+################################################################################
+class RateLimiter:
+    """
+    Token bucket limiting the number of calls made per second. Tokens are
+    refilled continuously at rate per second up to burst tokens.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, rate, burst=None):
+        """
+        Inputs:
+        --------
+        rate: float
+            Average number of calls allowed per second.
+        burst: int, None
+            Maximum number of calls that can be made at once after being idle.
+            Defaults to rate, with a minimum of 1.
+        """
+        assert rate > 0
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def acquire(self):
+        """
+        Blocks until a call is allowed.
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+################################################################################
+class StudyPrefetcher:
+    """
+    Fetches the series lists and series tags of studies from Ambra using a pool
+    of threads, ahead of when they are needed.
+
+    Every series list and tag payload is fetched at most once: results are kept,
+    keyed by study uuid and series uid, until forget() is called for the study.
+    Errors raised by Ambra are stored as well and raised again when the result
+    is requested.
+
+    If an ambra_cache.AmbraCache is given, requests go through it, so objects
+    already fetched elsewhere in the run, e.g. by Database, are not requested
+    again.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, n_workers=4, rate=None, burst=None, cache=None):
+        """
+        Inputs:
+        --------
+        n_workers: int
+            Number of threads making requests to Ambra. If 0, nothing is
+            fetched ahead and requests are made when a result is requested.
+        rate: float, None
+            If not None, maximum number of Ambra requests per second, shared by
+            all of the threads.
+        burst: int, None
+            Passed to RateLimiter.
+        cache: ambra_cache.AmbraCache, None
+            Cache shared with the rest of the run.
+        """
+        self.n_workers = n_workers
+        self.cache = cache
+        self.rate_limiter = RateLimiter(rate, burst=burst) if rate else None
+        self._executor = ThreadPoolExecutor(n_workers) if n_workers > 0 else None
+        self._lock = threading.Lock()
+        self._series = {}
+        self._tags = {}
+        self._study_series_uids = {}
+
+    # --------------------------------------------------------------------------
+    def _call(self, function, *args):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return function(*args)
+
+    # --------------------------------------------------------------------------
+    def _get_future(self, cache, key, function, *args):
+        """
+        Returns the future for key in cache, submitting function(*args) if the
+        key has not been requested yet.
+        """
+        with self._lock:
+            future = cache.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            cache[key] = future
+
+        if self._executor is None:
+            self._run(future, function, *args)
+        else:
+            self._executor.submit(self._run, future, function, *args)
+        return future, True
+
+    # --------------------------------------------------------------------------
+    def _run(self, future, function, *args):
+        try:
+            future.set_result(self._call(function, *args))
+        except Exception as e:
+            future.set_exception(e)
+
+    # --------------------------------------------------------------------------
+    def _get_series(self, study):
+        if self.cache is not None:
+            return self.cache.series(study)
+        return list(study.get_series())
+
+    # --------------------------------------------------------------------------
+    def _get_series_tags(self, series):
+        if self.cache is not None:
+            return self.cache.series_tags(series)
+        return series.get_tags(0)
+
+    # --------------------------------------------------------------------------
+    def _fetch_series(self, study):
+        series = self._get_series(study)
+        with self._lock:
+            if study.uuid not in self._series:
+                # The study was forgotten while its series were being fetched.
+                return series
+            self._study_series_uids[study.uuid] = [this.series_uid for this in series]
+        if self._executor is not None:
+            for this_series in series:
+                self._get_future(
+                    self._tags,
+                    this_series.series_uid,
+                    self._get_series_tags,
+                    this_series,
+                )
+        return series
+
+    # --------------------------------------------------------------------------
+    def prefetch(self, study):
+        """
+        Starts fetching the series list of the study and the tags of all of its
+        series in the background.
+        """
+        self._get_future(self._series, study.uuid, self._fetch_series, study)
+
+    # --------------------------------------------------------------------------
+    def series(self, study):
+        """
+        Returns the list of series of the study, as study.get_series().
+        """
+        future, _ = self._get_future(
+            self._series, study.uuid, self._fetch_series, study
+        )
+        return future.result()
+
+    # --------------------------------------------------------------------------
+    def series_tags(self, series):
+        """
+        Returns the tags of the series, as series.get_tags(0).
+        """
+        future, _ = self._get_future(
+            self._tags, series.series_uid, self._get_series_tags, series
+        )
+        return future.result()
+
+    # --------------------------------------------------------------------------
+    def forget(self, study):
+        """
+        Drops the results kept for the study and its series.
+        """
+        with self._lock:
+            self._series.pop(study.uuid, None)
+            for series_uid in self._study_series_uids.pop(study.uuid, []):
+                self._tags.pop(series_uid, None)
+
+    # --------------------------------------------------------------------------
+    def iter_prefetched(self, studies, window=None):
+        """
+        Yields the studies while keeping up to window studies ahead of the
+        one yielded being prefetched. The results of a study are forgotten once
+        the next study is requested, so memory use is bounded by the window.
+
+        Inputs:
+        --------
+        studies: iterable of AMBRA_Utils.Study objects
+        window: int, None
+            Number of studies fetched ahead. Defaults to twice the number of
+            workers.
+        """
+        if window is None:
+            window = max(1, 2 * self.n_workers)
+        pending = deque()
+        studies = iter(studies)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    study = next(studies)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.prefetch(study)
+                pending.append(study)
+            if not pending:
+                return
+            study = pending.popleft()
+            yield study
+            self.forget(study)
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
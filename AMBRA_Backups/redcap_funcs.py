@@ -257,27 +257,21 @@ def comp_schema_cap_db(db_name, project_name):
 
     for crf_name in forms:
         # redcap_variable discrepancies
-        unique_data_vars = pd.DataFrame(
-            db.run_select_query(
-                """SELECT DISTINCT(redcap_variable) 
+        unique_data_vars = db.query_to_dataframe(
+            """SELECT DISTINCT(redcap_variable) 
             FROM CRF_RedCap
             JOIN CRF_Data_RedCap
                 ON CRF_RedCap.id = CRF_Data_RedCap.id_crf
             WHERE crf_name = %s""",
-                [crf_name],
-                column_names=True,
-            )
+            [crf_name],
         )
         var_discrep_string = ""
         if not unique_data_vars.empty:
             unique_data_vars = unique_data_vars["redcap_variable"]
-            schema_vars = pd.DataFrame(
-                db.run_select_query(
-                    """SELECT redcap_variable FROM CRF_Schema_RedCap
+            schema_vars = db.query_to_dataframe(
+                """SELECT redcap_variable FROM CRF_Schema_RedCap
                 WHERE crf_name = %s""",
-                    [crf_name],
-                    column_names=True,
-                )
+                [crf_name],
             )["redcap_variable"]
 
             var_discreps = unique_data_vars[
@@ -295,13 +289,10 @@ def comp_schema_cap_db(db_name, project_name):
         # display(schema_vars)
 
         # question text discrepancies
-        schema_questions = pd.DataFrame(
-            db.run_select_query(
-                """SELECT question_text, redcap_variable FROM CRF_Schema_RedCap
+        schema_questions = db.query_to_dataframe(
+            """SELECT question_text, redcap_variable FROM CRF_Schema_RedCap
                                         WHERE crf_name = %s AND question_text IS NOT NULL""",
-                [crf_name],
-                column_names=True,
-            )
+            [crf_name],
         )
         schema_questions["variable-value"] = (
             schema_questions["redcap_variable"] + schema_questions["question_text"]
@@ -355,13 +346,10 @@ def comp_schema_cap_db(db_name, project_name):
         # display(api_questions.reset_index())
 
         # radio button option discrepancies
-        schema_radio_options = pd.DataFrame(
-            db.run_select_query(
-                """SELECT * FROM CRF_Schema_RedCap
+        schema_radio_options = db.query_to_dataframe(
+            """SELECT * FROM CRF_Schema_RedCap
                                     WHERE crf_name = %s AND question_type = 'radio'""",
-                [crf_name],
-                column_names=True,
-            )
+            [crf_name],
         )
         radio_discrep_string = ""
         if not schema_radio_options.empty:
@@ -574,7 +562,7 @@ def export_records_wrapper(project, patient_name, crf_name, instance=None):
     return form_df
 
 
-def project_data_to_db(db, project, start_date=None, end_date=None):
+def project_data_to_db(db, project, start_date=None, end_date=None, batch_size=1):
     """
     Exports data from redcap logs into db
     1. extract logs from redcap from last successful update to now
@@ -591,6 +579,10 @@ def project_data_to_db(db, project, start_date=None, end_date=None):
 
     Note: if a log appears in redcap, but not through the api, this is normal, the api
           just takes a few minutes
+
+    batch_size: int, None
+        Number of write statements per commit while adding the logs (step 2-7).
+        If None, all of the logs are added in a single transaction.
     """
 
     # try:
@@ -657,171 +649,178 @@ def project_data_to_db(db, project, start_date=None, end_date=None):
 
     # loop through record_logs and add to db
     failed_to_add = []
-    for i, log in tqdm(
-        enumerate(record_logs), total=len(record_logs), desc="Adding data logs to db"
-    ):
-        if log["details"] == "":  # no changes to record
-            continue
-        # log deleting a record
-        if "Delete record" in log["action"]:
-            patient_name = log["action"].split(" ")[-1].strip()
-            patient_id = str(
-                db.run_select_query(
-                    """SELECT id FROM patients WHERE patient_name = %s""",
-                    [patient_name],
-                )[0][0]
-            )
-            db.run_insert_query(
-                """UPDATE CRF_RedCap SET deleted = 1 WHERE id_patient = %s""",
-                [patient_id],
-            )
-            continue
+    with db.transaction(flush_every=batch_size):
+        for i, log in tqdm(
+            enumerate(record_logs),
+            total=len(record_logs),
+            desc="Adding data logs to db",
+        ):
+            if log["details"] == "":  # no changes to record
+                continue
+            # log deleting a record
+            if "Delete record" in log["action"]:
+                patient_name = log["action"].split(" ")[-1].strip()
+                patient_id = str(
+                    db.run_select_query(
+                        """SELECT id FROM patients WHERE patient_name = %s""",
+                        [patient_name],
+                    )[0][0]
+                )
+                db.run_insert_query(
+                    """UPDATE CRF_RedCap SET deleted = 1 WHERE id_patient = %s""",
+                    [patient_id],
+                )
+                continue
 
-        # list of current patients in db to check if there is a new patient
-        patient_name = log["action"].split(" ")[-1].strip()
-        patient_id = db.run_select_query(
-            """SELECT id FROM patients WHERE patient_name = %s""", [patient_name]
-        )
-        if not patient_id:
-            patient_id = db.run_insert_query(
-                """INSERT INTO patients (patient_name, patient_id) VALUES (%s, %s)""",
-                [patient_name, patient_name],
+            # list of current patients in db to check if there is a new patient
+            patient_name = log["action"].split(" ")[-1].strip()
+            patient_id = db.run_select_query(
+                """SELECT id FROM patients WHERE patient_name = %s""", [patient_name]
             )
-        else:
-            patient_id = patient_id[0][0]
-
-        # Process log details from string into dictionary.
-        instance = None
-        details = extract_details(log["details"] + ",")
-        crf_name = None
-
-        # Grab instance if in details
-        if "[instance]" in details:
-            # If the log contains the instance number and nothing else, no other data was changed
-            if len(details) == 1:
+            if not patient_id:
+                patient_id = db.run_insert_query(
+                    """INSERT INTO patients (patient_name, patient_id) VALUES (%s, %s)""",
+                    [patient_name, patient_name],
+                )
+            else:
+                patient_id = patient_id[0][0]
+
+            # Process log details from string into dictionary.
+            instance = None
+            details = extract_details(log["details"] + ",")
+            crf_name = None
+
+            # Grab instance if in details
+            if "[instance]" in details:
+                # If the log contains the instance number and nothing else, no other data was changed
+                if len(details) == 1:
+                    continue
+                instance = details["[instance]"]
+
+            # Get CRF
+            for form, vars in master_form_var_dict.items():
+                for form_var in vars:
+                    regex = rf"^{form_var}(\([a-zA-z0-9]*\.?[a-zA-z0-9]*\))?$"  # Handles multi choice var
+                    for detail_var in details:
+                        if re.fullmatch(regex, detail_var):
+                            crf_name = form
+            if not crf_name:
+                failed_to_add.append(
+                    (patient_name, log["timestamp"], f"redcap_variables: {log}")
+                )
                 continue
-            instance = details["[instance]"]
-
-        # Get CRF
-        for form, vars in master_form_var_dict.items():
-            for form_var in vars:
-                regex = rf"^{form_var}(\([a-zA-z0-9]*\.?[a-zA-z0-9]*\))?$"  # Handles multi choice var
-                for detail_var in details:
-                    if re.fullmatch(regex, detail_var):
-                        crf_name = form
-        if not crf_name:
-            failed_to_add.append(
-                (patient_name, log["timestamp"], f"redcap_variables: {log}")
-            )
-            continue
 
-        if (instance is None) and (crf_name in repeating_forms):
-            instance = 1
+            if (instance is None) and (crf_name in repeating_forms):
+                instance = 1
 
-        crf_row = pd.DataFrame(
-            db.run_select_query(
-                f"""SELECT * FROM CRF_RedCap WHERE id_patient = {patient_id} AND crf_name = \'{crf_name}\' 
-                                    AND instance {"IS NULL" if instance is None else f"= {instance}"} AND deleted = '0'""",
-                column_names=True,
+            crf_row = pd.DataFrame(
+                db.run_select_query(
+                    f"""SELECT * FROM CRF_RedCap WHERE id_patient = {patient_id} AND crf_name = \'{crf_name}\' 
+                                        AND instance {"IS NULL" if instance is None else f"= {instance}"} AND deleted = '0'""",
+                    column_names=True,
+                )
+            )  # cant use run_select_query.record here, because ('IS NULL' or '= #') is not a valid sql variable
+            record_df = export_records_wrapper(
+                project, patient_name, crf_name, instance
             )
-        )  # cant use run_select_query.record here, because ('IS NULL' or '= #') is not a valid sql variable
-        record_df = export_records_wrapper(project, patient_name, crf_name, instance)
-
-        if record_df.empty and crf_row.empty:  # deleted record in redcap not in db
-            continue
 
-        elif record_df.empty and not crf_row.empty:  # deleted record in redcap in db
-            deleted = 1
-            db.run_insert_query(
-                """UPDATE CRF_RedCap SET deleted = %s WHERE id = %s""",
-                [deleted, str(crf_row["id"].iloc[0])],
-            )
+            if record_df.empty and crf_row.empty:  # deleted record in redcap not in db
+                continue
 
-        elif not record_df.empty:  # data to enter
-            # preprocess record_df for data insertion/update
-            irrelevant_columns = {
-                "redcap_repeat_instrument",
-                "redcap_event_name",
-                "redcap_repeat_instance",
-            }
-            record_df = record_df.drop(irrelevant_columns, axis=1, errors="ignore")
-            record_df = record_df.melt(var_name="redcap_variable")
-            record_df.loc[
-                record_df["redcap_variable"].str.contains("___"), "redcap_variable"
-            ] = record_df["redcap_variable"] + ")"
-            record_df.loc[
-                record_df["redcap_variable"].str.contains("___"), "redcap_variable"
-            ] = record_df["redcap_variable"].str.replace("___", "(")
-
-            if not crf_row.empty:  # update
-                if f"{crf_name}_status" in record_df["redcap_variable"].to_list():
-                    if (
-                        record_df.loc[
-                            record_df["redcap_variable"] == f"{crf_name}_status",
-                            "value",
-                        ].iloc[0]
-                        == "4"
-                        or record_df.loc[
-                            record_df["redcap_variable"] == f"{crf_name}_status",
-                            "value",
-                        ].iloc[0]
-                        == "5"
-                    ):
-                        verified = 1
-                        db.run_insert_query(
-                            """UPDATE CRF_RedCap SET verified = %s WHERE id = %s""",
-                            [verified, str(crf_row["id"].iloc[0])],
-                        )
-                crf_id = crf_row["id"].iloc[0]
-                record_df["id_crf"] = crf_id
-
-                db_vars = db.run_select_query(
-                    """SELECT redcap_variable FROM CRF_Data_RedCap WHERE id_crf = %s""",
-                    [crf_id.item()],
+            elif (
+                record_df.empty and not crf_row.empty
+            ):  # deleted record in redcap in db
+                deleted = 1
+                db.run_insert_query(
+                    """UPDATE CRF_RedCap SET deleted = %s WHERE id = %s""",
+                    [deleted, str(crf_row["id"].iloc[0])],
                 )
-                db_vars = [v[0] for v in db_vars]
-                for _, row in record_df.iterrows():
-                    if row["redcap_variable"] in db_vars:
-                        db.run_insert_query(
-                            "UPDATE CRF_Data_RedCap SET value = %s WHERE id_crf = %s AND redcap_variable = %s",
-                            [row["value"], crf_id.item(), row["redcap_variable"]],
-                        )
-                    else:
-                        # this condition is from a previous method of inserting into the database only using logs.
-                        # The new(current 10/30/24) method initializes data into the data table with every value, the logs only used fields that were filled out.
-                        # after api initializations crf data, the data is only updated, not inserted. So existing crf data before this implementation will never
-                        # have their new values inserted, thus this else condition inserts the missing data
-                        db.run_insert_query(
-                            """INSERT INTO CRF_Data_RedCap (id_crf, value, redcap_variable) VALUES (%s, %s, %s)""",
-                            [crf_id.item(), row["value"], row["redcap_variable"]],
-                        )
-
-            elif crf_row.empty:  # insert
-                deleted = 0
-                verified = 0
-                if f"{crf_name}_status" in record_df["redcap_variable"].to_list():
-                    if (
-                        record_df.loc[
-                            record_df["redcap_variable"] == f"{crf_name}_status",
-                            "value",
-                        ].iloc[0]
-                        == "4"
-                        or record_df.loc[
-                            record_df["redcap_variable"] == f"{crf_name}_status",
-                            "value",
-                        ].iloc[0]
-                        == "5"
-                    ):
-                        verified = 1
-                crf_id = db.run_insert_query(
-                    """INSERT INTO CRF_RedCap (id_patient, crf_name, instance, deleted, verified)
-                                    VALUES (%s, %s, %s, %s, %s)""",
-                    [patient_id, crf_name, instance, deleted, verified],
-                )
-                record_df["id_crf"] = crf_id
 
-                # insert record df rows into CRF_Data_RedCap
-                utils.df_to_db_table(db, record_df, "CRF_Data_RedCap")
+            elif not record_df.empty:  # data to enter
+                # preprocess record_df for data insertion/update
+                irrelevant_columns = {
+                    "redcap_repeat_instrument",
+                    "redcap_event_name",
+                    "redcap_repeat_instance",
+                }
+                record_df = record_df.drop(irrelevant_columns, axis=1, errors="ignore")
+                record_df = record_df.melt(var_name="redcap_variable")
+                record_df.loc[
+                    record_df["redcap_variable"].str.contains("___"), "redcap_variable"
+                ] = record_df["redcap_variable"] + ")"
+                record_df.loc[
+                    record_df["redcap_variable"].str.contains("___"), "redcap_variable"
+                ] = record_df["redcap_variable"].str.replace("___", "(")
+
+                if not crf_row.empty:  # update
+                    if f"{crf_name}_status" in record_df["redcap_variable"].to_list():
+                        if (
+                            record_df.loc[
+                                record_df["redcap_variable"] == f"{crf_name}_status",
+                                "value",
+                            ].iloc[0]
+                            == "4"
+                            or record_df.loc[
+                                record_df["redcap_variable"] == f"{crf_name}_status",
+                                "value",
+                            ].iloc[0]
+                            == "5"
+                        ):
+                            verified = 1
+                            db.run_insert_query(
+                                """UPDATE CRF_RedCap SET verified = %s WHERE id = %s""",
+                                [verified, str(crf_row["id"].iloc[0])],
+                            )
+                    crf_id = crf_row["id"].iloc[0]
+                    record_df["id_crf"] = crf_id
+
+                    db_vars = db.run_select_query(
+                        """SELECT redcap_variable FROM CRF_Data_RedCap WHERE id_crf = %s""",
+                        [crf_id.item()],
+                    )
+                    db_vars = [v[0] for v in db_vars]
+                    for _, row in record_df.iterrows():
+                        if row["redcap_variable"] in db_vars:
+                            db.run_insert_query(
+                                "UPDATE CRF_Data_RedCap SET value = %s WHERE id_crf = %s AND redcap_variable = %s",
+                                [row["value"], crf_id.item(), row["redcap_variable"]],
+                            )
+                        else:
+                            # this condition is from a previous method of inserting into the database only using logs.
+                            # The new(current 10/30/24) method initializes data into the data table with every value, the logs only used fields that were filled out.
+                            # after api initializations crf data, the data is only updated, not inserted. So existing crf data before this implementation will never
+                            # have their new values inserted, thus this else condition inserts the missing data
+                            db.run_insert_query(
+                                """INSERT INTO CRF_Data_RedCap (id_crf, value, redcap_variable) VALUES (%s, %s, %s)""",
+                                [crf_id.item(), row["value"], row["redcap_variable"]],
+                            )
+
+                elif crf_row.empty:  # insert
+                    deleted = 0
+                    verified = 0
+                    if f"{crf_name}_status" in record_df["redcap_variable"].to_list():
+                        if (
+                            record_df.loc[
+                                record_df["redcap_variable"] == f"{crf_name}_status",
+                                "value",
+                            ].iloc[0]
+                            == "4"
+                            or record_df.loc[
+                                record_df["redcap_variable"] == f"{crf_name}_status",
+                                "value",
+                            ].iloc[0]
+                            == "5"
+                        ):
+                            verified = 1
+                    crf_id = db.run_insert_query(
+                        """INSERT INTO CRF_RedCap (id_patient, crf_name, instance, deleted, verified)
+                                        VALUES (%s, %s, %s, %s, %s)""",
+                        [patient_id, crf_name, instance, deleted, verified],
+                    )
+                    record_df["id_crf"] = crf_id
+
+                    # insert record df rows into CRF_Data_RedCap
+                    utils.df_to_db_table(db, record_df, "CRF_Data_RedCap")
 
     # After trying to add all the logs, if there are any logs with questions not attached
     # to a current crf (outdated variable), they will be printed to an error string
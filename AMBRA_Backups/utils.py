@@ -7,6 +7,23 @@ import os
 import shutil
 import pandas as pd
 import hashlib
+import sqlite3
+import tempfile
+import csv
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Size of the buffer used when hashing files.
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Approximate upper bound on the size of the values of a statement built by
+# df_to_db_table, well below the MySQL default max_allowed_packet.
+MAX_STATEMENT_BYTES = 4 * 1024 * 1024
+# Characters escaped in the files read by LOAD DATA, see _csv_value.
+LOAD_DATA_ESCAPES = str.maketrans(
+    {"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t", "\0": "\\0"}
+)
 
 
 # ------------------------------------------------------------------------------
@@ -45,20 +62,143 @@ def format_exception(
 
 
 # ------------------------------------------------------------------------------
-def hash_file(file_path):
+def stat_key(file_stat):
+    """
+    Returns the (size, mtime_ns, inode) tuple used to detect changed files.
+    """
+    return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+
+################################################################################
+class HashCache:
+    """
+    Persistent cache of file hashes stored in a SQLite database.
+
+    Entries are keyed by the absolute file path and the hash algorithm and
+    store the size, mtime_ns and inode of the file when it was hashed. A cached
+    hash is only returned if all of these still match the file, so a changed
+    file is hashed again automatically.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, cache_path=None):
+        """
+        Inputs:
+        --------
+        cache_path: str, Path, None
+            Path to the SQLite cache file. If None, ~/.ambra_hash_cache.sqlite
+            is used.
+        """
+        if cache_path is None:
+            cache_path = Path.home().joinpath(".ambra_hash_cache.sqlite")
+        self.cache_path = Path(cache_path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self.cache_path), check_same_thread=False
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                )"""
+            )
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        self._connection.close()
+
+    # --------------------------------------------------------------------------
+    def get(self, file_path, file_stat, algorithm):
+        """
+        Returns the cached hash of the file or None if it is not cached or the
+        file has changed since it was hashed.
+
+        file_stat: os.stat_result of the file.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                """SELECT size, mtime_ns, inode, digest FROM file_hashes
+                WHERE path=? AND algorithm=?""",
+                (str(Path(file_path).absolute()), algorithm),
+            ).fetchone()
+        if row is None:
+            return None
+        if tuple(row[0:3]) != stat_key(file_stat):
+            return None
+        return row[3]
+
+    # --------------------------------------------------------------------------
+    def set(self, file_path, file_stat, algorithm, digest):
+        """
+        Stores the hash of the file along with the stat values it was computed for.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """INSERT OR REPLACE INTO file_hashes
+                (path, algorithm, size, mtime_ns, inode, digest)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (str(Path(file_path).absolute()), algorithm)
+                + stat_key(file_stat)
+                + (digest,),
+            )
+
+
+# ------------------------------------------------------------------------------
+def hash_file(file_path, algorithm="md5", buffer_size=HASH_BUFFER_SIZE, cache=None):
     """
-    Returns the md5 hash of the file at file_path.
+    Returns the hex digest of the file at file_path.
+
+    The file is read in chunks of buffer_size bytes into a single reused buffer,
+    so memory use does not depend on the size of the file.
+
+    Inputs:
+    --------
+    file_path: str, Path
+        Path to the file to hash.
+
+    algorithm: str
+        Name of any algorithm supported by hashlib.new, e.g. 'md5' or 'sha256'.
+
+    buffer_size: int
+        Number of bytes read from the file at a time.
+
+    cache: HashCache, None
+        If not None, the cache is checked before reading the file and updated
+        with the new hash afterwards.
     """
     file_path = Path(file_path)
     if not file_path.is_file():
         raise Exception("Only files can be hashed.")
 
-    hasher = hashlib.md5()
-    with open(file_path, "rb") as fopen:
-        buf = fopen.read()
-        hasher.update(buf)
+    if cache is not None:
+        file_stat = file_path.stat()
+        digest = cache.get(file_path, file_stat, algorithm)
+        if digest is not None:
+            return digest
 
-    return hasher.hexdigest()
+    hasher = hashlib.new(algorithm)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as fopen:
+        while True:
+            n_read = fopen.readinto(buf)
+            if not n_read:
+                break
+            hasher.update(view[:n_read])
+    digest = hasher.hexdigest()
+
+    # Only cache the hash if the file did not change while it was being read.
+    if cache is not None and stat_key(file_path.stat()) == stat_key(file_stat):
+        cache.set(file_path, file_stat, algorithm, digest)
+
+    return digest
 
 
 # ------------------------------------------------------------------------------
@@ -83,6 +223,30 @@ def extract(zip_file):
     return extraction_directory
 
 
+# ------------------------------------------------------------------------------
+def is_zip_corrupt(zip_file):
+    """
+    Loads file using ZipFile, reads README.txt as additional
+    criteria after successful unzip. Returns True if the zip
+    file is corrupt and False if not.
+    """
+    zip_file = Path(zip_file)
+    if not zip_file.exists():
+        raise Exception("The zip file does not exist.")
+    try:
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            # Test reading a file from the zip
+            zip_ref.read("README.txt")
+            # If no exception is raised, the zip is likely not corrupt
+            return False
+    except zipfile.BadZipfile:
+        # If a BadZipFile exception is raised, the zip is corrupt
+        return True
+    except KeyError:
+        # Raised when the zip does not contain a README.txt file
+        return True
+
+
 # ------------------------------------------------------------------------------
 def convert_nifti(dicom_directory, output_directory):
     """
@@ -122,7 +286,55 @@ def convert_nifti(dicom_directory, output_directory):
 
 
 # ------------------------------------------------------------------------------
-def extract_and_convert(zip_file, output_directory, cleanup=False):
+def extract_to_scratch(zip_file, scratch_dir, max_bytes=None):
+    """
+    Extracts the contents of the zip_file into a new temporary directory inside
+    scratch_dir, e.g. /dev/shm or a local SSD, and returns its path.
+
+    Returns None without extracting anything if the uncompressed size of the
+    zip file is larger than max_bytes or than the free space in scratch_dir.
+
+    Inputs:
+    --------
+    zip_file: str, Path
+        Path to the zip file.
+    scratch_dir: str, Path
+        Directory in which the temporary extraction directory is created.
+    max_bytes: int, None
+        Maximum uncompressed size that may be extracted into scratch_dir.
+    """
+    zip_file = Path(zip_file)
+    scratch_dir = Path(scratch_dir)
+    assert zip_file.exists()
+
+    with zipfile.ZipFile(zip_file, "r") as zip:
+        uncompressed_size = sum(info.file_size for info in zip.infolist())
+        free_space = shutil.disk_usage(scratch_dir).free
+        if uncompressed_size > free_space or (
+            max_bytes is not None and uncompressed_size > max_bytes
+        ):
+            logging.info(
+                f"{zip_file} needs {uncompressed_size} bytes, more than is available in {scratch_dir}."
+            )
+            return None
+
+        extraction_directory = Path(
+            tempfile.mkdtemp(prefix=f"{zip_file.stem}_", dir=scratch_dir)
+        )
+        logging.info(f"Extracting zip file to {extraction_directory}")
+        try:
+            zip.extractall(path=extraction_directory)
+        except Exception:
+            shutil.rmtree(extraction_directory, ignore_errors=True)
+            raise
+
+    return extraction_directory
+
+
+# ------------------------------------------------------------------------------
+def extract_and_convert(
+    zip_file, output_directory, cleanup=False, scratch_dir=None, scratch_budget=None
+):
     """
     Extracts dicoms from the zip_file and converts them to nifti using dcm2nii.
 
@@ -132,7 +344,29 @@ def extract_and_convert(zip_file, output_directory, cleanup=False):
 
     cleanup: bool
         If True, the extracted data and directory will be deleted after nifti conversion.
+
+    scratch_dir: str, Path, None
+        If not None, the dicoms are extracted into a temporary directory in
+        scratch_dir instead of next to the zip_file, and that directory is always
+        removed after conversion. If the study does not fit in scratch_dir, it is
+        extracted next to the zip_file as usual.
+
+    scratch_budget: int, None
+        Maximum uncompressed size in bytes of a study extracted into scratch_dir.
     """
+    if scratch_dir is not None:
+        extraction_directory = extract_to_scratch(
+            zip_file, scratch_dir, max_bytes=scratch_budget
+        )
+        if extraction_directory is not None:
+            try:
+                convert_nifti(extraction_directory, output_directory)
+            finally:
+                logging.info(f"Removing {extraction_directory}.")
+                shutil.rmtree(extraction_directory, ignore_errors=True)
+            return
+        logging.info(f"Falling back to extracting {zip_file} next to the zip file.")
+
     extraction_directory = extract(zip_file)
     convert_nifti(extraction_directory, output_directory)
 
@@ -141,6 +375,127 @@ def extract_and_convert(zip_file, output_directory, cleanup=False):
         shutil.rmtree(extraction_directory)
 
 
+################################################################################
+class ConversionPool:
+    """
+    Runs extract_and_convert in a pool of worker processes so that nifti
+    conversion of one study overlaps with the download of the next.
+
+    Studies are queued with submit(), which blocks once max_pending conversions
+    are waiting so that downloads cannot run arbitrarily far ahead. The outcome
+    of every conversion is available from results() once close() has returned.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(
+        self,
+        n_workers=None,
+        max_pending=None,
+        scratch_dir=None,
+        scratch_budget=None,
+        convert=extract_and_convert,
+    ):
+        """
+        Inputs:
+        --------
+        n_workers: int, None
+            Number of dcm2niix conversions run at the same time. Defaults to the
+            number of CPUs.
+        max_pending: int, None
+            Maximum number of conversions queued or running before submit()
+            blocks. Defaults to twice n_workers.
+        scratch_dir, scratch_budget:
+            Passed to extract_and_convert for every conversion.
+        convert: function
+            Function run in the worker processes, called as
+            convert(zip_file, output_directory, cleanup=True, scratch_dir=...,
+            scratch_budget=...). Must be defined at module level so it can be
+            pickled.
+        """
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.convert = convert
+        # The pool is created from threaded code (downloads, logging, database
+        # pools, HashCache), so workers are spawned rather than forked to avoid
+        # inheriting locks held by other threads.
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * self.n_workers)
+        self._lock = threading.Lock()
+        self._results = []
+        self.scratch_dir = scratch_dir
+        self.scratch_budget = scratch_budget
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # --------------------------------------------------------------------------
+    def submit(self, zip_file, output_directory, key=None, callback=None):
+        """
+        Queues the conversion of zip_file into output_directory.
+
+        key: Identifier of the conversion included in its result, e.g. the study uuid.
+
+        callback: function, None
+            Called with the result dictionary when the conversion has finished.
+        """
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(
+                self.convert,
+                zip_file,
+                output_directory,
+                cleanup=True,
+                scratch_dir=self.scratch_dir,
+                scratch_budget=self.scratch_budget,
+            )
+        except Exception:
+            self._pending.release()
+            raise
+
+        def done(future):
+            self._pending.release()
+            error = future.exception()
+            result = {
+                "key": key,
+                "zip_file": zip_file,
+                "nifti_dir": output_directory,
+                "success": error is None,
+                "error": None if error is None else str(error),
+            }
+            if error is not None:
+                logging.error(f"Error converting {zip_file}: {error}")
+            with self._lock:
+                self._results.append(result)
+            if callback is not None:
+                callback(result)
+
+        future.add_done_callback(done)
+        return future
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Waits for all queued conversions to finish and shuts the pool down.
+        """
+        self._executor.shutdown(wait=True)
+
+    # --------------------------------------------------------------------------
+    def results(self):
+        """
+        Returns a list with one dictionary per finished conversion with the
+        keys 'key', 'zip_file', 'nifti_dir', 'success' and 'error'.
+        """
+        with self._lock:
+            return list(self._results)
+
+
 # ------------------------------------------------------------------------------
 def html_to_dataframe(html):
     """
@@ -178,22 +533,166 @@ def strip_ext(input):
 
 
 # ------------------------------------------------------------------------------
-def df_to_db_table(db, df, table_name):
+def _row_bytes(row):
+    """
+    Rough size in bytes of a row once rendered into an SQL statement.
+    """
+    return sum(len(str(value)) + 4 for value in row)
+
+
+# ------------------------------------------------------------------------------
+def iter_row_chunks(df, chunk_size=1000, max_chunk_bytes=MAX_STATEMENT_BYTES):
+    """
+    Yields the rows of df as lists of value lists holding at most chunk_size
+    rows and, unless a single row is larger, about max_chunk_bytes of data.
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = []
+        chunk_bytes = 0
+        for row in df.iloc[start : start + chunk_size].values.tolist():
+            row_bytes = _row_bytes(row)
+            if chunk and chunk_bytes + row_bytes > max_chunk_bytes:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if chunk:
+            yield chunk
+
+
+# ------------------------------------------------------------------------------
+def _csv_value(value):
+    """
+    Formats a value for LOAD DATA with '\\' as the escape character: NULL is
+    written as \\N, and backslashes and control characters in strings are
+    escaped so that a row always takes a single line.
+    """
+    if value is None or (not isinstance(value, (list, tuple)) and pd.isna(value)):
+        return "\\N"
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        return value.translate(LOAD_DATA_ESCAPES)
+    return value
+
+
+# ------------------------------------------------------------------------------
+def load_data_infile(db, df, table_name, chunk_size=10000):
+    """
+    Upserts the rows of df into table_name using LOAD DATA LOCAL INFILE.
+
+    The rows are streamed to a temporary CSV file, loaded into a temporary
+    table and then copied into table_name with the same ON DUPLICATE KEY UPDATE
+    as df_to_db_table. The load runs on its own connection, which only allows
+    local files from the temporary directory, and is committed on it before
+    returning. As it could not be rolled back with an open db.transaction(),
+    calling it inside one raises a RuntimeError.
+
+    Returns the id of the first inserted row.
+    """
+    if db.in_transaction():
+        raise RuntimeError(
+            "load_data_infile commits on its own connection and cannot run "
+            "inside db.transaction()"
+        )
+
+    columns = ", ".join(df.columns)
+    update_string = ", ".join(
+        [f"{column}=VALUES({column})" for column in df.columns[1:]]
+    )
+    staging_table = f"tmp_load_{table_name}"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_path = Path(temp_dir).joinpath(f"{table_name}.csv")
+        with open(csv_path, "w", newline="", encoding="utf-8") as fopen:
+            writer = csv.writer(fopen, lineterminator="\n")
+            for chunk in iter_row_chunks(df, chunk_size=chunk_size):
+                writer.writerows([[_csv_value(v) for v in row] for row in chunk])
+
+        connection = db.connect(
+            db.db_name,
+            config_path=db.config_path,
+            allow_local_infile_in_path=temp_dir,
+        )
+        try:
+            with connection.cursor() as cursor:
+                # No keys on the staging table so that, as with a single INSERT,
+                # the last of several rows with the same unique key wins.
+                cursor.execute(
+                    f"CREATE TEMPORARY TABLE {staging_table} "
+                    f"SELECT {columns} FROM {table_name} LIMIT 0"
+                )
+                cursor.execute(
+                    f"""LOAD DATA LOCAL INFILE %s
+                        INTO TABLE {staging_table}
+                        CHARACTER SET utf8mb4
+                        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                        ESCAPED BY '\\\\'
+                        LINES TERMINATED BY '\\n'
+                        ({columns})""",
+                    (str(csv_path),),
+                )
+                cursor.execute(
+                    f"""INSERT INTO {table_name} ({columns})
+                        SELECT {columns} FROM {staging_table}
+                        ON DUPLICATE KEY UPDATE {update_string}"""
+                )
+                row_id = cursor.lastrowid
+                cursor.execute(f"DROP TEMPORARY TABLE {staging_table}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    return row_id
+
+
+# ------------------------------------------------------------------------------
+def df_to_db_table(
+    db,
+    df,
+    table_name,
+    chunk_size=1000,
+    max_chunk_bytes=MAX_STATEMENT_BYTES,
+    load_data=False,
+):
     """
     inputs df rows into table. Table must exist and have the same columns as df
     Null entries to the table should be filled with None in the df
+
+    Rows are inserted with one INSERT ... ON DUPLICATE KEY UPDATE statement per
+    chunk of rows, all in a single db.transaction(), so large frames do not hit
+    max_allowed_packet. The table columns come from db.get_schema().
+
+    Inputs:
+    --------
+    db: Database
+    df: pandas.DataFrame
+        Rows to insert. The columns after the first one are updated when a row
+        with the same unique key already exists.
+    table_name: str
+    chunk_size: int
+        Maximum number of rows per statement.
+    max_chunk_bytes: int
+        Approximate maximum size of the values of a statement.
+    load_data: bool
+        If True, load the rows with LOAD DATA LOCAL INFILE instead, see
+        load_data_infile. The server must have local_infile enabled. Inside an
+        open db.transaction(), INSERT statements are still used so that the
+        rows are committed, or rolled back, with it.
+
+    Returns the id of the first inserted row.
     """
 
-    # if table not not in db, error
-    if table_name not in [table[0] for table in db.run_select_query("SHOW TABLES")]:
-        raise ValueError(f"Table {table_name} not in database")
+    # if table not not in db or columns not in table, error. Uses the schema
+    # cached by db, which is refreshed once if a column is missing.
+    db.check_columns(table_name, df.columns)
 
     # all df's columns must be in table
-    table_columns = [
-        col[0]
-        for col in db.run_select_query(f"SHOW COLUMNS FROM {table_name}")
-        if col[0] != "id"
-    ]
+    table_columns = [col for col in db.table_columns(table_name) if col != "id"]
     if not set(df.columns) <= set(table_columns):
         raise ValueError(f"""Columns in dataframe not in table {table_name}:
                          \ndf columns: \n{df.columns.to_list()}\n table columns: \n{table_columns}""")
@@ -204,25 +703,36 @@ def df_to_db_table(db, df, table_name):
     # if df.applymap(lambda x: isinstance(x, str) and "'" in x and "\\'" not in x).any().any():
     #     raise ValueError('Dataframe contains single quotes. Please remove them before inserting into database.')
 
+    if df.empty:
+        return None
+
+    if load_data and not db.in_transaction():
+        return load_data_infile(db, df, table_name)
+
     columns = df.columns.tolist()
     columns = "(" + ", ".join(columns) + ")"
-    values_string = ", ".join(
-        ["(" + ",".join(["%s"] * len(df.columns)) + ")"] * len(df)
-    )
+    row_string = "(" + ",".join(["%s"] * len(df.columns)) + ")"
     update_string = ", ".join(
         [f"{column}=VALUES({column})" for column in df.columns[1:]]
     )
-    values = df.values.tolist()
-    values = [item for sublist in values for item in sublist]
 
-    ret = db.run_insert_query(
-        f"""INSERT INTO {table_name} 
+    ret = None
+    with db.transaction():
+        for chunk in iter_row_chunks(
+            df, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes
+        ):
+            values_string = ", ".join([row_string] * len(chunk))
+            values = [item for row in chunk for item in row]
+            row_id = db.run_insert_query(
+                f"""INSERT INTO {table_name} 
                                       {columns} 
                                   VALUES 
                                       {values_string}
                                   ON DUPLICATE KEY UPDATE 
                                       {update_string}""",
-        values,
-    )
+                values,
+            )
+            if ret is None:
+                ret = row_id
 
     return ret
@@ -0,0 +1,69 @@
+"""
+Compares the CRF parsers of AMBRA_Backups.crfs on synthetic html CRFs.
+
+Prints the average time taken to parse a CRF and extract its values. The CRFs
+are made by test/crf_fixtures.py, and that the parsers extract the same values
+from them is tested in test/test_crfs.py.
+
+Usage:
+    python Developement/crf_parser_benchmark.py [--repeat N]
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+# The CRFs are generated by the fixtures of the tests, from the repository root.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from AMBRA_Backups import crfs  # noqa: E402
+from test.crf_fixtures import ADDITIONAL_FIELDS, make_crf  # noqa: E402
+
+PARSERS = ("html.parser", "lxml-bs4", crfs.FAST_PARSER)
+
+
+# ------------------------------------------------------------------------------
+def extract(html, parser):
+    if parser == "lxml-bs4":
+        # BeautifulSoup tree built by the lxml parser.
+        soup = BeautifulSoup(html, "lxml")
+    else:
+        soup = crfs.parse_html(html, parser=parser)
+    return {
+        "title": crfs.crf_title(None, soup),
+        "audit": crfs.attachment_audit(None, soup=soup),
+        "data": crfs.extract_crf_values(soup, additional_fields=ADDITIONAL_FIELDS),
+    }
+
+
+# ------------------------------------------------------------------------------
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--repeat", type=int, default=20)
+    args = arg_parser.parse_args()
+
+    fixtures = {
+        f"{n_spans} spans, {audit_style} audit": make_crf(
+            n_spans, audit_style=audit_style
+        )
+        for n_spans in (50, 300, 1000)
+        for audit_style in ("class", "token")
+    }
+
+    print(f"{'fixture':<26}" + "".join(f"{parser:>14}" for parser in PARSERS))
+    for name, html in fixtures.items():
+        timings = []
+        for parser in PARSERS:
+            start = perf_counter()
+            for _ in range(args.repeat):
+                extract(html, parser)
+            timings.append((perf_counter() - start) / args.repeat * 1000)
+        print(f"{name:<26}" + "".join(f"{timing:>11.2f} ms" for timing in timings))
+
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
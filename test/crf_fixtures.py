@@ -0,0 +1,62 @@
+"""
+Synthetic html CRFs, shared by test/test_crfs.py and
+Developement/crf_parser_benchmark.py so that the parser parity tests cover the
+same html that the parsers are timed on.
+"""
+
+ADDITIONAL_FIELDS = [
+    {"html_span_id": "reason", "tag": "span", "attrs": {"class": "reason"}}
+]
+
+
+# ------------------------------------------------------------------------------
+def make_crf(n_spans=12, audit_style="class", meta_charset=True):
+    """
+    Returns the html of a CRF written like the CRFs exported by Ambra, with
+    non-ASCII text, hidden spans and spans without a class.
+
+    Inputs:
+    --------
+    n_spans: int
+        Number of answer spans in the CRF.
+    audit_style: str
+        'class' for audit entries marked with report-audit-* classes, 'token'
+        for audit entries marked with data-i18n-token attributes.
+    meta_charset: bool
+        Whether the head declares the utf-8 charset.
+    """
+    rows = []
+    for index in range(n_spans):
+        html_class = "" if index % 3 == 0 else ' class="report-answer value"'
+        style = ' style="display:none"' if index % 4 == 0 else ""
+        rows.append(
+            f'<tr><td><label for="q{index}">Question {index} &amp; notes</label></td>'
+            f'<td><span id="question_{index}"{html_class}{style}>'
+            f"Réponse {index} café<br/><b>{index % 5}</b></span></td></tr>"
+        )
+    if audit_style == "class":
+        audit = "".join(
+            '<div class="report-audit-entry">'
+            f'<span class="report-audit-action">{action}</span> '
+            f'<span class="report-audit-user">Zoë {index}</span> '
+            f'<span class="report-audit-time">0{index + 1}-1{index}-2024 '
+            f"0{index + 1}:15:00 PM</span></div>"
+            for index, action in enumerate(["Created", "Signed", "Signed Addendum"])
+        )
+    else:
+        audit = "".join(
+            f'<div><span data-i18n-token="report-audit:{action.lower()}">'
+            f"{action}</span> by Zoë {index} at 0{index + 1}-1{index}-2024 "
+            f"0{index + 1}:15:00 PM</div>"
+            for index, action in enumerate(["Created", "Signed"])
+        )
+    meta = "<meta charset='utf-8'>" if meta_charset else ""
+    return (
+        f"<!DOCTYPE html><html><head>{meta}<title>CRF</title>"
+        "<style>span { color: black; }</style></head><body>"
+        '<h1><span data-i18n-token="report:title">Visite initiale</span></h1>'
+        f'<table class="report">{"".join(rows)}</table>'
+        f'<div class="report-audit">{audit}</div>'
+        '<p>Reason: <span class="reason" title="free text">déjà vu</span></p>'
+        "</body></html>"
+    )
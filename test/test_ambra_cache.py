@@ -0,0 +1,183 @@
+"""
+Tests for ambra_cache.AmbraCache
+"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from AMBRA_Backups.ambra_cache import AmbraCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Counter:
+    """
+    Fetch function returning a new value every time it is called.
+    """
+
+    def __init__(self, value="value"):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return f"{self.value}-{self.calls}"
+
+
+def make_study(uuid="study", updated="2024-01-01 00:00:00", n_series=2):
+    series = [
+        SimpleNamespace(series_uid=f"{uuid}.{index}") for index in range(n_series)
+    ]
+    for this_series in series:
+        this_series.get_tags = Counter(this_series.series_uid)
+    return SimpleNamespace(
+        uuid=uuid,
+        updated=updated,
+        get_series=lambda: iter(series),
+        get_study_tags=Counter(f"{uuid}-tags"),
+    )
+
+
+def test_hit_and_miss():
+    cache = AmbraCache(clock=Clock())
+    fetch = Counter()
+    assert cache.get("key", fetch) == "value-1"
+    assert cache.get("key", fetch) == "value-1"
+    assert fetch.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_expiry():
+    clock = Clock()
+    cache = AmbraCache(ttl=10, clock=clock)
+    fetch = Counter()
+    cache.get("key", fetch)
+
+    clock.now = 10
+    assert cache.get("key", fetch) == "value-1"
+    clock.now = 10.5
+    assert cache.get("key", fetch) == "value-2"
+    assert fetch.calls == 2
+
+
+def test_no_ttl():
+    clock = Clock()
+    cache = AmbraCache(ttl=None, clock=clock)
+    fetch = Counter()
+    cache.get("key", fetch)
+    clock.now = 10**9
+    assert cache.get("key", fetch) == "value-1"
+
+
+def test_lru_eviction():
+    cache = AmbraCache(max_size=2, clock=Clock())
+    fetches = {key: Counter(key) for key in "abc"}
+    cache.get("a", fetches["a"])
+    cache.get("b", fetches["b"])
+    # Using 'a' makes 'b' the least recently used entry.
+    cache.get("a", fetches["a"])
+    cache.get("c", fetches["c"])
+
+    cache.get("a", fetches["a"])
+    cache.get("c", fetches["c"])
+    assert fetches["a"].calls == 1
+    assert fetches["c"].calls == 1
+    cache.get("b", fetches["b"])
+    assert fetches["b"].calls == 2
+
+
+def test_errors_not_cached():
+    cache = AmbraCache(clock=Clock())
+
+    def fail():
+        raise RuntimeError("Ambra error")
+
+    with pytest.raises(RuntimeError):
+        cache.get("key", fail)
+    assert cache.get("key", Counter()) == "value-1"
+
+
+def test_study_entries_keyed_on_updated():
+    cache = AmbraCache(clock=Clock())
+    study = make_study()
+    assert cache.study_tags(study) == "study-tags-1"
+    assert cache.study_tags(study) == "study-tags-1"
+
+    study.updated = "2024-02-01 00:00:00"
+    assert cache.study_tags(study) == "study-tags-2"
+
+
+def test_invalidate():
+    cache = AmbraCache(clock=Clock())
+    study = make_study()
+    series = cache.series(study)
+    tags = [cache.series_tags(this_series) for this_series in series]
+    cache.study_tags(study)
+    other_study = make_study("other")
+    cache.study_tags(other_study)
+
+    cache.invalidate(study)
+
+    assert cache.study_tags(study) == "study-tags-2"
+    assert [cache.series_tags(this_series) for this_series in series] == [
+        tag.replace("-1", "-2") for tag in tags
+    ]
+    assert cache.study_tags(other_study) == "other-tags-1"
+
+
+def test_concurrent_requests_fetch_once():
+    cache = AmbraCache(clock=Clock())
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=10)
+        return "value"
+
+    results = []
+
+    def request():
+        results.append(cache.get("key", slow_fetch))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    threads[0].start()
+    assert started.wait(timeout=10)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results == ["value"] * 4
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_other_keys_not_blocked():
+    cache = AmbraCache(clock=Clock())
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        started.set()
+        release.wait(timeout=10)
+        return "slow"
+
+    thread = threading.Thread(target=cache.get, args=("slow", slow_fetch))
+    thread.start()
+    assert started.wait(timeout=10)
+    # A fetch for another key completes while 'slow' is being fetched.
+    assert cache.get("fast", Counter()) == "value-1"
+    release.set()
+    thread.join(timeout=10)
@@ -0,0 +1,241 @@
+"""
+Tests for backup
+"""
+
+import threading
+import time
+
+import pytest
+from ambra_sdk.exceptions.storage import NotFound
+
+from AMBRA_Backups import backup
+from AMBRA_Backups.journal import BackupJournal
+from AMBRA_Utils import Api
+
+
+class FakeStudy:
+    def __init__(self, uuid="study", error=None):
+        self.uuid = uuid
+        self.study_uid = f"1.2.{uuid}"
+        self.patient_name = "patient"
+        self.patientid = "id"
+        self.modality = "MR"
+        self.study_date = "20240101"
+        self.formatted_description = "brain"
+        self.created = "2024-01-01 00:00:00"
+        self.updated = "2024-01-01 00:00:00"
+        self.error = error
+
+    def download(self, zip_file, ignore_exists=False):
+        zip_file.write_bytes(b"partial")
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.mark.parametrize(
+    "error", [NotFound.__new__(NotFound), ConnectionError("connection reset")]
+)
+def test_failed_download_removes_part_file(tmp_path, error):
+    study = FakeStudy(error=error)
+    if isinstance(error, NotFound):
+        assert backup.backup_study(study, tmp_path, annotations=False) == (
+            None,
+            None,
+            None,
+        )
+    else:
+        with pytest.raises(ConnectionError):
+            backup.backup_study(study, tmp_path, annotations=False)
+
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == []
+
+
+class FakeNamespace(Api.Namespace):
+    """
+    Namespace listing n_studies studies, then raising list_error if set.
+    """
+
+    def __init__(self, name, n_studies, list_error=None):
+        self.name = name
+        self.uuid = name
+        self.studies = [FakeStudy(f"{name}-{index}") for index in range(n_studies)]
+        self.list_error = list_error
+
+    def get_studies(self):
+        yield from self.studies
+        if self.list_error is not None:
+            raise self.list_error
+
+    def __str__(self):
+        return self.name
+
+
+class Recorder:
+    """
+    Stands in for backup_study, recording the largest number of studies
+    backed up at the same time, overall and per namespace, and the order of
+    events.
+    """
+
+    def __init__(self, delay=0.02, fail=(), convert_fail=()):
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.fail = set(fail)
+        self.convert_fail = set(convert_fail)
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.max_total = 0
+        self.events = []
+
+    def __call__(self, study, backup_path, converter=None, **kwargs):
+        name = study.uuid.rsplit("-", 1)[0]
+        with self.lock:
+            self.in_flight[name] = self.in_flight.get(name, 0) + 1
+            self.max_in_flight[name] = max(
+                self.max_in_flight.get(name, 0), self.in_flight[name]
+            )
+            self.max_total = max(self.max_total, sum(self.in_flight.values()))
+            self.events.append(("started", study.uuid))
+        try:
+            time.sleep(self.delay)
+            if study.uuid in self.fail:
+                raise RuntimeError(f"Could not download {study.uuid}")
+            zip_file = backup_path.joinpath(f"{study.uuid}.zip")
+            if converter is not None:
+                converter.submit(
+                    zip_file,
+                    backup_path.joinpath(f"{study.uuid}_nii"),
+                    key=study.uuid,
+                    callback=lambda result: None,
+                )
+            return zip_file, None, None
+        finally:
+            with self.lock:
+                self.in_flight[name] -= 1
+
+
+class FakeConversionPool:
+    """
+    Stands in for utils.ConversionPool. Conversions only finish when the pool
+    is closed, after all downloads, and record their end in recorder.events.
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.submitted = []
+
+    def submit(self, zip_file, output_directory, key=None, callback=None):
+        self.submitted.append((key, output_directory, callback))
+
+    def close(self):
+        for key, output_directory, callback in self.submitted:
+            success = key not in self.recorder.convert_fail
+            self.recorder.events.append(("converted", key))
+            callback(
+                {
+                    "key": key,
+                    "zip_file": None,
+                    "nifti_dir": output_directory,
+                    "success": success,
+                    "error": None if success else "Conversion failed",
+                }
+            )
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = BackupJournal(tmp_path.joinpath("journal.jsonl"))
+    journal.start_run()
+    return journal
+
+
+def run_scheduler(monkeypatch, tmp_path, namespaces, recorder, **kwargs):
+    monkeypatch.setattr(backup, "backup_study", recorder)
+    scheduler = backup.BackupScheduler(tmp_path, progress_interval=0, **kwargs)
+    for namespace in namespaces:
+        scheduler.add_namespace(namespace)
+    return scheduler.run()
+
+
+def test_scheduler_caps(monkeypatch, tmp_path):
+    namespaces = [FakeNamespace(name, 8) for name in ("a", "b", "c")]
+    recorder = Recorder()
+    progress = run_scheduler(
+        monkeypatch, tmp_path, namespaces, recorder, n_workers=4, namespace_workers=2
+    )
+
+    assert recorder.max_total == 4
+    assert max(recorder.max_in_flight.values()) == 2
+    assert all(summary["downloaded"] == 8 for summary in progress.values())
+    # Round-robin dispatch starts every namespace within the first two rounds
+    # of downloads, instead of taking the studies of one namespace first.
+    first_started = [event[1].rsplit("-", 1)[0] for event in recorder.events[:8]]
+    assert set(first_started) == {"a", "b", "c"}
+
+
+def test_scheduler_listing_error(monkeypatch, tmp_path, journal):
+    failing = FakeNamespace("a", 3, list_error=ConnectionError("listing failed"))
+    other = FakeNamespace("b", 3)
+    recorder = Recorder(delay=0)
+    progress = run_scheduler(
+        monkeypatch, tmp_path, [failing, other], recorder, n_workers=2, journal=journal
+    )
+
+    assert progress["a"]["listed"] == 3
+    assert progress["a"]["downloaded"] == 3
+    assert progress["b"]["downloaded"] == 3
+    assert not journal.is_namespace_complete(failing)
+    assert journal.is_namespace_complete(other)
+
+
+def test_scheduler_failed_download(monkeypatch, tmp_path, journal):
+    namespaces = [FakeNamespace("a", 3), FakeNamespace("b", 3)]
+    recorder = Recorder(delay=0, fail={"a-1"})
+    progress = run_scheduler(
+        monkeypatch, tmp_path, namespaces, recorder, n_workers=2, journal=journal
+    )
+
+    assert progress["a"]["failed"] == 1
+    assert progress["a"]["downloaded"] == 2
+    assert not journal.is_namespace_complete(namespaces[0])
+    assert journal.is_namespace_complete(namespaces[1])
+
+
+def test_scheduler_completes_after_conversions(monkeypatch, tmp_path, journal):
+    namespaces = [FakeNamespace("a", 3), FakeNamespace("b", 3)]
+    recorder = Recorder(delay=0, convert_fail={"b-2"})
+    monkeypatch.setattr(
+        backup.utils, "ConversionPool", lambda **kwargs: FakeConversionPool(recorder)
+    )
+    set_namespace_complete = journal.set_namespace_complete
+
+    def record_complete(namespace):
+        recorder.events.append(("complete", namespace.uuid))
+        set_namespace_complete(namespace)
+
+    journal.set_namespace_complete = record_complete
+    progress = run_scheduler(
+        monkeypatch,
+        tmp_path,
+        namespaces,
+        recorder,
+        n_workers=2,
+        journal=journal,
+        convert=True,
+        convert_workers=1,
+    )
+
+    assert progress["a"]["converted"] == 3
+    assert progress["b"]["converted"] == 2
+    assert progress["b"]["conversion_failed"] == 1
+    # Namespace a is only complete once its last conversion has finished, and
+    # namespace b, with a failed conversion, not at all.
+    complete = recorder.events.index(("complete", "a"))
+    assert complete > max(
+        index
+        for index, event in enumerate(recorder.events)
+        if event[0] == "converted" and event[1].startswith("a-")
+    )
+    assert ("complete", "b") not in recorder.events
+    assert journal.is_namespace_complete(namespaces[0])
+    assert not journal.is_namespace_complete(namespaces[1])
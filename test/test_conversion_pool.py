@@ -0,0 +1,69 @@
+"""
+Tests for utils.ConversionPool
+"""
+
+import threading
+from pathlib import Path
+
+from AMBRA_Backups import utils
+
+
+def fake_convert(
+    zip_file, output_directory, cleanup=False, scratch_dir=None, scratch_budget=None
+):
+    """
+    Stands in for extract_and_convert in the worker processes.
+    """
+    if Path(zip_file).stem == "bad":
+        raise ValueError(f"Could not convert {zip_file}")
+    Path(output_directory).mkdir()
+    Path(output_directory).joinpath("image.nii.gz").write_text(str(zip_file))
+
+
+def run_conversions(pool, conversions):
+    callbacks = []
+    lock = threading.Lock()
+
+    def callback(result):
+        with lock:
+            callbacks.append(result)
+
+    with pool:
+        for key, (zip_file, output_directory) in conversions.items():
+            pool.submit(zip_file, output_directory, key=key, callback=callback)
+
+    return {result["key"]: result for result in callbacks}
+
+
+def test_conversion_and_callback(tmp_path):
+    pool = utils.ConversionPool(n_workers=2, convert=fake_convert)
+    conversions = {
+        "good": (tmp_path / "good.zip", tmp_path / "good_nii"),
+        "bad": (tmp_path / "bad.zip", tmp_path / "bad_nii"),
+    }
+    callbacks = run_conversions(pool, conversions)
+
+    assert callbacks["good"]["success"]
+    assert callbacks["good"]["error"] is None
+    assert callbacks["good"]["nifti_dir"] == tmp_path / "good_nii"
+    assert (tmp_path / "good_nii" / "image.nii.gz").read_text() == str(
+        tmp_path / "good.zip"
+    )
+
+    assert not callbacks["bad"]["success"]
+    assert "Could not convert" in callbacks["bad"]["error"]
+    assert not (tmp_path / "bad_nii").exists()
+
+    results = {result["key"]: result for result in pool.results()}
+    assert results == callbacks
+
+
+def test_corrupt_zip(tmp_path):
+    zip_file = tmp_path.joinpath("corrupt.zip")
+    zip_file.write_bytes(b"not a zip file")
+
+    pool = utils.ConversionPool(n_workers=1)
+    callbacks = run_conversions(pool, {"corrupt": (zip_file, tmp_path / "nii")})
+
+    assert not callbacks["corrupt"]["success"]
+    assert callbacks["corrupt"]["error"]
@@ -0,0 +1,651 @@
+"""
+Tests for crfs
+"""
+
+import copy
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import mysql.connector.errors as mysql_errors
+import pytest
+from mysql.connector import FieldType
+
+from AMBRA_Backups import crfs
+from AMBRA_Backups.Database.database import Database
+from test.crf_fixtures import ADDITIONAL_FIELDS, make_crf
+
+CRF_HTML = (
+    "<html><head><title>CRF</title></head><body>"
+    '<h1><span data-i18n-token="report:title">Baseline Visit</span></h1>'
+    '<table class="report">'
+    '<tr><td><span id="question_1" class="report-answer">Yes</span></td></tr>'
+    '<tr><td><span id="question_2" style="display:none">No</span></td></tr>'
+    "</table>"
+    '<div class="report-audit"><div class="report-audit-entry">'
+    '<span class="report-audit-action">Signed</span> '
+    '<span class="report-audit-user">User 1</span> '
+    '<span class="report-audit-time">01-15-2024 02:15:00 PM</span>'
+    "</div></div></body></html>"
+)
+
+
+PARSERS = [crfs.DEFAULT_PARSER, crfs.FAST_PARSER]
+
+
+def extract(html, parser):
+    soup = crfs.parse_html(html, parser=parser)
+    return {
+        "title": crfs.crf_title(None, soup),
+        "audit": crfs.attachment_audit(None, soup=soup),
+        "data": crfs.extract_crf_values(soup, additional_fields=ADDITIONAL_FIELDS),
+    }
+
+
+class FakeAttachment:
+    def __init__(self, html=CRF_HTML, uploaded=datetime(2024, 1, 15, 14, 30)):
+        self.id = 1
+        self.filename = "crf.html"
+        self.uploaded = uploaded
+        self.version = 1
+        self.phi_namespace = "namespace"
+        self.html = html
+        self.downloads = 0
+
+    def get_content(self):
+        self.downloads += 1
+        return self.html
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.inserted = []
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def insert_dict(self, record, table_name):
+        self.inserted.append((table_name, record))
+        return len(self.inserted)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """
+    Replaces the CRF_Data and data_added writes of add_html, returning the
+    list of data written.
+    """
+    written = []
+    monkeypatch.setattr(
+        crfs,
+        "insert_crf_data",
+        lambda database, id_crf, all_data: written.append(all_data),
+    )
+    monkeypatch.setattr(crfs, "set_data_added", lambda *args, **kwargs: None)
+    return written
+
+
+def test_parse_crf():
+    crf = crfs.parse_crf(FakeAttachment())
+    assert crf["title"] == "Baseline Visit"
+    assert crf["signed_by"] == "User 1"
+    assert crf["signed_date"] == datetime(2024, 1, 15, 14, 15)
+    assert {data["html_span_id"]: data["value"] for data in crf["data"]} == {
+        "question_1": "Yes",
+        "question_2": "No",
+    }
+
+
+def test_current_crf_is_not_downloaded(monkeypatch, written):
+    attachment = FakeAttachment()
+    monkeypatch.setattr(
+        crfs,
+        "crf_in_database",
+        lambda database, id_study, crf_id: (True, datetime(2024, 1, 15, 14, 30), True),
+    )
+    crfs.add_html(FakeDatabase(), attachment, id_study=1)
+    assert attachment.downloads == 0
+    assert written == []
+
+
+def test_new_crf_is_looked_up_and_parsed_once(monkeypatch, written):
+    attachment = FakeAttachment()
+    lookups = []
+
+    def crf_in_database(database, id_study, crf_id):
+        lookups.append(crf_id)
+        return False, None, False
+
+    monkeypatch.setattr(crfs, "crf_in_database", crf_in_database)
+    database = FakeDatabase()
+    crfs.add_html(database, attachment, id_study=1)
+
+    assert attachment.downloads == 1
+    assert lookups == [attachment.id]
+    assert database.inserted[0][1]["crf_name"] == "Baseline Visit"
+    assert [data["value"] for data in written[0]] == ["Yes", "No"]
+
+
+def test_crf_without_data_raises(monkeypatch, written):
+    attachment = FakeAttachment()
+    crf = crfs.parse_crf(attachment)
+    crf["data"] = None
+    database = FakeDatabase()
+    with pytest.raises(ValueError):
+        crfs.add_html(database, attachment, id_study=1, crf=crf)
+    assert database.inserted == []
+    assert attachment.downloads == 1
+
+
+@pytest.mark.parametrize("audit_style", ["class", "token"])
+@pytest.mark.parametrize("meta_charset", [True, False])
+@pytest.mark.parametrize("as_bytes", [False, True])
+def test_parser_parity(audit_style, meta_charset, as_bytes):
+    pytest.importorskip("lxml")
+    html = make_crf(audit_style=audit_style, meta_charset=meta_charset)
+    if as_bytes:
+        html = html.encode("utf-8")
+
+    results = [extract(html, parser) for parser in PARSERS]
+    assert results[0] == results[1]
+    assert crfs.is_lxml(crfs.parse_html(html, parser=crfs.FAST_PARSER))
+
+    result = results[0]
+    assert result["title"] == "Visite initiale"
+    assert result["audit"][-1]["Name"] == (
+        "Zoë 1" if audit_style == "token" else "Zoë 2"
+    )
+    values = {data["html_span_id"]: data["value"] for data in result["data"]}
+    assert values["question_1"].startswith("Réponse 1 café")
+    assert values["reason"] == "déjà vu"
+
+
+def test_xml_declaration():
+    pytest.importorskip("lxml")
+    html = '<?xml version="1.0" encoding="utf-8"?>' + make_crf(meta_charset=False)
+    for this_html in (html, html.encode("utf-8")):
+        assert extract(this_html, crfs.FAST_PARSER) == extract(
+            this_html, crfs.DEFAULT_PARSER
+        )
+
+
+class FakeConnection:
+    """
+    In-memory stand-in for a MySQL connection holding the studies, CRF and
+    CRF_Data tables. Changes are only kept by commit() and are undone by
+    rollback(). Statements containing fail_on raise an IntegrityError.
+    """
+
+    def __init__(self, studies=(), crf_rows=(), fail_on=None):
+        self.tables = {
+            "studies": [dict(row) for row in studies],
+            "CRF": [dict(row) for row in crf_rows],
+            "CRF_Data": {},
+        }
+        self.committed = copy.deepcopy(self.tables)
+        self.fail_on = fail_on
+        self.statements = []
+        # Number of statements run before each commit.
+        self.commits = []
+        self.rollbacks = 0
+
+    def cursor(self, buffered=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits.append(len(self.statements))
+        self.committed = copy.deepcopy(self.tables)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.tables = copy.deepcopy(self.committed)
+
+    def is_connected(self):
+        return True
+
+    def write_commits(self):
+        """
+        Returns the commits made after the first statement that is not a
+        SELECT, as numbers of statements run before them.
+        """
+        first_write = next(
+            (
+                index
+                for index, (query, _) in enumerate(self.statements)
+                if not query.startswith("SELECT")
+            ),
+            len(self.statements),
+        )
+        return [commit for commit in self.commits if commit > first_write]
+
+    def crf_row(self, id_study, crf_id, committed=False):
+        tables = self.committed if committed else self.tables
+        for row in tables["CRF"]:
+            if row["id_study"] == id_study and row["crf_id"] == str(crf_id):
+                return row
+        return None
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.description = []
+        self.lastrowid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def _result(self, columns, rows):
+        self.description = [(column, FieldType.VAR_STRING) for column in columns]
+        self.rows = rows
+
+    def execute(self, query, params=()):
+        connection = self.connection
+        tables = connection.tables
+        query = " ".join(query.split())
+        params = list(params)
+        assert query.count("%s") == len(params), query
+        connection.statements.append((query, params))
+        if connection.fail_on is not None and connection.fail_on in query:
+            raise mysql_errors.IntegrityError(msg=f"Failed: {query}")
+
+        if query.startswith("SELECT * FROM CRF WHERE"):
+            row = connection.crf_row(*params)
+            columns = ["id", "id_study", "crf_id", "uploaded", "data_added"]
+            self._result(columns, [] if row is None else [[row[c] for c in columns]])
+        elif query.startswith("SELECT id FROM studies WHERE"):
+            ids = [
+                (study["id"],)
+                for study in tables["studies"]
+                if study["study_uid"] == params[0]
+            ]
+            self._result(["id"], ids)
+        elif query.startswith("SELECT id FROM CRF WHERE"):
+            self._result(["id"], [(connection.crf_row(*params)["id"],)])
+        elif query.startswith("SELECT studies.study_uid"):
+            rows = []
+            for study in tables["studies"]:
+                if study["phi_namespace"] != params[0]:
+                    continue
+                these_crfs = [
+                    (row["crf_id"], row["uploaded"], row["data_added"])
+                    for row in tables["CRF"]
+                    if row["id_study"] == study["id"]
+                ]
+                for crf in these_crfs or [(None, None, None)]:
+                    rows.append((study["study_uid"], study["id"], *crf))
+            columns = ["study_uid", "id", "crf_id", "uploaded", "data_added"]
+            self._result(columns, rows)
+        elif query.startswith("INSERT INTO CRF_Data"):
+            for start in range(0, len(params), 5):
+                id_crf, value, html_class, html_style, span_id = params[
+                    start : start + 5
+                ]
+                tables["CRF_Data"][(id_crf, span_id)] = value
+        elif query.startswith("INSERT INTO CRF "):
+            columns = re.search(r"\((.*?)\)", query).group(1).split(",")
+            row = dict(zip([column.strip() for column in columns], params))
+            row["crf_id"] = str(row["crf_id"])
+            row["id"] = len(tables["CRF"]) + 1
+            tables["CRF"].append(row)
+            self.lastrowid = row["id"]
+        elif query.startswith("UPDATE CRF SET data_added"):
+            connection.crf_row(params[1], params[2])["data_added"] = params[0]
+        elif query.startswith("UPDATE CRF SET"):
+            id_crf = int(re.search(r"WHERE id='(\d+)'", query).group(1))
+            columns = re.findall(r"(\w+)=%s", query)
+            row = next(row for row in tables["CRF"] if row["id"] == id_crf)
+            row.update(zip(columns, params))
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+
+CRF_COLUMNS = [
+    "id",
+    "id_study",
+    "crf_name",
+    "file_type",
+    "file_name",
+    "signed_by",
+    "signed_date",
+    "uploaded",
+    "crf_id",
+    "version",
+    "phi_namespace",
+    "data_added",
+]
+
+
+def make_database(connection):
+    """
+    Returns a Database using connection, with the schema of the CRF table.
+    """
+    database = Database.__new__(Database)
+    database.db_name = "crf_test"
+    database.config_path = None
+    database.n_retries = 0
+    database.pool_timeout = 1
+    database._local = threading.local()
+    database._pool = None
+    database._connection = connection
+    database.hash_cache = None
+    database.ambra_cache = None
+    database._schema = {
+        "CRF": {
+            "columns": [(column,) for column in CRF_COLUMNS],
+            "unique_keys": {"PRIMARY": ["id"]},
+        }
+    }
+    database._schema_generation = Database._schema_generations.get("crf_test", 0)
+    database._schema_lock = threading.Lock()
+    return database
+
+
+def span_data(n_values, value="value"):
+    return [
+        {
+            "value": f"{value} {index}",
+            "html_class": "report-answer",
+            "html_style": None,
+            "html_span_id": f"question_{index}",
+        }
+        for index in range(n_values)
+    ]
+
+
+def test_insert_crf_data_chunks():
+    connection = FakeConnection()
+    database = make_database(connection)
+    crfs.insert_crf_data(database, 1, span_data(7), chunk_size=3)
+
+    inserts = [params for query, params in connection.statements if "CRF_Data" in query]
+    assert [len(params) for params in inserts] == [15, 15, 5]
+    assert connection.tables["CRF_Data"] == {
+        (1, f"question_{index}"): f"value {index}" for index in range(7)
+    }
+
+
+def test_insert_crf_data_truncates_long_values():
+    connection = FakeConnection()
+    database = make_database(connection)
+    long_value = "a" * 100 + "b" * 1024
+    data = span_data(1)
+    data[0]["value"] = long_value
+    crfs.insert_crf_data(database, 1, data)
+    assert connection.tables["CRF_Data"][(1, "question_0")] == "b" * 1024
+
+
+def test_add_html_writes_in_one_transaction():
+    connection = FakeConnection()
+    database = make_database(connection)
+    attachment = FakeAttachment()
+    crfs.add_html(database, attachment, id_study=1)
+
+    row = connection.crf_row(1, attachment.id, committed=True)
+    assert row["crf_name"] == "Baseline Visit"
+    assert row["data_added"] is True
+    assert len(connection.committed["CRF_Data"]) == 2
+    assert connection.write_commits() == [len(connection.statements)]
+
+
+def test_failed_insert_rolls_back_new_crf():
+    connection = FakeConnection(fail_on="INSERT INTO CRF_Data")
+    database = make_database(connection)
+    attachment = FakeAttachment()
+    with pytest.raises(mysql_errors.IntegrityError):
+        crfs.add_html(database, attachment, id_study=1)
+
+    assert connection.rollbacks == 1
+    assert connection.write_commits() == []
+    assert connection.crf_row(1, attachment.id) is None
+    assert connection.tables["CRF_Data"] == {}
+
+
+def test_failed_insert_rolls_back_reuploaded_crf():
+    uploaded = datetime(2024, 1, 1)
+    connection = FakeConnection(
+        crf_rows=[
+            {
+                "id": 1,
+                "id_study": 1,
+                "crf_id": "1",
+                "crf_name": "Old title",
+                "uploaded": uploaded,
+                "data_added": True,
+            }
+        ],
+        fail_on="INSERT INTO CRF_Data",
+    )
+    database = make_database(connection)
+    with pytest.raises(mysql_errors.IntegrityError):
+        crfs.add_html(database, FakeAttachment(), id_study=1)
+
+    row = connection.crf_row(1, 1)
+    assert row["data_added"] is True
+    assert row["uploaded"] == uploaded
+    assert row["crf_name"] == "Old title"
+
+
+class FakeStudy:
+    """
+    Study whose attachments are a CRF and a pdf, recording when they are
+    listed in tracker.
+    """
+
+    def __init__(self, index, tracker, delay=0, error=None, attachment_error=None):
+        self.study_uid = f"1.2.{index}"
+        self.tracker = tracker
+        self.delay = delay
+        self.error = error
+        crf = FakeAttachment()
+        crf.id = index
+        crf.filename = f"crf_{index}.html"
+        if attachment_error is not None:
+
+            def get_content():
+                raise attachment_error
+
+            crf.get_content = get_content
+        pdf = FakeAttachment()
+        pdf.filename = f"report_{index}.pdf"
+        self.attachments = [crf, pdf]
+
+    def get_attachments(self):
+        self.tracker.listed(self)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.attachments
+
+
+class Tracker:
+    """
+    Records the studies listed and written by backup_studies and the largest
+    number of studies listed but not written yet.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listed_studies = []
+        self.written = []
+        self.max_outstanding = 0
+
+    def listed(self, study):
+        with self.lock:
+            self.listed_studies.append(study.study_uid)
+            outstanding = len(self.listed_studies) - len(self.written)
+            self.max_outstanding = max(self.max_outstanding, outstanding)
+
+    def wrote(self, study, fetched):
+        with self.lock:
+            self.written.append(
+                (
+                    study.study_uid,
+                    [attachment.filename for attachment, _, _ in fetched],
+                    threading.current_thread() is threading.main_thread(),
+                )
+            )
+
+
+@pytest.mark.parametrize("n_workers", [0, 3])
+def test_backup_studies(monkeypatch, n_workers):
+    tracker = Tracker()
+    studies = [
+        FakeStudy(
+            index,
+            tracker,
+            # Earlier studies take longer, so they finish out of order.
+            delay=0.02 * (5 - index) if n_workers and index < 5 else 0,
+            error=RuntimeError("listing failed") if index == 7 else None,
+            attachment_error=ValueError("no content") if index == 5 else None,
+        )
+        for index in range(8)
+    ]
+    original_write = crfs.write_study_crfs
+
+    def write_study_crfs(database, study, fetched):
+        tracker.wrote(study, fetched)
+        return original_write(database, study, fetched)
+
+    added = []
+    monkeypatch.setattr(crfs, "write_study_crfs", write_study_crfs)
+    monkeypatch.setattr(
+        crfs,
+        "add_html",
+        lambda database, attachment, id_study, crf=None: added.append(
+            (id_study, crf["title"])
+        ),
+    )
+    database = type("FakeDatabase", (), {"get_study_by_uid": lambda self, uid: uid})()
+
+    errors = crfs.backup_studies(
+        database, iter(studies), n_workers=n_workers, max_pending=3
+    )
+
+    assert [(error["study_uid"], error["attachment"]) for error in errors] == [
+        ("1.2.5", "crf_5.html"),
+        ("1.2.7", None),
+    ]
+    assert errors[0]["error"].startswith("GetContentError")
+    assert errors[1]["error"].startswith("GetAttachmentsError")
+    assert isinstance(errors[1]["exception"].__cause__, RuntimeError)
+
+    # The last study fails to be listed, so that every study listed before it
+    # is written and counted as no longer outstanding.
+    expected = [f"1.2.{index}" for index in range(7)]
+    assert [study_uid for study_uid, _, _ in tracker.written] == expected
+    assert all(main_thread for _, _, main_thread in tracker.written)
+    assert all(
+        filenames == [f"crf_{study_uid[4:]}.html"]
+        for study_uid, filenames, _ in tracker.written
+    )
+    assert added == [
+        (study_uid, "Baseline Visit") for study_uid in expected if study_uid != "1.2.5"
+    ]
+    assert tracker.max_outstanding == (3 if n_workers else 1)
+
+
+UPLOADED = datetime(2024, 1, 15, 14, 30)
+
+
+def crf_row(id_crf, id_study, uploaded=UPLOADED, data_added=True):
+    return {
+        "id": id_crf,
+        "id_study": id_study,
+        "crf_id": str(id_study - 1),
+        "crf_name": "Baseline Visit",
+        "uploaded": uploaded,
+        "data_added": data_added,
+    }
+
+
+def namespace_connection():
+    """
+    Returns a FakeConnection where, for the CRF of study index i with id
+    i + 1 and crf_id 'i':
+        0: is up to date
+        1: has been uploaded again since it was added
+        2: has not had its data added
+        3: is in another namespace
+    """
+    studies = [
+        {"id": index + 1, "study_uid": f"1.2.{index}", "phi_namespace": "namespace"}
+        for index in range(3)
+    ]
+    studies.append({"id": 4, "study_uid": "1.2.3", "phi_namespace": "other"})
+    studies.append({"id": 5, "study_uid": "1.2.4", "phi_namespace": "namespace"})
+    return FakeConnection(
+        studies=studies,
+        crf_rows=[
+            crf_row(1, 1),
+            crf_row(2, 2, uploaded=datetime(2024, 1, 1)),
+            crf_row(3, 3, data_added=False),
+            crf_row(4, 4),
+        ],
+    )
+
+
+def test_namespace_crf_status():
+    database = make_database(namespace_connection())
+    study_ids, crf_status = crfs.namespace_crf_status(database, "namespace")
+
+    # Studies without CRFs are in the map, studies of other namespaces not.
+    assert study_ids == {"1.2.0": 1, "1.2.1": 2, "1.2.2": 3, "1.2.4": 5}
+    assert crf_status == {
+        (1, "0"): (UPLOADED, True),
+        (2, "1"): (datetime(2024, 1, 1), True),
+        (3, "2"): (UPLOADED, False),
+    }
+
+
+def test_crf_is_current():
+    database = make_database(namespace_connection())
+    _, crf_status = crfs.namespace_crf_status(database, "namespace")
+    attachment = FakeAttachment(uploaded=UPLOADED.replace(microsecond=123456))
+
+    # The integer attachment id matches the varchar crf_id.
+    attachment.id = 0
+    assert crfs.crf_is_current(crf_status, 1, attachment)
+    attachment.id = 1
+    assert not crfs.crf_is_current(crf_status, 2, attachment)
+    attachment.id = 2
+    assert not crfs.crf_is_current(crf_status, 3, attachment)
+    attachment.id = 4
+    assert not crfs.crf_is_current(crf_status, 5, attachment)
+
+
+def test_backup_studies_skips_current_crfs():
+    connection = namespace_connection()
+    database = make_database(connection)
+    crf_status = crfs.namespace_crf_status(database, "namespace")
+
+    tracker = Tracker()
+    studies = [FakeStudy(index, tracker) for index in range(4)]
+    for study in studies:
+        study.attachments[0].uploaded = UPLOADED.replace(microsecond=123456)
+
+    errors = crfs.backup_studies(database, studies, crf_status=crf_status)
+
+    assert errors == []
+    assert [study.attachments[0].downloads for study in studies] == [0, 1, 1, 1]
+    rows = [connection.crf_row(index + 1, index, committed=True) for index in range(4)]
+    assert all(row["data_added"] is True for row in rows)
+    # Only the CRF uploaded again has its row updated.
+    assert rows[1]["uploaded"] == UPLOADED.replace(microsecond=123456)
+    assert rows[2]["uploaded"] == UPLOADED
+    # The CRF of the study missing from the map is downloaded, but add_html
+    # finds it up to date and does not write its data again.
+    assert {id_crf for id_crf, _ in connection.committed["CRF_Data"]} == {2, 3}
@@ -0,0 +1,142 @@
+"""
+Tests for Database.query_to_parquet and Database.query_to_dataframe(arrow=True)
+"""
+
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from mysql.connector import FieldFlag, FieldType
+
+from AMBRA_Backups.Database.database import Database, arrow_type
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def column(name, field_type, flags=0, charset=45):
+    """
+    Returns a cursor.description entry as mysql.connector builds it.
+    """
+    return (name, field_type, None, None, None, None, 1, flags, charset)
+
+
+class FakeCursor:
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = list(rows)
+
+    def execute(self, query, record=None):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+
+    def cursor(self, buffered=None):
+        return self._cursor
+
+    def close(self):
+        self.closed = True
+
+
+def make_database(description, rows):
+    """
+    Returns a Database whose connections run queries on a FakeCursor.
+    """
+    connection = FakeConnection(FakeCursor(description, rows))
+    database = Database.__new__(Database)
+    database.db_name = "test"
+    database.config_path = None
+    database.connect = lambda *args, **kwargs: connection
+    return database, connection
+
+
+def test_decimal_precision_grows(tmp_path):
+    description = [column("value", FieldType.NEWDECIMAL)]
+    rows = [(Decimal("1.23"),), (Decimal("12345.6789"),), (None,)]
+    database, connection = make_database(description, rows)
+
+    parquet_path = tmp_path.joinpath("export.parquet")
+    assert database.query_to_parquet("SELECT", parquet_path, batch_size=1) == 3
+    assert connection.closed
+
+    table = pq.read_table(parquet_path)
+    assert pa.types.is_decimal(table.schema.field("value").type)
+    assert table.column("value").to_pylist() == [
+        Decimal("1.23"),
+        Decimal("12345.6789"),
+        None,
+    ]
+
+
+def test_null_first_batch(tmp_path):
+    description = [
+        column("id_study", FieldType.LONGLONG),
+        column("study_date", FieldType.DATETIME),
+        column("duration", FieldType.TIME),
+        column("tags", FieldType.JSON),
+        column("notes", FieldType.BLOB, flags=FieldFlag.BLOB),
+        column(
+            "data",
+            FieldType.BLOB,
+            flags=FieldFlag.BLOB | FieldFlag.BINARY,
+            charset=63,
+        ),
+    ]
+    rows = [
+        (None, None, None, None, None, None),
+        (1, None, timedelta(hours=1), '{"a": 1}', "text", b"\x00\x01"),
+    ]
+    database, _ = make_database(description, rows)
+
+    parquet_path = tmp_path.joinpath("export.parquet")
+    assert database.query_to_parquet("SELECT", parquet_path, batch_size=1) == 2
+
+    table = pq.read_table(parquet_path)
+    assert table.schema.types == [
+        pa.int64(),
+        pa.timestamp("us"),
+        pa.duration("us"),
+        pa.string(),
+        pa.string(),
+        pa.binary(),
+    ]
+    assert table.to_pylist()[1] == {
+        "id_study": 1,
+        "study_date": None,
+        "duration": timedelta(hours=1),
+        "tags": '{"a": 1}',
+        "notes": "text",
+        "data": b"\x00\x01",
+    }
+
+
+def test_empty_result(tmp_path):
+    description = [column("id_study", FieldType.LONG), column("value", FieldType.SET)]
+    database, _ = make_database(description, [])
+
+    parquet_path = tmp_path.joinpath("export.parquet")
+    assert database.query_to_parquet("SELECT", parquet_path) == 0
+    table = pq.read_table(parquet_path)
+    assert table.num_rows == 0
+    assert table.column_names == ["id_study", "value"]
+
+
+def test_arrow_type_uses_reported_precision():
+    description = ("value", FieldType.NEWDECIMAL, None, None, 10, 2, 1, 0, 63)
+    assert arrow_type(description) == pa.decimal128(10, 2)
+    unsigned = column("id", FieldType.LONGLONG, flags=FieldFlag.UNSIGNED)
+    assert arrow_type(unsigned) == pa.uint64()
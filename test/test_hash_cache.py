@@ -0,0 +1,81 @@
+"""
+Tests for utils.HashCache and utils.hash_file
+"""
+
+import hashlib
+import os
+
+import pytest
+
+from AMBRA_Backups import utils
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = utils.HashCache(tmp_path.joinpath("hashes.sqlite"))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data_file = tmp_path.joinpath("data.bin")
+    data_file.write_bytes(b"first content")
+    return data_file
+
+
+def test_hit(cache, data_file):
+    digest = utils.hash_file(data_file, cache=cache)
+    assert digest == hashlib.md5(b"first content").hexdigest()
+    assert cache.get(data_file, data_file.stat(), "md5") == digest
+
+    # A cached digest is returned without reading the file.
+    cache.set(data_file, data_file.stat(), "md5", "cached")
+    assert utils.hash_file(data_file, cache=cache) == "cached"
+
+
+def test_invalidated_by_rewrite(cache, data_file):
+    utils.hash_file(data_file, cache=cache)
+    old_stat = data_file.stat()
+
+    data_file.write_bytes(b"second, longer content")
+    os.utime(data_file, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns + 10**9))
+
+    assert cache.get(data_file, data_file.stat(), "md5") is None
+    assert (
+        utils.hash_file(data_file, cache=cache)
+        == hashlib.md5(b"second, longer content").hexdigest()
+    )
+
+
+def test_same_size_rewrite(cache, data_file):
+    utils.hash_file(data_file, cache=cache)
+    old_stat = data_file.stat()
+
+    data_file.write_bytes(b"other content")
+    os.utime(data_file, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns + 10**9))
+
+    assert utils.hash_file(data_file, cache=cache) == (
+        hashlib.md5(b"other content").hexdigest()
+    )
+
+
+def test_algorithm_is_part_of_key(cache, data_file):
+    md5 = utils.hash_file(data_file, algorithm="md5", cache=cache)
+    sha256 = utils.hash_file(data_file, algorithm="sha256", cache=cache)
+
+    assert md5 == hashlib.md5(b"first content").hexdigest()
+    assert sha256 == hashlib.sha256(b"first content").hexdigest()
+    assert cache.get(data_file, data_file.stat(), "md5") == md5
+    assert cache.get(data_file, data_file.stat(), "sha256") == sha256
+
+
+def test_persistent(tmp_path, data_file):
+    cache_path = tmp_path.joinpath("hashes.sqlite")
+    cache = utils.HashCache(cache_path)
+    digest = utils.hash_file(data_file, cache=cache)
+    cache.close()
+
+    cache = utils.HashCache(cache_path)
+    assert cache.get(data_file, data_file.stat(), "md5") == digest
+    cache.close()
@@ -0,0 +1,102 @@
+"""
+Tests for the backup journal
+"""
+
+from types import SimpleNamespace
+
+from AMBRA_Backups.journal import BackupJournal
+
+
+def make_study(uuid, updated="2024-01-01 00:00:00"):
+    return SimpleNamespace(uuid=uuid, updated=updated)
+
+
+def test_resume_unfinished_run(tmp_path):
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    journal = BackupJournal(journal_path)
+    run_id = journal.start_run()
+    journal.set_state(make_study("a"), "queued")
+    journal.set_state(make_study("a"), "verified", zip_file=tmp_path / "a.zip")
+    journal.set_state(make_study("b"), "downloading")
+
+    journal = BackupJournal(journal_path)
+    assert journal.start_run() == run_id
+    assert journal.is_complete(make_study("a"))
+    assert journal.get_record(make_study("a"))["zip_file"] == str(tmp_path / "a.zip")
+    assert not journal.is_complete(make_study("b"))
+    assert not journal.is_complete(make_study("a"), convert=True)
+    # A study updated on Ambra since it was journaled is not complete.
+    assert not journal.is_complete(make_study("a", updated="2024-02-01 00:00:00"))
+
+
+def test_finished_run_starts_new_run(tmp_path):
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    journal = BackupJournal(journal_path)
+    run_id = journal.start_run()
+    journal.finish_run()
+
+    journal = BackupJournal(journal_path)
+    assert journal.start_run() != run_id
+
+
+def test_namespace_completion(tmp_path):
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    namespace = SimpleNamespace(uuid="namespace")
+    journal = BackupJournal(journal_path)
+    journal.start_run()
+    assert not journal.is_namespace_complete(namespace)
+    journal.set_namespace_complete(namespace)
+    assert journal.is_namespace_complete(namespace)
+
+    # Still complete when the unfinished run is resumed.
+    journal = BackupJournal(journal_path)
+    journal.start_run()
+    assert journal.is_namespace_complete(namespace)
+
+    # But not in the next run.
+    journal.finish_run()
+    journal = BackupJournal(journal_path)
+    journal.start_run()
+    assert not journal.is_namespace_complete(namespace)
+
+
+def test_truncated_last_line(tmp_path):
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    journal = BackupJournal(journal_path)
+    journal.start_run()
+    journal.set_state(make_study("a"), "verified")
+    with open(journal_path, "a") as fopen:
+        fopen.write('{"run": "1", "uuid": "b", "sta')
+
+    journal = BackupJournal(journal_path)
+    assert journal.is_complete(make_study("a"))
+    assert journal.get_record(make_study("b")) is None
+
+    # Entries written after the crash survive the next replay.
+    run_id = journal.start_run()
+    journal.set_state(make_study("c"), "verified")
+    journal = BackupJournal(journal_path)
+    assert journal.start_run() == run_id
+    assert journal.is_complete(make_study("a"))
+    assert journal.is_complete(make_study("c"))
+    assert all(
+        line.startswith("{") and line.endswith("}")
+        for line in journal_path.read_text().splitlines()
+    )
+
+
+def test_finish_run_compacts(tmp_path):
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    for _ in range(3):
+        journal = BackupJournal(journal_path)
+        journal.start_run()
+        for state in ("queued", "downloading", "downloaded", "verified"):
+            journal.set_state(make_study("a"), state, zip_file="a.zip")
+        journal.finish_run()
+
+    lines = journal_path.read_text().splitlines()
+    assert len(lines) == 3
+
+    journal = BackupJournal(journal_path)
+    assert journal.is_complete(make_study("a"))
+    assert journal.get_record(make_study("a"))["zip_file"] == "a.zip"
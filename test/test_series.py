@@ -0,0 +1,162 @@
+"""
+Tests for Database.insert_series_bulk and study_updated_datetime
+"""
+
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from AMBRA_Backups.Database.database import (
+    IMG_SERIES_COLUMNS,
+    Database,
+    study_updated_datetime,
+)
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self, buffered=None):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=()):
+        assert query.count("%s") == len(params), query
+        self.connection.statements.append((query, list(params)))
+
+
+def make_database():
+    connection = RecordingConnection()
+    database = Database.__new__(Database)
+    database.db_name = "series_test"
+    database.n_retries = 0
+    database._local = threading.local()
+    database._pool = None
+    database._connection = connection
+    database.ambra_cache = None
+    return database, connection
+
+
+def make_series(index, description="T1 MPRAGE", error=None):
+    def get_tags(level):
+        if error is not None:
+            raise error
+        return {
+            "tags": [
+                {"group": 0x0020, "element": 0x0011, "value": str(index)},
+                {"group": 0x0018, "element": 0x0080, "value": "2300"},
+            ]
+        }
+
+    return SimpleNamespace(
+        series_uid=f"1.2.{index}",
+        formatted_description=description,
+        count=100 + index,
+        study=SimpleNamespace(study_uid="1.2"),
+        get_tags=get_tags,
+    )
+
+
+def test_insert_series_bulk():
+    database, connection = make_database()
+    series_list = [
+        make_series(0),
+        make_series(1, error=LookupError("no tags")),
+        make_series(2, description="FLAIR"),
+        make_series(3),
+    ]
+    failed = database.insert_series_bulk(
+        series_list, id_study=7, series_exceptions=(LookupError,)
+    )
+
+    assert [series.series_uid for series, _ in failed] == ["1.2.1"]
+    (series_query, values), (_, descriptions) = connection.statements
+    assert series_query.startswith(
+        f"INSERT IGNORE INTO img_series (id_study, {', '.join(IMG_SERIES_COLUMNS)})"
+    )
+    n_columns = len(IMG_SERIES_COLUMNS) + 1
+    rows = [
+        values[start : start + n_columns] for start in range(0, len(values), n_columns)
+    ]
+    assert len(rows) == 3
+    records = [dict(zip(("id_study",) + IMG_SERIES_COLUMNS, row)) for row in rows]
+    assert [record["id_study"] for record in records] == [7, 7, 7]
+    assert [record["series_number"] for record in records] == ["0", "2", "3"]
+    assert [record["series_uid"] for record in records] == ["1.2.0", "1.2.2", "1.2.3"]
+    assert records[0]["TR"] == "2300"
+    assert records[0]["TE"] is None
+    assert records[0]["number_of_dicoms"] == 100
+    assert descriptions == ["T1 MPRAGE", "FLAIR"]
+    assert connection.commits == 1
+
+
+def test_insert_series_bulk_other_errors_raise():
+    database, connection = make_database()
+    with pytest.raises(RuntimeError):
+        database.insert_series_bulk(
+            [make_series(0), make_series(1, error=RuntimeError("Ambra error"))],
+            id_study=7,
+            series_exceptions=(LookupError,),
+        )
+    assert connection.statements == []
+
+
+def test_insert_series_bulk_stop_on_exception():
+    database, connection = make_database()
+    fetched = []
+    series_list = [
+        make_series(0),
+        make_series(1, error=LookupError("no tags")),
+        make_series(2),
+    ]
+    for series in series_list:
+        get_tags = series.get_tags
+
+        def recorded(level, series=series, get_tags=get_tags):
+            fetched.append(series.series_uid)
+            return get_tags(level)
+
+        series.get_tags = recorded
+
+    failed = database.insert_series_bulk(
+        series_list,
+        id_study=7,
+        series_exceptions=(LookupError,),
+        stop_on_exception=True,
+    )
+
+    assert [series.series_uid for series, _ in failed] == ["1.2.1"]
+    assert fetched == ["1.2.0", "1.2.1"]
+    assert connection.statements == []
+
+
+def test_study_updated_datetime():
+    study = SimpleNamespace(
+        created="2024-01-01 10:00:00.5-07", updated="2024-02-01 11:30:00+02"
+    )
+    assert study_updated_datetime(study) == datetime(2024, 2, 1, 11, 30)
+    study.updated = None
+    assert study_updated_datetime(study) == datetime(2024, 1, 1, 10, 0, 0, 500000)
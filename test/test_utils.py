@@ -0,0 +1,116 @@
+"""
+Tests for the row chunking and LOAD DATA helpers of utils
+"""
+
+import csv
+import io
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from AMBRA_Backups import utils
+
+
+class FakeDatabase:
+    """
+    Records the statements df_to_db_table runs instead of sending them.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.queries = []
+        self.depth = 0
+
+    def check_columns(self, table_name, columns):
+        pass
+
+    def table_columns(self, table_name):
+        return ["id"] + self.columns
+
+    @contextmanager
+    def transaction(self):
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+    def in_transaction(self):
+        return self.depth > 0
+
+    def run_insert_query(self, query, record):
+        self.queries.append((query, record))
+        return len(self.queries)
+
+
+def test_chunks_by_rows():
+    df = pd.DataFrame({"a": range(10), "b": list("abcdefghij")})
+    chunks = list(utils.iter_row_chunks(df, chunk_size=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert [row for chunk in chunks for row in chunk] == df.values.tolist()
+
+
+def test_chunks_by_bytes():
+    df = pd.DataFrame({"a": ["x" * 10] * 6})
+    row_bytes = utils._row_bytes(["x" * 10])
+    chunks = list(
+        utils.iter_row_chunks(df, chunk_size=100, max_chunk_bytes=2 * row_bytes)
+    )
+    assert [len(chunk) for chunk in chunks] == [2, 2, 2]
+
+
+def test_oversized_row_gets_its_own_chunk():
+    df = pd.DataFrame({"a": ["small", "x" * 1000, "small", "small"]})
+    chunks = list(utils.iter_row_chunks(df, chunk_size=100, max_chunk_bytes=100))
+    assert [len(chunk) for chunk in chunks] == [1, 1, 2]
+    assert chunks[1] == [["x" * 1000]]
+
+
+def test_empty_frame_has_no_chunks():
+    assert list(utils.iter_row_chunks(pd.DataFrame({"a": []}))) == []
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, "\\N"),
+        (np.nan, "\\N"),
+        (pd.NaT, "\\N"),
+        (True, 1),
+        (False, 0),
+        (3, 3),
+        ("plain", "plain"),
+        ("back\\slash", "back\\\\slash"),
+        ("tab\there", "tab\\there"),
+        ("two\nlines\r\n", "two\\nlines\\r\\n"),
+        ("\\N", "\\\\N"),
+    ],
+)
+def test_csv_value(value, expected):
+    assert utils._csv_value(value) == expected
+
+
+def test_csv_rows_stay_on_one_line():
+    rows = [["a,b", 'say "hi"', "line\nbreak", None]]
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerows([[utils._csv_value(value) for value in row] for row in rows])
+    assert output.getvalue() == '"a,b","say ""hi""",line\\nbreak,\\N\n'
+
+
+def test_load_data_inside_transaction_raises():
+    db = FakeDatabase(["a"])
+    with db.transaction(), pytest.raises(RuntimeError):
+        utils.load_data_infile(db, pd.DataFrame({"a": [1]}), "table")
+
+
+def test_load_data_inside_transaction_uses_inserts():
+    db = FakeDatabase(["a", "b"])
+    df = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    with db.transaction():
+        row_id = utils.df_to_db_table(db, df, "table", chunk_size=2, load_data=True)
+
+    assert row_id == 1
+    assert [record for _, record in db.queries] == [[1, "x", 2, "y"], [3, "z"]]